@@ -0,0 +1,141 @@
+import ipaddress
+import logging
+import math
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Union
+from config import (ADMISSION_MAX_QUEUE, ADMISSION_BATCH_SHARE, ADMISSION_MAX_PER_CLIENT, ADMISSION_RETRY_AFTER,
+                    ADMISSION_CLIENT_HEADER, ADMISSION_TRUSTED_PROXIES)
+from job_queue import JobQueue, QUEUED, INTERACTIVE, BATCH
+from metrics import count_admission
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Priority classes clients can ask for, by name
+PRIORITIES = {"interactive": INTERACTIVE, "batch": BATCH}
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+# Bounds of the Retry-After estimate, in seconds
+MIN_RETRY_AFTER, MAX_RETRY_AFTER = 1, 300
+
+@dataclass(slots=True)
+class Rejection:
+    """Why a job was turned away: the HTTP status, a message and when to try again."""
+    status: int
+    reason: str
+    retry_after: int
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(self.retry_after)}
+
+class AdmissionController:
+    """
+    Decides whether a new job may join the queue, before anything is created for it.
+
+    The worker pool caps how many pipelines run at once; this keeps the line in front of
+    it short enough to be worth waiting in. A full queue turns everyone away (503), and a
+    client with `max_per_client` jobs queued or running is turned away on its own (429),
+    so one client can't take the whole queue. Batch-priority work may only fill
+    `batch_share` of the queue, leaving the rest for interactive prompts.
+
+    Rejections carry a Retry-After estimated from how fast the queue is draining.
+    """
+
+    def __init__(self, queue: JobQueue, max_queue: int = ADMISSION_MAX_QUEUE, batch_share: float = ADMISSION_BATCH_SHARE,
+                 max_per_client: int = ADMISSION_MAX_PER_CLIENT, retry_after: float = ADMISSION_RETRY_AFTER):
+        self.queue = queue
+        self.max_queue = max_queue
+        self.batch_share = batch_share
+        self.max_per_client = max_per_client
+        self.retry_after = retry_after
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {"queue_full": 0, "client_limit": 0}
+
+    def check(self, client: str, priority: int = INTERACTIVE) -> Optional[Rejection]:
+        """
+        Admit a job or say why not.
+
+        Arguments:
+            client: Who submits the job (see client_key)
+            priority: The job's priority class
+
+        Returns:
+            None if the job may be enqueued, otherwise a Rejection
+        """
+        priority_name = "batch" if priority == BATCH else "interactive"
+        limit = self.max_queue
+        if priority == BATCH and limit > 0:
+            limit = max(1, int(limit * self.batch_share))
+        if limit > 0:
+            queued = self.queue.counts()[QUEUED]
+            if queued >= limit:
+                return self._reject("queue_full", priority_name, 503,
+                                    f"The queue is full ({queued} prompts waiting); try again later",
+                                    queued - limit + 1)
+        if self.max_per_client > 0:
+            load = self.queue.load(client)
+            if load >= self.max_per_client:
+                return self._reject("client_limit", priority_name, 429,
+                                    f"Too many prompts in progress for this client ({load}); try again later",
+                                    load - self.max_per_client + 1)
+        self.admitted += 1
+        count_admission("admitted", priority_name)
+        return None
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "max_queue": self.max_queue,
+            "max_per_client": self.max_per_client,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "throughput_per_second": round(self.queue.throughput(), 3),
+        }
+
+    def _reject(self, outcome: str, priority_name: str, status: int, reason: str, excess: int) -> Rejection:
+        self.rejected[outcome] += 1
+        count_admission(outcome, priority_name)
+        return Rejection(status=status, reason=reason, retry_after=self._retry_after(excess))
+
+    def _retry_after(self, excess: int) -> int:
+        """Seconds until `excess` jobs should have finished at the recent throughput."""
+        rate = self.queue.throughput()
+        seconds = excess / rate if rate > 0 else self.retry_after
+        return int(min(max(math.ceil(seconds), MIN_RETRY_AFTER), MAX_RETRY_AFTER))
+
+def parse_networks(spec: str) -> List[Network]:
+    """Parse a comma-separated list of addresses and networks, skipping invalid entries."""
+    networks = []
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        try:
+            networks.append(ipaddress.ip_network(entry.strip(), strict=False))
+        except ValueError:
+            logger.warning(f"Ignoring invalid trusted proxy {entry.strip()!r}")
+    return networks
+
+# Peers whose ADMISSION_CLIENT_HEADER is believed
+TRUSTED_PROXIES = parse_networks(ADMISSION_TRUSTED_PROXIES)
+
+def client_key(request, trusted_proxies: Optional[List[Network]] = None) -> str:
+    """
+    Who a request is from: its remote address, or the ADMISSION_CLIENT_HEADER header when the
+    request comes through a trusted proxy. Anyone else could send a new id with every request
+    and so dodge the per-client limit.
+    """
+    if trusted_proxies is None:
+        trusted_proxies = TRUSTED_PROXIES
+    host = request.client.host if request.client is not None else "unknown"
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return host
+    if any(address in network for network in trusted_proxies):
+        client = request.headers.get(ADMISSION_CLIENT_HEADER)
+        if client:
+            return client.strip()[:128]
+    return host
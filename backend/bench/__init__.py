@@ -0,0 +1 @@
+"""Offline benchmark harness: a mock LLM server (mock_llm.py) and a load driver (run.py)."""
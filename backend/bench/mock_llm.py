@@ -0,0 +1,353 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import re
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional, Tuple
+from aiohttp import web
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Words used to pad replies out to the requested length
+FILLER = ("the quick brown fox jumps over a lazy dog while seven wizards quietly "
+          "hex jolly dwarves and sphinxes of black quartz judge my vow").split()
+
+# Rough local stand-ins for the parser's category split, so the pipeline sees realistic plans
+MATH_HINT = re.compile(r"\d\s*[-+*/^=]\s*\d|\b(solve|integral|derivative|equation|probability|sum of)\b", re.I)
+CODE_HINT = re.compile(r"\b(python|javascript|function|code|script|sql|regex|class|bug|compile)\b", re.I)
+LITERATURE_HINT = re.compile(r"\b(poem|novel|story|author|theme|shakespeare|character|essay)\b", re.I)
+
+# Content wrapped in <content> tags, as the generation prompts send it
+CONTENT_TAGS = re.compile(r"<content>\n?(.*?)\n?</content>", re.S)
+
+@dataclass(slots=True)
+class MockConfig:
+    """How one mock provider behaves."""
+    latency: float = 0.2             # Median seconds until the reply (or first token) starts
+    jitter: float = 0.5              # Sigma of the log-normal spread around the median
+    error_rate: float = 0.0          # Share of calls answered with `error_status`
+    error_status: int = 529          # Status returned for injected errors
+    retry_after: Optional[float] = None  # Retry-After header sent with injected errors
+    stream_errors: float = 0.0       # Share of streams cut off mid-reply
+    tokens_per_second: float = 200.0  # Streaming speed (0 sends the whole reply at once)
+    reply_tokens: int = 120          # Reply length, capped by the request's max tokens
+    cache_min_tokens: int = 1024     # Shortest system prompt the prompt cache stores, as in the real API
+
+    def sample_latency(self, rng: random.Random) -> float:
+        if self.jitter <= 0:
+            return self.latency
+        return rng.lognormvariate(0, self.jitter) * self.latency
+
+@dataclass
+class MockStats:
+    requests: int = 0
+    streams: int = 0
+    errors: int = 0
+    stream_errors: int = 0
+    batches: int = 0
+    batch_requests: int = 0
+    by_kind: Dict[str, int] = field(default_factory=dict)
+
+class MockLLM:
+    """
+    Local stand-in for the Anthropic Messages (and Message Batches) and Gemini
+    generateContent endpoints.
+
+    Replies follow each API's JSON and SSE formats closely enough for providers.py, with
+    configurable latency, error rates and streaming speed per provider. Message batches
+    end `batch_delay` seconds after they are created. Parser and batched
+    generation requests get JSON replies derived from the prompt, so sessions take the
+    same paths through the pipeline as they would against the real APIs.
+    """
+
+    def __init__(self, claude: Optional[MockConfig] = None, gemini: Optional[MockConfig] = None,
+                 seed: Optional[int] = None, batch_delay: float = 1.0):
+        self.configs = {"claude": claude or MockConfig(), "gemini": gemini or MockConfig()}
+        self.stats = {"claude": MockStats(), "gemini": MockStats()}
+        self.rng = random.Random(seed)
+        self.batch_delay = batch_delay
+        self.message_batches: Dict[str, Dict] = {}
+        # System prompts in the simulated prompt cache (it never expires here)
+        self.prompt_cache = set()
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/messages", self.anthropic_messages)
+        app.router.add_post("/v1/messages/batches", self.create_message_batch)
+        app.router.add_get("/v1/messages/batches/{batch_id}", self.get_message_batch)
+        app.router.add_get("/v1/messages/batches/{batch_id}/results", self.get_message_batch_results)
+        app.router.add_post("/v1/models/{name}", self.gemini_generate)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+    async def anthropic_messages(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        system, prompt = _system_text(body), _message_text(body.get("messages", []))
+        text, kind = self._reply(system, prompt, body.get("max_tokens", 4096), "claude")
+        usage = self._claude_usage(body, system, prompt, text)
+
+        error = await self._delay_or_error("claude", kind, body.get("stream", False))
+        if error is not None:
+            return error
+        if not body.get("stream"):
+            return web.json_response({
+                "id": "msg_mock", "type": "message", "role": "assistant", "model": body.get("model"),
+                "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "usage": usage,
+            })
+
+        response = await _start_sse(request)
+        await _send_sse(response, {"type": "message_start", "message": {
+            "id": "msg_mock", "model": body.get("model"), "usage": {**usage, "output_tokens": 1}}},
+                        event="message_start")
+        cut = await self._stream_chunks("claude", text, lambda chunk: _send_sse(response, {
+            "type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}}, event="content_block_delta"))
+        if cut:
+            await _send_sse(response, {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}},
+                            event="error")
+            return response
+        await _send_sse(response, {"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                                   "usage": {"output_tokens": usage["output_tokens"]}}, event="message_delta")
+        await _send_sse(response, {"type": "message_stop"}, event="message_stop")
+        return response
+
+    async def create_message_batch(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        batch_id = f"msgbatch_mock{len(self.message_batches) + 1}"
+        batch = self.message_batches[batch_id] = {
+            "id": batch_id, "type": "message_batch", "processing_status": "in_progress",
+            "request_counts": {"processing": len(body["requests"]), "succeeded": 0, "errored": 0,
+                               "canceled": 0, "expired": 0},
+            "results_url": None, "results": [],
+        }
+        self.stats["claude"].batches += 1
+        self.stats["claude"].batch_requests += len(body["requests"])
+        asyncio.get_running_loop().call_later(self.batch_delay, self._end_message_batch, batch, body["requests"],
+                                              f"{request.scheme}://{request.host}/v1/messages/batches/{batch_id}/results")
+        return web.json_response(_batch_info(batch))
+
+    async def get_message_batch(self, request: web.Request) -> web.Response:
+        batch = self.message_batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"type": "error", "error": {"type": "not_found_error", "message": "No such batch"}},
+                                     status=404)
+        return web.json_response(_batch_info(batch))
+
+    async def get_message_batch_results(self, request: web.Request) -> web.Response:
+        batch = self.message_batches.get(request.match_info["batch_id"])
+        if batch is None or batch["processing_status"] != "ended":
+            return web.json_response({"type": "error", "error": {"type": "not_found_error", "message": "No results"}},
+                                     status=404)
+        body = "".join(json.dumps(line) + "\n" for line in batch["results"])
+        return web.Response(text=body, content_type="application/x-jsonlines")
+
+    def _end_message_batch(self, batch: Dict, requests: List[Dict], results_url: str):
+        config = self.configs["claude"]
+        counts = batch["request_counts"]
+        for entry in requests:
+            params = entry["params"]
+            system, prompt = _system_text(params), _message_text(params.get("messages", []))
+            text, kind = self._reply(system, prompt, params.get("max_tokens", 4096), "claude")
+            self.stats["claude"].by_kind[kind] = self.stats["claude"].by_kind.get(kind, 0) + 1
+            if self.rng.random() < config.error_rate:
+                counts["errored"] += 1
+                result = {"type": "errored", "error": {"type": "error", "error": {
+                    "type": "overloaded_error", "message": "Injected error"}}}
+            else:
+                counts["succeeded"] += 1
+                result = {"type": "succeeded", "message": {
+                    "id": "msg_mock", "type": "message", "role": "assistant", "model": params.get("model"),
+                    "content": [{"type": "text", "text": text}], "stop_reason": "end_turn",
+                    "usage": self._claude_usage(params, system, prompt, text)}}
+            batch["results"].append({"custom_id": entry["custom_id"], "result": result})
+        counts["processing"] = 0
+        batch["processing_status"] = "ended"
+        batch["results_url"] = results_url
+
+    async def gemini_generate(self, request: web.Request) -> web.StreamResponse:
+        name = request.match_info["name"]
+        body = await request.json()
+        prompt = " ".join(part.get("text", "") for content in body.get("contents", [])
+                          for part in content.get("parts", []))
+        max_tokens = body.get("generationConfig", {}).get("maxOutputTokens", 2048)
+        text, kind = self._reply("", prompt, max_tokens, "gemini")
+        prompt_tokens, reply_tokens = _count_tokens(prompt), _count_tokens(text)
+        usage = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": reply_tokens,
+                 "totalTokenCount": prompt_tokens + reply_tokens}
+
+        streaming = name.endswith(":streamGenerateContent")
+        error = await self._delay_or_error("gemini", kind, streaming)
+        if error is not None:
+            return error
+        if not streaming:
+            return web.json_response({"candidates": [{"content": {"role": "model", "parts": [{"text": text}]},
+                                                      "finishReason": "STOP"}], "usageMetadata": usage})
+
+        response = await _start_sse(request)
+        cut = await self._stream_chunks("gemini", text, lambda chunk: _send_sse(response, {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": chunk}]}}]}))
+        if not cut:
+            await _send_sse(response, {"candidates": [{"content": {"role": "model", "parts": [{"text": ""}]},
+                                                       "finishReason": "STOP"}], "usageMetadata": usage})
+        # A cut stream just ends, which the client reports as missing its finishReason
+        return response
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({provider: vars(stats) for provider, stats in self.stats.items()})
+
+    def _claude_usage(self, body: Dict, system: str, prompt: str, text: str) -> Dict[str, int]:
+        """Anthropic usage for a request, with a system prompt marked for caching counted as a cache write or read."""
+        usage = {"input_tokens": _count_tokens(system) + _count_tokens(prompt), "output_tokens": _count_tokens(text),
+                 "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+        blocks = body.get("system")
+        marked = isinstance(blocks, list) and any(block.get("cache_control") for block in blocks)
+        if marked and _count_tokens(system) >= self.configs["claude"].cache_min_tokens:
+            usage["input_tokens"] -= _count_tokens(system)
+            if system in self.prompt_cache:
+                usage["cache_read_input_tokens"] = _count_tokens(system)
+            else:
+                self.prompt_cache.add(system)
+                usage["cache_creation_input_tokens"] = _count_tokens(system)
+        return usage
+
+    def _reply(self, system: str, prompt: str, max_tokens: int, provider: str) -> Tuple[str, str]:
+        """The reply text for a request and what kind of request it was."""
+        if "analyzing and categorizing" in system:
+            return json.dumps(split_categories(prompt)), "parse"
+        if "mapping those categories to content" in system:
+            try:
+                # The JSON object follows the list of categories
+                categories = json.loads(prompt[prompt.find("{"):])
+            except json.JSONDecodeError:
+                categories = {}
+            return json.dumps({category: f"Answer this clearly and completely: {content}"
+                               for category, content in categories.items()}), "generate_batch"
+        if "creating structured prompts" in system:
+            content = CONTENT_TAGS.search(prompt)
+            return f"Answer this clearly and completely: {content.group(1) if content else prompt}", "generate"
+        length = min(self.configs[provider].reply_tokens, max_tokens)
+        kind = "combine" if "synthesizing information" in system else "compact" if "condensing" in system else "answer"
+        return filler_text(length, self.rng), kind
+
+    async def _delay_or_error(self, provider: str, kind: str, streaming: bool) -> Optional[web.Response]:
+        config = self.configs[provider]
+        stats = self.stats[provider]
+        stats.requests += 1
+        stats.streams += streaming
+        stats.by_kind[kind] = stats.by_kind.get(kind, 0) + 1
+        await asyncio.sleep(config.sample_latency(self.rng))
+        if self.rng.random() < config.error_rate:
+            stats.errors += 1
+            headers = {"retry-after": f"{config.retry_after:g}"} if config.retry_after is not None else None
+            return web.json_response({"type": "error", "error": {"type": "overloaded_error", "message": "Injected error"}},
+                                     status=config.error_status, headers=headers)
+        return None
+
+    async def _stream_chunks(self, provider: str, text: str, send) -> bool:
+        """Send `text` in word chunks at the configured speed; returns True if the stream was cut."""
+        config = self.configs[provider]
+        words = text.split(" ")
+        cut_at = len(words) + 1
+        if self.rng.random() < config.stream_errors:
+            self.stats[provider].stream_errors += 1
+            cut_at = self.rng.randrange(1, max(2, len(words)))
+        # Roughly four words per chunk, like the real APIs
+        for start in range(0, len(words), 4):
+            if start >= cut_at:
+                return True
+            chunk = " ".join(words[start:start + 4]) + (" " if start + 4 < len(words) else "")
+            await send(chunk)
+            if config.tokens_per_second > 0:
+                await asyncio.sleep(_count_tokens(chunk) / config.tokens_per_second)
+        return False
+
+def _batch_info(batch: Dict) -> Dict:
+    """A message batch as the API describes it (without the results)."""
+    return {key: value for key, value in batch.items() if key != "results"}
+
+def split_categories(prompt: str) -> Dict[str, str]:
+    """Split a prompt into the parser's categories by sentence, using keyword hints."""
+    buckets: Dict[str, List[str]] = {"general_knowledge": [], "mathematics": [], "coding": [], "literature": []}
+    for sentence in re.split(r"(?<=[.?!])\s+", prompt.strip()):
+        if not sentence:
+            continue
+        if CODE_HINT.search(sentence):
+            buckets["coding"].append(sentence)
+        elif MATH_HINT.search(sentence):
+            buckets["mathematics"].append(sentence)
+        elif LITERATURE_HINT.search(sentence):
+            buckets["literature"].append(sentence)
+        else:
+            buckets["general_knowledge"].append(sentence)
+    return {category: " ".join(sentences) or "Not Applicable" for category, sentences in buckets.items()}
+
+def filler_text(tokens: int, rng: random.Random) -> str:
+    return " ".join(rng.choice(FILLER) for _ in range(max(1, tokens)))
+
+def _count_tokens(text: str) -> int:
+    return max(1, len(text) // 4) if text else 0
+
+def _system_text(body: Dict) -> str:
+    system = body.get("system") or ""
+    if isinstance(system, list):
+        return " ".join(block.get("text", "") for block in system)
+    return system
+
+def _message_text(messages: List[Dict]) -> str:
+    parts = []
+    for message in messages:
+        content = message.get("content", "")
+        if isinstance(content, list):
+            parts.extend(block.get("text", "") for block in content)
+        else:
+            parts.append(content)
+    return "\n".join(parts)
+
+async def _start_sse(request: web.Request) -> web.StreamResponse:
+    response = web.StreamResponse(headers={"content-type": "text/event-stream", "cache-control": "no-cache"})
+    await response.prepare(request)
+    return response
+
+async def _send_sse(response: web.StreamResponse, data: Dict, event: Optional[str] = None):
+    lines = (f"event: {event}\n" if event else "") + f"data: {json.dumps(data)}\n\n"
+    await response.write(lines.encode("utf-8"))
+
+async def start_mock_server(mock: MockLLM, host: str = "127.0.0.1", port: int = 0) -> Tuple[web.AppRunner, str]:
+    """
+    Serve `mock` in the running event loop.
+
+    Returns:
+        Tuple of (runner to clean up when done, base URL such as http://127.0.0.1:54321)
+    """
+    runner = web.AppRunner(mock.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_host, bound_port = runner.addresses[0][:2]
+    return runner, f"http://{bound_host}:{bound_port}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the mock LLM server on its own")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8811)
+    parser.add_argument("--latency", type=float, default=0.2, help="Median seconds before each reply starts")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Log-normal sigma of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of calls that fail")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Streaming speed")
+    parser.add_argument("--batch-delay", type=float, default=1.0, help="Seconds until a message batch ends")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = MockConfig(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        tokens_per_second=args.tokens_per_second)
+    mock = MockLLM(claude=config, gemini=replace(config), seed=args.seed, batch_delay=args.batch_delay)
+    logger.info(f"Mock LLM server on http://{args.host}:{args.port} "
+                f"(ANTHROPIC_API_URL=http://{args.host}:{args.port}/v1/messages, GEMINI_API_URL=http://{args.host}:{args.port}/v1)")
+    web.run_app(mock.make_app(), host=args.host, port=args.port, print=None, access_log=None)
+
+if __name__ == "__main__":
+    main()
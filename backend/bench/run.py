@@ -0,0 +1,356 @@
+"""
+Offline load test: replays a workload of prompts against main.app, with the LLM APIs
+replaced by the local mock in mock_llm.py, and reports throughput, latency percentiles
+and memory growth. Needs no network or API keys.
+
+Run from the backend directory:
+
+    python -m bench.run --sessions 200 --concurrency 100
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_WORKLOAD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "workload.jsonl")
+
+# Statuses after which a session no longer changes (same as main.FINAL_STATUSES)
+FINAL_STATUSES = ("completed", "error")
+
+logger = logging.getLogger("bench")
+
+def load_workload(path: str) -> List[str]:
+    """
+    Read prompts from a JSONL file.
+
+    Each line is an object with a "prompt" field, or a "title" and "body" (the format of
+    requests.jsonl), or a bare JSON string.
+    """
+    prompts = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                prompts.append(item)
+            elif "prompt" in item:
+                prompts.append(item["prompt"])
+            else:
+                prompts.append("\n\n".join(part for part in (item.get("title"), item.get("body")) if part))
+    if not prompts:
+        raise ValueError(f"No prompts in {path}")
+    return prompts
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile, or None for no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "count": len(values),
+        "p50": _round(percentile(values, 50)),
+        "p90": _round(percentile(values, 90)),
+        "p99": _round(percentile(values, 99)),
+        "max": _round(max(values)) if values else None,
+    }
+
+def rss_bytes() -> int:
+    """Resident set size of this process (the app, the mock and the driver share it)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        # Peak rather than current outside Linux; kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 4) if value is not None else None
+
+async def run_session(client, base_url: str, prompt: str) -> Dict:
+    """Submit one prompt and follow its event stream until the session finishes."""
+    started = time.monotonic()
+    result = {"status": "error", "error": None, "latency": None, "first_delta": None, "metrics": None}
+    try:
+        async with client.post(f"{base_url}/api/prompt", json={"prompt": prompt}) as response:
+            response.raise_for_status()
+            session_id = (await response.json())["session_id"]
+
+        event = None
+        async with client.get(f"{base_url}/api/events/{session_id}") as response:
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8").rstrip()
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                    continue
+                if not line.startswith("data:"):
+                    continue
+                data = json.loads(line[len("data:"):])
+                if event == "delta" and result["first_delta"] is None:
+                    result["first_delta"] = time.monotonic() - started
+                if event in ("snapshot", "update") and data.get("status") in FINAL_STATUSES:
+                    result["status"] = data["status"]
+                    result["error"] = data.get("error")
+                    result["metrics"] = data.get("metrics")
+                    break
+        if result["status"] == "completed" and result["metrics"] is None:
+            # The snapshot of an already finished session carries everything
+            async with client.get(f"{base_url}/api/status/{session_id}") as response:
+                result["metrics"] = (await response.json()).get("metrics")
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {str(e)}"
+    result["latency"] = time.monotonic() - started
+    return result
+
+async def run_load(client, base_url: str, prompts: List[str], sessions: int, concurrency: int,
+                   on_progress=None) -> List[Dict]:
+    """Run `sessions` sessions, cycling through `prompts`, with at most `concurrency` in flight."""
+    queue: asyncio.Queue = asyncio.Queue()
+    for index in range(sessions):
+        queue.put_nowait(prompts[index % len(prompts)])
+    results = []
+
+    async def worker():
+        while True:
+            try:
+                prompt = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            results.append(await run_session(client, base_url, prompt))
+            if on_progress is not None:
+                on_progress(len(results))
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, sessions))))
+    return results
+
+def build_report(results: List[Dict], elapsed: float, memory: Dict[str, int], mock_stats: Dict,
+                 app_stats: Dict, args: argparse.Namespace) -> Dict:
+    completed = [result for result in results if result["status"] == "completed"]
+    stages: Dict[str, List[float]] = {}
+    tokens = {"input": 0, "output": 0, "cache_read": 0, "cache_write": 0}
+    for result in completed:
+        metrics = result["metrics"] or {}
+        per_stage: Dict[str, float] = {}
+        for name, seconds in metrics.get("stages", {}).items():
+            # "generate:coding" and "generate:mathematics" both count towards "generate";
+            # concurrent categories overlap, so a session's stage time is its slowest category
+            stage = name.split(":", 1)[0]
+            per_stage[stage] = max(per_stage.get(stage, 0.0), seconds)
+        for stage, seconds in per_stage.items():
+            stages.setdefault(stage, []).append(seconds)
+        tokens["input"] += metrics.get("input_tokens", 0)
+        tokens["output"] += metrics.get("output_tokens", 0)
+        tokens["cache_read"] += metrics.get("cache_read_tokens", 0)
+        tokens["cache_write"] += metrics.get("cache_write_tokens", 0)
+
+    errors: Dict[str, int] = {}
+    for result in results:
+        if result["status"] != "completed":
+            message = (result["error"] or "unknown").split("\n", 1)[0][:120]
+            errors[message] = errors.get(message, 0) + 1
+
+    return {
+        "config": {
+            "sessions": args.sessions, "concurrency": args.concurrency, "workload": args.workload,
+            "latency": args.latency, "jitter": args.jitter, "error_rate": args.error_rate,
+            "stream": not args.no_stream, "cache": args.cache,
+        },
+        "sessions": len(results),
+        "completed": len(completed),
+        "failed": len(results) - len(completed),
+        "elapsed": round(elapsed, 3),
+        "sessions_per_second": round(len(completed) / elapsed, 3) if elapsed > 0 else None,
+        "session_latency": summarize([result["latency"] for result in completed]),
+        "first_delta": summarize([result["first_delta"] for result in completed if result["first_delta"] is not None]),
+        "stages": {stage: summarize(values) for stage, values in sorted(stages.items())},
+        "tokens": tokens,
+        "memory": {
+            **memory,
+            "growth": memory["end"] - memory["warm"],
+            "growth_per_session": round((memory["end"] - memory["warm"]) / max(len(results), 1)),
+        },
+        "errors": errors,
+        "mock": mock_stats,
+        "app": app_stats,
+    }
+
+def print_report(report: Dict):
+    def row(name: str, summary: Dict):
+        cells = " ".join(f"{summary[key]:>9.3f}" if summary[key] is not None else f"{'-':>9}"
+                         for key in ("p50", "p90", "p99", "max"))
+        print(f"  {name:<16} {summary['count']:>7} {cells}")
+
+    print(f"\nSessions: {report['completed']}/{report['sessions']} completed in {report['elapsed']}s "
+          f"({report['sessions_per_second']} sessions/sec, concurrency {report['config']['concurrency']})")
+    print(f"\n  {'latency (s)':<16} {'count':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    row("session", report["session_latency"])
+    row("first delta", report["first_delta"])
+    for stage, summary in report["stages"].items():
+        row(stage, summary)
+    memory = report["memory"]
+    print(f"\nMemory (RSS): start {memory['start'] / 2**20:.1f} MiB, after warmup {memory['warm'] / 2**20:.1f} MiB, "
+          f"end {memory['end'] / 2**20:.1f} MiB, peak {memory['peak'] / 2**20:.1f} MiB, "
+          f"growth {memory['growth'] / 2**20:+.1f} MiB ({memory['growth_per_session']} bytes/session)")
+    print(f"Tokens: {report['tokens']['input']} in, {report['tokens']['output']} out, "
+          f"{report['tokens']['cache_read']} read from and {report['tokens']['cache_write']} written to the prompt cache")
+    if report["errors"]:
+        print("\nFailures:")
+        for message, count in sorted(report["errors"].items(), key=lambda item: -item[1]):
+            print(f"  {count:>5}  {message}")
+
+def configure_environment(args: argparse.Namespace, mock_url: str, log_dir: str):
+    """Point the app at the mock; must run before any backend module is imported."""
+    environment = {
+        "ANTHROPIC_API_URL": f"{mock_url}/v1/messages",
+        "GEMINI_API_URL": f"{mock_url}/v1",
+        "ANTHROPIC_API_KEY": "bench",
+        "GEMINI_API_KEY": "bench",
+        "STREAM_RESPONSES": "false" if args.no_stream else "true",
+        # The point is to measure the pipeline, not the provider quotas
+        "RATE_LIMIT_REQUESTS": "0",
+        "RETRY_BASE_DELAY": "0.05",
+        "PROMPT_LOG_DIR": os.path.join(log_dir, "prompt_logs"),
+        "PROMPT_BATCH_DB_PATH": os.path.join(log_dir, "prompt_batches.sqlite3"),
+        "CACHE_BACKEND": "memory",
+        "SESSION_BACKEND": "memory",
+        "JOB_BACKEND": "memory",
+        # Every session gets a worker at once, so queueing doesn't hide pipeline latency
+        "JOB_WORKERS": str(args.concurrency),
+        # All sessions come from one address; the load generator shouldn't be throttled as a client
+        "ADMISSION_MAX_PER_CLIENT": "0",
+        "HTTP_POOL_LIMIT": str(max(100, args.concurrency * 4)),
+        "HTTP_POOL_LIMIT_PER_HOST": str(max(20, args.concurrency * 4)),
+    }
+    if not args.cache:
+        # Repeated workload prompts would otherwise be answered from the response cache
+        environment["CACHE_MAX_ENTRIES"] = "0"
+    for name, value in environment.items():
+        # Settings already in the environment win, so any config.py option can be benchmarked
+        os.environ.setdefault(name, value)
+
+async def benchmark(args: argparse.Namespace) -> Dict:
+    from dataclasses import replace
+    from bench.mock_llm import MockConfig, MockLLM, start_mock_server
+
+    config = MockConfig(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        stream_errors=args.stream_error_rate, tokens_per_second=args.tokens_per_second,
+                        reply_tokens=args.reply_tokens)
+    mock = MockLLM(claude=config, gemini=replace(config), seed=args.seed)
+    mock_runner, mock_url = await start_mock_server(mock)
+
+    with tempfile.TemporaryDirectory(prefix="llm-router-bench-") as log_dir:
+        configure_environment(args, mock_url, log_dir)
+        if BACKEND_DIR not in sys.path:
+            sys.path.insert(0, BACKEND_DIR)
+        import aiohttp
+        import uvicorn
+        import main
+
+        if not args.verbose:
+            # Injected errors would flood the output; failures are summed up in the report
+            logging.disable(logging.ERROR)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("127.0.0.1", 0))
+        base_url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+        server = uvicorn.Server(uvicorn.Config(main.app, log_level="warning", access_log=False,
+                                               timeout_keep_alive=60))
+        server_task = asyncio.create_task(server.serve(sockets=[sock]))
+        while not server.started:
+            if server_task.done():
+                server_task.result()
+            await asyncio.sleep(0.01)
+
+        prompts = load_workload(args.workload)
+        memory = {"start": rss_bytes()}
+        peak = memory["start"]
+
+        async def sample_memory():
+            nonlocal peak
+            while True:
+                peak = max(peak, rss_bytes())
+                await asyncio.sleep(0.1)
+
+        sampler = asyncio.create_task(sample_memory())
+        connector = aiohttp.TCPConnector(limit=args.concurrency * 2)
+        try:
+            # Session events repeat the prompt, so a long-input workload needs long SSE lines
+            async with aiohttp.ClientSession(connector=connector, read_bufsize=2**24,
+                                             timeout=aiohttp.ClientTimeout(total=args.session_timeout)) as client:
+                if args.warmup:
+                    await run_load(client, base_url, prompts, args.warmup, args.concurrency)
+                memory["warm"] = rss_bytes()
+
+                def on_progress(done: int):
+                    if not args.quiet and done % max(1, args.sessions // 10) == 0:
+                        print(f"  {done}/{args.sessions} sessions", file=sys.stderr)
+
+                started = time.monotonic()
+                results = await run_load(client, base_url, prompts, args.sessions, args.concurrency, on_progress)
+                elapsed = time.monotonic() - started
+                memory["end"] = rss_bytes()
+
+                async with client.get(f"{base_url}/api/stats") as response:
+                    app_stats = await response.json()
+        finally:
+            sampler.cancel()
+            server.should_exit = True
+            await server_task
+            await mock_runner.cleanup()
+
+        memory["peak"] = max(peak, memory["end"])
+        mock_stats = {provider: vars(stats) for provider, stats in mock.stats.items()}
+        return build_report(results, elapsed, memory, mock_stats, app_stats, args)
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline load test of the prompt pipeline against a mock LLM server")
+    parser.add_argument("--workload", default=DEFAULT_WORKLOAD, help="JSONL file of prompts")
+    parser.add_argument("--sessions", type=int, default=100, help="Sessions to run (the workload is cycled)")
+    parser.add_argument("--concurrency", type=int, default=20, help="Sessions in flight at once")
+    parser.add_argument("--warmup", type=int, default=10, help="Sessions run first and left out of the report")
+    parser.add_argument("--latency", type=float, default=0.2, help="Median mock latency before each reply (seconds)")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Log-normal sigma of the mock latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of mock calls that fail with 529")
+    parser.add_argument("--stream-error-rate", type=float, default=0.0, help="Share of mock streams cut off")
+    parser.add_argument("--tokens-per-second", type=float, default=400.0, help="Mock streaming speed")
+    parser.add_argument("--reply-tokens", type=int, default=120, help="Length of mock answers")
+    parser.add_argument("--no-stream", action="store_true", help="Run with STREAM_RESPONSES=false")
+    parser.add_argument("--cache", action="store_true", help="Keep the response cache enabled")
+    parser.add_argument("--session-timeout", type=float, default=300, help="Give up on a session after this long")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the mock's latency and errors")
+    parser.add_argument("--output", help="Also write the report as JSON to this file")
+    parser.add_argument("--max-failure-rate", type=float, default=None,
+                        help="Exit with status 1 if more than this share of sessions fail (for CI)")
+    parser.add_argument("--quiet", action="store_true", help="No progress output")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's logging")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    report = asyncio.run(benchmark(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.max_failure_rate is not None and report["failed"] > args.max_failure_rate * report["sessions"]:
+        print(f"\nFailure rate above {args.max_failure_rate}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
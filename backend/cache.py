@@ -0,0 +1,202 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from config import CACHE_BACKEND, CACHE_TTL, CACHE_MAX_ENTRIES, CACHE_PATH
+from metrics import count_cache_lookup
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def normalize_prompt(text: str) -> str:
+    """Unify line endings and strip outer whitespace; nothing else about a prompt is safe to change."""
+    return text.replace("\r\n", "\n").strip()
+
+def make_cache_key(provider: str, model: str, system_prompt: str, prompt: str, **params) -> str:
+    """
+    Build a cache key from everything that determines a provider's reply.
+
+    Only line endings and outer whitespace are normalized, since indentation and line breaks
+    inside a prompt (code, lists) can change its meaning; params with a value of None are dropped.
+    """
+    normalized = {
+        "provider": provider,
+        "model": model,
+        "system": normalize_prompt(system_prompt),
+        "prompt": normalize_prompt(prompt),
+        "params": {key: value for key, value in sorted(params.items()) if value is not None},
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    Base class for response caches; subclasses store text values with a TTL and a size bound.
+    Used directly it is a no-op cache that always misses.
+    """
+
+    backend = "none"
+
+    def __init__(self, ttl: float = CACHE_TTL, max_entries: int = CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        count_cache_lookup(value is not None)
+        return value
+
+    def set(self, key: str, value: str):
+        self._set(key, value)
+
+    async def lookup(self, key: str) -> Optional[str]:
+        """Async get() for use on the event loop."""
+        return self.get(key)
+
+    async def store(self, key: str, value: str):
+        """Async set() for use on the event loop."""
+        self.set(key, value)
+
+    def stats(self) -> Dict[str, object]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend,
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _get(self, key: str) -> Optional[str]:
+        return None
+
+    def _set(self, key: str, value: str):
+        pass
+
+    def __len__(self) -> int:
+        return 0
+
+class MemoryCache(ResponseCache):
+    """In-process LRU cache with per-entry expiry."""
+
+    backend = "memory"
+
+    def __init__(self, ttl: float = CACHE_TTL, max_entries: int = CACHE_MAX_ENTRIES):
+        super().__init__(ttl, max_entries)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key: str, value: str):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+class SQLiteCache(ResponseCache):
+    """
+    On-disk cache backed by SQLite, so entries survive restarts and are shared by workers
+    on the same host. Least recently used entries are evicted past max_entries.
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path: str = CACHE_PATH, ttl: float = CACHE_TTL, max_entries: int = CACHE_MAX_ENTRIES):
+        super().__init__(ttl, max_entries)
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)")
+
+    async def lookup(self, key: str) -> Optional[str]:
+        # Keep disk access off the event loop
+        return await asyncio.to_thread(self.get, key)
+
+    async def store(self, key: str, value: str):
+        await asyncio.to_thread(self.set, key, value)
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.evictions += 1
+                return None
+            self._conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+        return value
+
+    def _set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now)
+            )
+            self._conn.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+            count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used_at LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+                self.evictions += count - self.max_entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+def make_cache(backend: str = CACHE_BACKEND) -> ResponseCache:
+    """Create the cache configured by CACHE_BACKEND ("memory", "sqlite" or "none")."""
+    if backend == "memory":
+        return MemoryCache()
+    if backend == "sqlite":
+        logger.info(f"Using SQLite response cache at {CACHE_PATH}")
+        return SQLiteCache()
+    if backend != "none":
+        logger.warning(f"Unknown CACHE_BACKEND {backend!r}, caching disabled")
+    return ResponseCache()
+
+# Shared cache used by the provider calls
+response_cache = make_cache()
@@ -0,0 +1,91 @@
+import logging
+import re
+from typing import Dict, Iterator, Tuple
+from config import MAP_REDUCE_CHUNK_TOKENS, MAP_REDUCE_OVERLAP_TOKENS
+from tokens import CHARS_PER_TOKEN
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Stands in for the middle of a long prompt while it is parsed; restore_excerpt() puts it back
+OMITTED_MARKER = "[[OMITTED {} CHARACTERS]]"
+OMITTED_PATTERN = re.compile(r"\[\[OMITTED \d+ CHARACTERS\]\]")
+
+# Where a chunk may end, best first: paragraph, line, sentence, word
+BOUNDARIES = ("\n\n", "\n", ". ", " ")
+
+def make_excerpt(text: str, excerpt_tokens: int) -> Tuple[str, Tuple[int, int]]:
+    """
+    Shorten a long text to its start and end, for a step (like parsing) that only needs
+    the gist and would otherwise have to copy the whole text into its reply.
+
+    Returns:
+        Tuple of (excerpt with OMITTED_MARKER in place of the middle, (start, end) of the
+        omitted span in `text`)
+    """
+    keep = excerpt_tokens * CHARS_PER_TOKEN // 2
+    if len(text) <= 2 * keep:
+        return text, (len(text), len(text))
+    start = _boundary_before(text, keep, keep // 2)
+    end = _boundary_after(text, len(text) - keep, len(text) - keep // 2)
+    return text[:start] + OMITTED_MARKER.format(end - start) + text[end:], (start, end)
+
+def restore_excerpt(categories: Dict[str, str], text: str, span: Tuple[int, int]) -> Dict[str, str]:
+    """
+    Put the span omitted by make_excerpt() back into the parsed categories.
+
+    The marker is replaced wherever the parser copied it. If it was dropped, the whole text
+    goes to the category that holds most of the excerpt, since that is where the bulk of
+    the prompt belongs.
+    """
+    start, end = span
+    if start >= end:
+        return categories
+    restored = dict(categories)
+    found = False
+    for category, content in categories.items():
+        if isinstance(content, str) and OMITTED_PATTERN.search(content):
+            # A function replacement so backslashes in the text aren't treated as escapes
+            restored[category] = OMITTED_PATTERN.sub(lambda match: text[start:end], content)
+            found = True
+    if not found:
+        applicable = [category for category, content in categories.items() if content != "Not Applicable"]
+        target = max(applicable, key=lambda category: len(categories[category]), default="general_knowledge")
+        logger.warning(f"Parser dropped the omitted text marker, giving the whole prompt to {target}")
+        restored[target] = text
+    return restored
+
+def iter_chunks(text: str, chunk_tokens: int = MAP_REDUCE_CHUNK_TOKENS,
+                overlap_tokens: int = MAP_REDUCE_OVERLAP_TOKENS) -> Iterator[str]:
+    """
+    Yield consecutive chunks of about `chunk_tokens` each, ending on paragraph, line,
+    sentence or word boundaries where possible, with `overlap_tokens` repeated between
+    neighbours. Chunks are produced lazily, so only the ones being processed are held.
+    """
+    size = max(1, chunk_tokens) * CHARS_PER_TOKEN
+    overlap = min(max(0, overlap_tokens) * CHARS_PER_TOKEN, size // 4)
+    position = 0
+    while position < len(text):
+        end = len(text) if len(text) - position <= size else _boundary_before(text, position + size, position + size // 2)
+        yield text[position:end]
+        if end >= len(text):
+            return
+        position = max(position + 1, _boundary_after(text, end - overlap, end)) if overlap else end
+
+def _boundary_before(text: str, limit: int, floor: int) -> int:
+    """The end of the last boundary in text[floor:limit], or `limit` if there is none."""
+    for boundary in BOUNDARIES:
+        index = text.rfind(boundary, floor, limit)
+        if index != -1:
+            return index + len(boundary)
+    return limit
+
+def _boundary_after(text: str, start: int, ceiling: int) -> int:
+    """The end of the first boundary in text[start:ceiling], or `start` if there is none."""
+    for boundary in BOUNDARIES:
+        index = text.find(boundary, start, ceiling)
+        if index != -1:
+            return index + len(boundary)
+    return start
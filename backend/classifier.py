@@ -0,0 +1,142 @@
+import logging
+import re
+from dataclasses import dataclass
+from typing import Dict
+from config import CLASSIFIER_ENABLED, CLASSIFIER_THRESHOLD
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+CATEGORIES = ["general_knowledge", "mathematics", "coding", "literature"]
+
+CODE_FENCE = re.compile(r"```")
+CODE_LINE = re.compile(
+    r"^\s*(def |class |import |from \S+ import |return\b|if .*:\s*$|for .*:\s*$|while .*:\s*$|"
+    r"function\b|const |let |var |#include|public |private |SELECT |INSERT |UPDATE |<\w+[^>]*>|\}|//|/\*)"
+    r"|[;{]\s*$|=>"
+)
+CODE_WORDS = re.compile(
+    r"\b(python|javascript|typescript|java|c\+\+|rust|golang|sql|regex|function|method|compile[rd]?|"
+    r"bug|debug|stack ?trace|exception|refactor|api|algorithm|code|script|program(ming)?|implement|variable|array|"
+    r"linked list|hash ?map|data structure|unit tests?|loop|recursion)\b",
+    re.IGNORECASE
+)
+# Whole prompt is an arithmetic expression, optionally wrapped in "what is ... ?"
+ARITHMETIC_ONLY = re.compile(
+    r"^\s*(what is|what's|calculate|compute|evaluate|simplify|solve)?\s*[-+*/^().=%\d\sx]+\??\s*$",
+    re.IGNORECASE
+)
+MATH_EXPRESSION = re.compile(r"\d+(\.\d+)?\s*[-+*/^=×÷]\s*\(?\s*\d+|\\(frac|int|sum|sqrt)|\$[^$]+\$|\b[a-z]\^\d|\b\d*[a-z]\s*[+\-]\s*\d+\s*=")
+MATH_WORDS = re.compile(
+    r"\b(solve|equation|integral|integrate|derivative|differentiate|calculate|compute|prove|theorem|"
+    r"matrix|matrices|probability|polynomial|factori[sz]e|sum of|product of|percent(age)?|"
+    r"square root|logarithm|algebra|geometry|triangle|vector)\b",
+    re.IGNORECASE
+)
+LITERATURE_WORDS = re.compile(
+    r"\b(poem|poetry|novel|author|character|protagonist|narrator|passage|stanza|sonnet|metaphor|"
+    r"symbolism|theme|literary|fiction|shakespeare|chapter|plot|summari[sz]e (the|this) (story|text|passage))\b",
+    re.IGNORECASE
+)
+# Signs that a prompt asks several things at once, which is what the LLM parser is for
+MULTI_PART = re.compile(r"(\?[^?]+\?)|(^\s*(\d+[.)]|[-*])\s+)|\b(also|additionally|as well as|and then)\b",
+                        re.IGNORECASE | re.MULTILINE)
+
+@dataclass(slots=True)
+class Classification:
+    """Result of the local classifier for one prompt."""
+    category: str
+    confidence: float
+    scores: Dict[str, float]
+
+    def as_categories(self, prompt: str) -> Dict[str, str]:
+        """The category map parse_prompt returns, with the whole prompt under `category`."""
+        return {name: prompt if name == self.category else "Not Applicable" for name in CATEGORIES}
+
+def _scores(prompt: str) -> Dict[str, float]:
+    lines = [line for line in prompt.splitlines() if line.strip()]
+    code_lines = sum(1 for line in lines if CODE_LINE.search(line))
+
+    coding = 3.0 * min(len(CODE_FENCE.findall(prompt)) // 2, 2)
+    coding += min(code_lines, 8) * 0.5
+    coding += min(len(CODE_WORDS.findall(prompt)), 4) * 0.75
+
+    mathematics = 4.0 if ARITHMETIC_ONLY.match(prompt) and any(c.isdigit() for c in prompt) else 0.0
+    mathematics += min(len(MATH_EXPRESSION.findall(prompt)), 3) * 1.0
+    mathematics += min(len(MATH_WORDS.findall(prompt)), 4) * 0.75
+
+    literature = min(len(LITERATURE_WORDS.findall(prompt)), 4) * 0.75
+
+    return {
+        "general_knowledge": 0.0,
+        "mathematics": mathematics,
+        "coding": coding,
+        "literature": literature,
+    }
+
+def classify_prompt(prompt: str) -> Classification:
+    """
+    Guess the single category of a prompt from keyword, code and math features.
+
+    Arguments:
+        prompt: The user prompt
+
+    Returns:
+        The best category, a confidence between 0 and 1, and the raw score per category
+    """
+    scores = _scores(prompt)
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (category, top), (_, second) = ranked[0], ranked[1]
+
+    if top == 0:
+        # Nothing technical or literary; most likely general knowledge, but the
+        # parser may still find structure we can't see
+        category = "general_knowledge"
+        confidence = 0.5
+    else:
+        confidence = top / (top + second + 0.5)
+
+    if MULTI_PART.search(prompt):
+        confidence *= 0.7
+
+    return Classification(category, round(confidence, 3), scores)
+
+class PromptClassifier:
+    """Counts how often the local classifier lets parse_prompt skip the LLM call."""
+
+    def __init__(self, enabled: bool = CLASSIFIER_ENABLED, threshold: float = CLASSIFIER_THRESHOLD):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.classified = 0
+        self.bypassed = 0
+        self.total_confidence = 0.0
+        self.bypassed_by_category: Dict[str, int] = {}
+
+    def classify(self, prompt: str) -> Classification:
+        """Classify a prompt and record the outcome."""
+        result = classify_prompt(prompt)
+        self.classified += 1
+        self.total_confidence += result.confidence
+        if self.should_bypass(result):
+            self.bypassed += 1
+            self.bypassed_by_category[result.category] = self.bypassed_by_category.get(result.category, 0) + 1
+        return result
+
+    def should_bypass(self, result: Classification) -> bool:
+        return self.enabled and result.confidence >= self.threshold
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "classified": self.classified,
+            "bypassed": self.bypassed,
+            "bypass_rate": self.bypassed / self.classified if self.classified else 0.0,
+            "avg_confidence": self.total_confidence / self.classified if self.classified else 0.0,
+            "bypassed_by_category": dict(self.bypassed_by_category),
+        }
+
+# Shared classifier used by parse_prompt
+prompt_classifier = PromptClassifier()
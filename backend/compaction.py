@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import random
+import re
+import zlib
+from typing import Dict, List, Optional, Set, Tuple
+from config import (COMBINE_INPUT_BUDGET_TOKENS, COMBINE_DEDUPE_THRESHOLD, COMBINE_SUMMARY_MODEL,
+                    COMBINE_SUMMARY_MIN_CATEGORIES, COMBINE_SUMMARY_TIMEOUT)
+from message_batches import deferred_timeout
+from metrics import track_stage
+from providers import anthropic_message
+from tokens import CHARS_PER_TOKEN, estimate_tokens
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Passages are compared as sets of overlapping word 5-grams
+SHINGLE_WORDS = 5
+# Shorter passages (headings, one-liners) are never treated as repeats
+MIN_DEDUPE_WORDS = 12
+
+# MinHash signature length, and the bands of it that are bucketed to find candidate pairs:
+# 16 bands of 4 rows make passages that are 80% alike candidates with >99.9% probability
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+_PRIME = (1 << 61) - 1
+# Fixed seed: the same responses must compact to the same text in every process, or the
+# combine call would miss the response cache
+_seeded = random.Random(0xC0FFEE)
+_HASHES = [(_seeded.randrange(1, _PRIME), _seeded.randrange(0, _PRIME)) for _ in range(MINHASH_PERMUTATIONS)]
+
+SUMMARY_SYSTEM_PROMPT = """You are condensing one expert's answer so it can be merged with answers from other experts.
+
+    Keep every fact, step, number, caveat and code block a reader would need, and drop repetition,
+    preamble and filler. Keep the answer's structure and voice. Reply with the condensed answer only."""
+
+def split_passages(text: str) -> List[str]:
+    """Split a response into paragraphs, keeping fenced code blocks whole."""
+    passages, current, fenced = [], [], False
+    for line in text.split("\n"):
+        if line.lstrip().startswith("```"):
+            fenced = not fenced
+        if not line.strip() and not fenced:
+            if current:
+                passages.append("\n".join(current))
+                current = []
+            continue
+        current.append(line)
+    if current:
+        passages.append("\n".join(current))
+    return passages
+
+def _shingles(words: List[str]) -> Set[int]:
+    return {zlib.crc32(" ".join(words[index:index + SHINGLE_WORDS]).encode("utf-8"))
+            for index in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+
+def _signature(shingles: Set[int]) -> Tuple[int, ...]:
+    return tuple(min((a * shingle + b) % _PRIME for shingle in shingles) for a, b in _HASHES)
+
+def _similarity(first: Tuple[int, ...], second: Tuple[int, ...]) -> float:
+    """MinHash estimate of the Jaccard similarity of two passages' shingles."""
+    return sum(a == b for a, b in zip(first, second)) / MINHASH_PERMUTATIONS
+
+def dedupe_passages(sections: Dict[str, List[str]],
+                    threshold: float = COMBINE_DEDUPE_THRESHOLD) -> Tuple[Dict[str, List[str]], int]:
+    """
+    Drop passages that repeat an earlier one, in this section or an earlier section.
+
+    Arguments:
+        sections: Passages of each response, in the order the responses are combined
+        threshold: Estimated shingle similarity from which a passage counts as a repeat
+
+    Returns:
+        Tuple of (the sections without repeated passages, number of passages dropped)
+    """
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    signatures: List[Tuple[int, ...]] = []
+    buckets: Dict[Tuple[int, Tuple[int, ...]], List[int]] = {}
+    deduped: Dict[str, List[str]] = {}
+    dropped = 0
+    for category, passages in sections.items():
+        kept = deduped[category] = []
+        for passage in passages:
+            words = re.findall(r"\w+", passage.lower())
+            if len(words) < MIN_DEDUPE_WORDS:
+                kept.append(passage)
+                continue
+            signature = _signature(_shingles(words))
+            bands = [(band, signature[band * rows:(band + 1) * rows]) for band in range(LSH_BANDS)]
+            candidates = {index for band in bands for index in buckets.get(band, ())}
+            if any(_similarity(signature, signatures[index]) >= threshold for index in candidates):
+                dropped += 1
+                continue
+            for band in bands:
+                buckets.setdefault(band, []).append(len(signatures))
+            signatures.append(signature)
+            kept.append(passage)
+    return deduped, dropped
+
+def allocate_budget(sizes: Dict[str, int], budget: int) -> Dict[str, int]:
+    """
+    Split a token budget between sections, max-min fair: sections smaller than an equal share
+    keep their size, and what they leave over is shared by the larger ones.
+    """
+    allocation: Dict[str, int] = {}
+    remaining = dict(sizes)
+    left = budget
+    while remaining:
+        share = left // len(remaining)
+        small = {category: size for category, size in remaining.items() if size <= share}
+        if not small:
+            allocation.update((category, share) for category in remaining)
+            break
+        for category, size in small.items():
+            allocation[category] = size
+            left -= size
+            del remaining[category]
+    return allocation
+
+def trim_passages(passages: List[str], tokens: int) -> str:
+    """Keep the leading passages that fit in `tokens`, and note how many were left out."""
+    kept, used = [], 0
+    for passage in passages:
+        cost = estimate_tokens(passage)
+        if used + cost > tokens:
+            break
+        kept.append(passage)
+        used += cost
+    if not kept and passages:
+        # Not even the first passage fits; cut it at a word boundary
+        limit = max(1, tokens) * CHARS_PER_TOKEN
+        cut = passages[0].rfind(" ", 0, limit)
+        kept.append(passages[0][:cut if cut > 0 else limit] + " ...")
+    left_out = len(passages) - len(kept)
+    if left_out:
+        kept.append(f"[{left_out} more paragraphs left out for length]")
+    return "\n\n".join(kept)
+
+async def summarize_section(category: str, text: str, tokens: int, model: str = COMBINE_SUMMARY_MODEL) -> Optional[str]:
+    """
+    Condense one response to about `tokens` tokens with a cheaper model.
+
+    Returns:
+        The condensed response, or None if the call failed or the reply is still too long
+    """
+    words = max(50, tokens * 3 // 4)
+    prompt = f"Condense this answer about {category.replace('_', ' ')} to at most {words} words:\n\n<answer>\n{text}\n</answer>"
+    try:
+        summary = await anthropic_message(model, SUMMARY_SYSTEM_PROMPT, prompt, max_tokens=tokens + tokens // 4)
+    except Exception as e:
+        logger.warning(f"Could not condense the {category} response: {str(e)}")
+        return None
+    if not summary.strip() or estimate_tokens(summary) > tokens * 3 // 2:
+        return None
+    return summary.strip()
+
+async def compact_responses(responses: Dict[str, str], budget: int = COMBINE_INPUT_BUDGET_TOKENS,
+                            summary_min_categories: int = COMBINE_SUMMARY_MIN_CATEGORIES,
+                            summary_timeout: float = COMBINE_SUMMARY_TIMEOUT) -> Dict[str, str]:
+    """
+    Fit the responses to be combined into a token budget.
+
+    Responses within the budget are returned unchanged. Otherwise passages repeated across
+    responses are dropped, and if that isn't enough the budget is split fairly between the
+    responses and each one over its share is condensed with a cheaper model. With fewer than
+    `summary_min_categories` responses, or when condensing fails, an oversized response is
+    trimmed locally at a paragraph boundary instead.
+
+    Arguments:
+        responses: Valid responses by category, in the order they are combined
+        budget: Estimated tokens the responses may take together (0 = no limit)
+        summary_min_categories: Fewest responses for which condensing calls are made
+        summary_timeout: Seconds the condensing calls may take together
+
+    Returns:
+        The responses by category, compacted
+    """
+    total = sum(estimate_tokens(text) for text in responses.values())
+    if budget <= 0 or total <= budget:
+        return responses
+
+    with track_stage("compact"):
+        # Hashing every passage takes a few hundred milliseconds on long responses; keep it off the event loop
+        sections, dropped = await asyncio.to_thread(
+            dedupe_passages, {category: split_passages(text) for category, text in responses.items()})
+        compacted = {category: "\n\n".join(passages) or "[Covered by the responses above]"
+                     for category, passages in sections.items()}
+        sizes = {category: estimate_tokens(text) for category, text in compacted.items()}
+        oversized: List[str] = []
+        if sum(sizes.values()) > budget:
+            allocation = allocate_budget(sizes, budget)
+            oversized = [category for category in compacted if sizes[category] > allocation[category]]
+            summaries: List[Optional[str]] = [None] * len(oversized)
+            if len(responses) >= summary_min_categories and COMBINE_SUMMARY_MODEL:
+                try:
+                    summaries = await asyncio.wait_for(
+                        asyncio.gather(*(summarize_section(category, compacted[category], allocation[category])
+                                         for category in oversized)),
+                        timeout=deferred_timeout(summary_timeout))
+                except asyncio.TimeoutError:
+                    logger.warning(f"Condensing responses took over {summary_timeout}s, trimming them instead")
+            for category, summary in zip(oversized, summaries):
+                compacted[category] = summary or trim_passages(sections[category], allocation[category])
+
+    logger.info(f"Compacted the responses to combine from ~{total} to ~"
+                f"{sum(estimate_tokens(text) for text in compacted.values())} tokens "
+                f"({dropped} repeated passages dropped, {len(oversized)} responses shortened)")
+    return compacted
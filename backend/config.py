@@ -42,13 +42,143 @@ for key, value in API_KEYS.items():
         logger.warning(f"{key.upper()} API key is missing")
 
 # Directories for logging
-PARSED_PROMPTS_DIR = os.getenv("PARSED_PROMPTS_DIR", "../logs/parsed_prompts")
+PARSED_PROMPTS_DIR = os.getenv("PARSED_PROMPTS_DIR", "../logs/parsed_prompts")        # Per-session files from older versions, still readable
 GENERATED_PROMPTS_DIR = os.getenv("GENERATED_PROMPTS_DIR", "../logs/generated_prompts")
-
-# Create directories if they don't exist
-os.makedirs(PARSED_PROMPTS_DIR, exist_ok=True)
-os.makedirs(GENERATED_PROMPTS_DIR, exist_ok=True)
+PROMPT_LOG_DIR = os.getenv("PROMPT_LOG_DIR", "../logs/prompt_logs")                     # Compressed JSONL segments and their index
+PROMPT_LOG_SEGMENT_BYTES = int(os.getenv("PROMPT_LOG_SEGMENT_BYTES", str(64 * 1024 * 1024)))  # Rotate past this compressed size
+PROMPT_LOG_SEGMENT_SECONDS = float(os.getenv("PROMPT_LOG_SEGMENT_SECONDS", "3600"))   # Rotate after this long
+PROMPT_LOG_MAX_SEGMENTS = int(os.getenv("PROMPT_LOG_MAX_SEGMENTS", "168"))            # Oldest segments are deleted past this (0 keeps all)
+PROMPT_LOG_BATCH_SIZE = int(os.getenv("PROMPT_LOG_BATCH_SIZE", "256"))                # Records per write
+PROMPT_LOG_FLUSH_INTERVAL = float(os.getenv("PROMPT_LOG_FLUSH_INTERVAL", "1"))        # Seconds a partial batch may wait
+PROMPT_LOG_QUEUE_SIZE = int(os.getenv("PROMPT_LOG_QUEUE_SIZE", "10000"))              # Records are dropped when the writer falls this far behind
 
 # API rate limiting settings
-RATE_LIMIT_REQUESTS = int(os.getenv("RATE_LIMIT_REQUESTS", "15"))  # Maximum requests per minute
-RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "100"))     # Window in seconds
\ No newline at end of file
+RATE_LIMIT_REQUESTS = int(os.getenv("RATE_LIMIT_REQUESTS", "15"))  # Maximum requests per window per provider (0 disables)
+RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "100"))     # Window in seconds
+RATE_LIMIT_TOKENS = int(os.getenv("RATE_LIMIT_TOKENS", "0"))       # Maximum input+output tokens per window (0 = no token limit)
+RATE_LIMITS = os.getenv("RATE_LIMITS", "")                          # JSON overrides per provider or provider:model
+
+# Routing deadlines (seconds) for the concurrent fan-out to the specialist LLMs
+ROUTE_CATEGORY_TIMEOUT = float(os.getenv("ROUTE_CATEGORY_TIMEOUT", "45"))  # Per-category deadline
+ROUTE_TOTAL_TIMEOUT = float(os.getenv("ROUTE_TOTAL_TIMEOUT", "60"))        # Deadline for the whole fan-out
+
+# Shared HTTP client pool used for every provider call
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))                  # Total open connections
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))  # Connections per provider host
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))    # Seconds to keep idle connections
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))            # Seconds to cache DNS lookups
+HTTP_REQUEST_TIMEOUT = float(os.getenv("HTTP_REQUEST_TIMEOUT", "30"))       # Total timeout per provider request
+
+# Structured prompt generation (Step 2)
+GENERATE_CONCURRENCY = int(os.getenv("GENERATE_CONCURRENCY", "4"))                      # Generation calls in flight
+GENERATE_TIMEOUT = float(os.getenv("GENERATE_TIMEOUT", "25"))                          # Seconds before falling back to raw content
+GENERATE_BATCHED = os.getenv("GENERATE_BATCHED", "false").lower() in ("1", "true", "yes")  # One call for all categories
+
+# Server-sent events for session updates
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "1000"))                   # Buffered events per subscriber
+EVENT_KEEPALIVE_INTERVAL = float(os.getenv("EVENT_KEEPALIVE_INTERVAL", "15"))   # Seconds between keep-alive comments
+
+# Stream LLM replies token by token to /api/events subscribers
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() in ("1", "true", "yes")
+
+# Provider endpoints (override to point at a proxy or a local stand-in)
+ANTHROPIC_API_URL = os.getenv("ANTHROPIC_API_URL", "https://api.anthropic.com/v1/messages")
+GEMINI_API_URL = os.getenv("GEMINI_API_URL", "https://generativelanguage.googleapis.com/v1")
+
+# Response cache for provider calls ("memory", "sqlite" or "none")
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_TTL = float(os.getenv("CACHE_TTL", "3600"))                    # Seconds before an entry expires
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1000"))      # Least recently used entries are evicted past this
+CACHE_PATH = os.getenv("CACHE_PATH", "../logs/response_cache.sqlite3")  # Used by the sqlite backend
+
+# Session storage ("memory", or "sqlite" to share sessions across workers and restarts)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))                       # Seconds after the last update
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "10000"))        # Oldest sessions are evicted past this
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(256 * 1024 * 1024)))  # Approximate text held by all sessions
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "../logs/sessions.sqlite3")  # Used by the sqlite backend
+
+# Retries for transient provider failures (429, 5xx, overload, dropped connections)
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))                # Attempts per call, including the first
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1"))                  # Backoff base in seconds, doubled per retry with full jitter
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "20"))                   # Cap on a single backoff
+RETRY_BUDGET = float(os.getenv("RETRY_BUDGET", "40"))                         # No new attempt starts this many seconds after the first
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))  # Consecutive failures before a provider's circuit opens
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))       # Seconds before a trial call is let through
+
+# Local pre-classifier that lets obviously single-category prompts skip the LLM parse
+CLASSIFIER_ENABLED = os.getenv("CLASSIFIER_ENABLED", "true").lower() in ("1", "true", "yes")
+CLASSIFIER_THRESHOLD = float(os.getenv("CLASSIFIER_THRESHOLD", "0.8"))  # Minimum confidence to skip the LLM
+
+# Per-session planning: skip stages that can't improve the answer
+PLANNER_FAST_PATH = os.getenv("PLANNER_FAST_PATH", "true").lower() in ("1", "true", "yes")  # Single category: no combine step
+PLANNER_REWRITE_MIN_TOKENS = int(os.getenv("PLANNER_REWRITE_MIN_TOKENS", "24"))  # Shorter category prompts are routed as-is
+
+# Category -> model routing (see routing_table.py for the built-in table and file format)
+ROUTING_TABLE_PATH = os.getenv("ROUTING_TABLE_PATH", "")                          # Optional JSON overrides, reloaded when the file changes
+ROUTING_RELOAD_INTERVAL = float(os.getenv("ROUTING_RELOAD_INTERVAL", "5"))        # Seconds between checks for changes
+ROUTING_EWMA_ALPHA = float(os.getenv("ROUTING_EWMA_ALPHA", "0.2"))                # Weight of the newest call in latency/error averages
+ROUTING_PRICE_WEIGHT = float(os.getenv("ROUTING_PRICE_WEIGHT", "0.05"))          # Seconds of latency one $/Mtok of price is worth
+ROUTING_MAX_ERROR_RATE = float(os.getenv("ROUTING_MAX_ERROR_RATE", "0.5"))        # Models above this error rate are skipped
+ROUTING_RECOVERY_TIME = float(os.getenv("ROUTING_RECOVERY_TIME", "30"))           # Seconds before a skipped model is probed again
+ROUTING_MAX_FALLBACKS = int(os.getenv("ROUTING_MAX_FALLBACKS", "1"))              # Other models tried after a failed call
+
+# Hedged specialist calls: duplicate a call that runs past a latency percentile (opt-in)
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))    # Hedge once a call is slower than this share of recent calls
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1"))       # Never hedge sooner than this (seconds)
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))    # Latency samples needed before a model is hedged
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.05"))          # Maximum fraction of recent calls that may be hedged
+HEDGE_TARGET = os.getenv("HEDGE_TARGET", "alternate")            # "alternate" (next model in the route) or "same"
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "500"))             # Recent calls kept for percentiles and the budget
+
+# Map-reduce for very long inputs: chunk, process chunks concurrently, reduce the notes
+MAP_REDUCE_THRESHOLD_TOKENS = int(os.getenv("MAP_REDUCE_THRESHOLD_TOKENS", "6000"))  # Category content above this is chunked
+MAP_REDUCE_CHUNK_TOKENS = int(os.getenv("MAP_REDUCE_CHUNK_TOKENS", "3000"))          # Target size of one chunk
+MAP_REDUCE_OVERLAP_TOKENS = int(os.getenv("MAP_REDUCE_OVERLAP_TOKENS", "150"))       # Repeated between neighbouring chunks
+MAP_REDUCE_CONCURRENCY = int(os.getenv("MAP_REDUCE_CONCURRENCY", "4"))               # Chunk calls in flight per category
+MAP_REDUCE_REDUCE_TOKENS = int(os.getenv("MAP_REDUCE_REDUCE_TOKENS", "6000"))        # Notes merged by one reduce call
+MAP_REDUCE_MAX_CHUNKS = int(os.getenv("MAP_REDUCE_MAX_CHUNKS", "64"))                # Text past this many chunks is left out
+MAP_REDUCE_TIMEOUT = float(os.getenv("MAP_REDUCE_TIMEOUT", "300"))                   # Pipeline deadline when a category is chunked
+PARSE_EXCERPT_TOKENS = int(os.getenv("PARSE_EXCERPT_TOKENS", "600"))                 # Long prompts are parsed from their start and end
+
+# Share one upstream call between identical provider calls that are in flight at once
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Job queue for prompt processing ("memory", or "sqlite" to survive restarts and share work between processes)
+JOB_BACKEND = os.getenv("JOB_BACKEND", "memory")
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "../logs/jobs.sqlite3")                 # Used by the sqlite backend
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "16"))                               # Interactive jobs the API process runs at once (0 = leave them to worker.py)
+JOB_BATCH_WORKERS = int(os.getenv("JOB_BATCH_WORKERS", "2"))                    # Batch-priority jobs (bulk uploads) it runs at once, on workers of their own
+JOB_VISIBILITY_TIMEOUT = float(os.getenv("JOB_VISIBILITY_TIMEOUT", "60"))       # A job whose worker stops heartbeating is redelivered after this
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))                      # Deliveries before a job is given up on
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))                # Seconds between checks for jobs enqueued by other processes
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "86400"))                      # Seconds finished jobs are kept for status reads
+
+# Bulk prompt submission (/api/prompts/batch) and the Anthropic Message Batches API it can use
+PROMPT_BATCH_DB_PATH = os.getenv("PROMPT_BATCH_DB_PATH", "../logs/prompt_batches.sqlite3")  # Uploads and results, kept for resuming
+PROMPT_BATCH_CONCURRENCY = int(os.getenv("PROMPT_BATCH_CONCURRENCY", "64"))                 # Prompts of one upload processed at once
+MESSAGE_BATCHES_ENABLED = os.getenv("MESSAGE_BATCHES_ENABLED", "true").lower() in ("1", "true", "yes")  # Send bulk Claude calls as Message Batches
+ANTHROPIC_BATCHES_URL = os.getenv("ANTHROPIC_BATCHES_URL", f"{ANTHROPIC_API_URL}/batches")
+MESSAGE_BATCH_WINDOW = float(os.getenv("MESSAGE_BATCH_WINDOW", "5"))                         # Seconds calls are collected before a batch is sent
+MESSAGE_BATCH_MAX_REQUESTS = int(os.getenv("MESSAGE_BATCH_MAX_REQUESTS", "10000"))           # Calls per batch at most
+MESSAGE_BATCH_POLL_INTERVAL = float(os.getenv("MESSAGE_BATCH_POLL_INTERVAL", "30"))          # Seconds between batch status checks
+MESSAGE_BATCH_TIMEOUT = float(os.getenv("MESSAGE_BATCH_TIMEOUT", "86400"))                   # Deadline for deferred calls (batches expire after 24h)
+
+# Anthropic prompt caching of the static system prompts (only prefixes of 1024+ tokens are cached, 2048+ for Haiku)
+PROMPT_CACHING_ENABLED = os.getenv("PROMPT_CACHING_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Admission control in front of the job queue: excess prompts are turned away with a Retry-After (0 = no limit)
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "1000"))           # Queued jobs at most; past this new prompts get a 503
+ADMISSION_BATCH_SHARE = float(os.getenv("ADMISSION_BATCH_SHARE", "0.5"))       # Share of ADMISSION_MAX_QUEUE batch-priority work may fill
+ADMISSION_MAX_PER_CLIENT = int(os.getenv("ADMISSION_MAX_PER_CLIENT", "50"))    # Queued plus running jobs per client; past this a 429
+ADMISSION_RETRY_AFTER = float(os.getenv("ADMISSION_RETRY_AFTER", "5"))         # Retry-After while no throughput has been measured yet
+ADMISSION_CLIENT_HEADER = os.getenv("ADMISSION_CLIENT_HEADER", "X-Client-ID")  # Header naming the client, trusted only from the proxies below
+ADMISSION_TRUSTED_PROXIES = os.getenv("ADMISSION_TRUSTED_PROXIES", "")         # Comma-separated addresses or networks; others are known by their address
+
+# Combiner input compaction: keep the responses sent to the combining call within a token budget
+COMBINE_INPUT_BUDGET_TOKENS = int(os.getenv("COMBINE_INPUT_BUDGET_TOKENS", "6000"))       # Estimated input tokens for the responses (0 = no limit)
+COMBINE_DEDUPE_THRESHOLD = float(os.getenv("COMBINE_DEDUPE_THRESHOLD", "0.8"))            # Similarity from which a passage repeats an earlier one
+COMBINE_SUMMARY_MODEL = os.getenv("COMBINE_SUMMARY_MODEL", "claude-3-5-haiku-20241022")   # Condenses oversized responses ("" = trim locally)
+COMBINE_SUMMARY_MIN_CATEGORIES = int(os.getenv("COMBINE_SUMMARY_MIN_CATEGORIES", "3"))    # Fewer responses are only trimmed locally
+COMBINE_SUMMARY_TIMEOUT = float(os.getenv("COMBINE_SUMMARY_TIMEOUT", "15"))               # Condensing calls past this fall back to trimming
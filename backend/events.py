@@ -0,0 +1,66 @@
+import asyncio
+import json
+import logging
+from typing import Any, Dict, List, Optional
+from config import EVENT_QUEUE_SIZE
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Put on a subscriber's queue when it fell too far behind; the reader should resend a full snapshot
+RESYNC = object()
+
+class EventBus:
+    """
+    In-process publish/subscribe hub for session events.
+
+    Each subscriber gets its own bounded queue. A subscriber that can't keep up has its
+    backlog dropped and receives RESYNC instead, so a slow client never holds up the
+    pipeline and can recover by reading the full session state again.
+    """
+
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+
+    def subscribe(self, session_id: str) -> asyncio.Queue:
+        """Start receiving (event, data) tuples for a session."""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(session_id, []).append(queue)
+        return queue
+
+    def unsubscribe(self, session_id: str, queue: asyncio.Queue):
+        """Stop receiving events for a session."""
+        queues = self._subscribers.get(session_id)
+        if not queues:
+            return
+        if queue in queues:
+            queues.remove(queue)
+        if not queues:
+            del self._subscribers[session_id]
+
+    def publish(self, session_id: str, event: str, data: Any):
+        """Send an event to everyone subscribed to the session."""
+        for queue in self._subscribers.get(session_id, ()):
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                logger.warning(f"Event subscriber for session {session_id} fell behind, resyncing")
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(RESYNC)
+
+    def subscriber_count(self, session_id: Optional[str] = None) -> int:
+        """Number of open subscriptions, for one session or overall."""
+        if session_id is not None:
+            return len(self._subscribers.get(session_id, ()))
+        return sum(len(queues) for queues in self._subscribers.values())
+
+def format_sse(event: str, data: Any) -> str:
+    """Format an event in the text/event-stream wire format."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Shared bus used by the API and the pipeline
+event_bus = EventBus()
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+from config import (HEDGE_ENABLED, HEDGE_PERCENTILE, HEDGE_MIN_DELAY, HEDGE_MIN_SAMPLES,
+                    HEDGE_BUDGET, HEDGE_TARGET, HEDGE_WINDOW)
+from metrics import count_hedge
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Starts one attempt; receives the delta callback to use (None when not streaming)
+AttemptFactory = Callable[[Optional[Callable[[str], None]]], Awaitable[str]]
+
+class Hedger:
+    """
+    Decides when a slow specialist call gets a duplicate, and keeps score.
+
+    A call is hedged once it has run longer than the HEDGE_PERCENTILE latency of that
+    model's recent successful calls, as long as hedges stay under HEDGE_BUDGET of
+    recent calls.
+    """
+
+    def __init__(self, enabled: bool = HEDGE_ENABLED, percentile: float = HEDGE_PERCENTILE,
+                 min_delay: float = HEDGE_MIN_DELAY, min_samples: int = HEDGE_MIN_SAMPLES,
+                 budget: float = HEDGE_BUDGET, target: str = HEDGE_TARGET, window: int = HEDGE_WINDOW):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.budget = budget
+        self.target = target
+        self.window = window
+        self._latencies: Dict[str, Deque[float]] = {}
+        # Whether each of the last `window` calls was hedged
+        self._recent: Deque[bool] = deque(maxlen=window)
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.denied = 0
+
+    def observe(self, model: str, latency: float):
+        """Record the latency of a successful call to `model`."""
+        samples = self._latencies.get(model)
+        if samples is None:
+            samples = self._latencies[model] = deque(maxlen=self.window)
+        samples.append(latency)
+
+    def delay(self, model: str) -> Optional[float]:
+        """Seconds to wait before hedging a call to `model`, or None if it shouldn't be hedged."""
+        if not self.enabled:
+            return None
+        samples = self._latencies.get(model)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+    def _allow(self) -> bool:
+        # Counting this call, hedges must stay within the budget share of recent calls
+        if sum(self._recent) + 1 > self.budget * (len(self._recent) + 1):
+            self.denied += 1
+            count_hedge("denied")
+            return False
+        return True
+
+    async def race(self, primary: AttemptFactory, hedge: AttemptFactory, delay: Optional[float],
+                   on_delta: Optional[Callable[[str], None]] = None) -> Tuple[str, bool]:
+        """
+        Run `primary`, and `hedge` as well if primary is still running after `delay` seconds.
+
+        The first attempt to produce output wins: its first streamed delta when
+        streaming, otherwise its result. The loser is cancelled. An attempt that fails
+        before winning leaves the other one running.
+
+        Returns:
+            Tuple of (reply text, whether the hedge won); raises the error of the last
+            attempt to fail if neither succeeds
+        """
+        winner: Optional[str] = None
+        tasks: Dict[str, asyncio.Task] = {}
+
+        def claim(name: str):
+            nonlocal winner
+            winner = name
+            for other, task in tasks.items():
+                if other != name and not task.done():
+                    task.cancel()
+
+        def forward(name: str) -> Optional[Callable[[str], None]]:
+            if on_delta is None:
+                return None
+            def deliver(text: str):
+                if winner is None:
+                    claim(name)
+                if winner == name:
+                    on_delta(text)
+            return deliver
+
+        tasks["primary"] = asyncio.create_task(primary(forward("primary")), name="hedge-primary")
+        hedged = False
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks.values(), timeout=delay)
+                if not done and winner is None and self._allow():
+                    hedged = True
+                    self.hedged += 1
+                    logger.info(f"Call still running after {delay:.2f}s, sending a hedge")
+                    tasks["hedge"] = asyncio.create_task(hedge(forward("hedge")), name="hedge-secondary")
+            self._recent.append(hedged)
+
+            error: Optional[BaseException] = None
+            pending = set(tasks.values())
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = "primary" if task is tasks["primary"] else "hedge"
+                    if task.cancelled():
+                        continue
+                    if task.exception() is not None:
+                        error = task.exception()
+                        if winner == name:
+                            raise error
+                        continue
+                    if winner in (None, name):
+                        claim(name)
+                        if hedged:
+                            hedge_won = name == "hedge"
+                            if hedge_won:
+                                self.hedge_wins += 1
+                            else:
+                                self.primary_wins += 1
+                            count_hedge("won" if hedge_won else "lost")
+                        return task.result(), name == "hedge"
+            if error is None:
+                raise RuntimeError("Hedged call finished without a result")
+            raise error
+        finally:
+            for task in tasks.values():
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": self.enabled,
+            "percentile": self.percentile,
+            "budget": self.budget,
+            "target": self.target,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "primary_wins": self.primary_wins,
+            "win_rate": self.hedge_wins / self.hedged if self.hedged else 0.0,
+            "denied": self.denied,
+            "recent_hedge_rate": sum(self._recent) / len(self._recent) if self._recent else 0.0,
+            "delays": {model: self.delay(model) for model in self._latencies},
+        }
+
+# Shared hedger used by the router
+hedger = Hedger()
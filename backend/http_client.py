@@ -0,0 +1,117 @@
+import aiohttp
+import logging
+from typing import Dict, Optional
+from config import (HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST, HTTP_KEEPALIVE_TIMEOUT,
+                    HTTP_DNS_CACHE_TTL, HTTP_REQUEST_TIMEOUT)
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Shared client session used by every provider call
+_session: Optional[aiohttp.ClientSession] = None
+_connector: Optional[aiohttp.TCPConnector] = None
+
+# Simple counters so we can size the pool
+_stats = {
+    "sessions_created": 0,
+    "requests": 0,
+    "connections_created": 0,
+    "connections_reused": 0,
+}
+
+async def start_http_client() -> aiohttp.ClientSession:
+    """
+    Create the shared pooled client session if it isn't running yet.
+
+    Called from the FastAPI lifespan hook; provider calls made outside the app
+    (scripts, the REPL) start it lazily through get_session().
+
+    Returns:
+        The shared aiohttp.ClientSession
+    """
+    global _session, _connector
+
+    if _session is not None and not _session.closed:
+        return _session
+
+    _connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        use_dns_cache=True
+    )
+    _session = aiohttp.ClientSession(
+        connector=_connector,
+        timeout=aiohttp.ClientTimeout(total=HTTP_REQUEST_TIMEOUT),
+        trace_configs=[_trace_config()]
+    )
+    _stats["sessions_created"] += 1
+    logger.info(f"Started HTTP client pool (limit={HTTP_POOL_LIMIT}, per_host={HTTP_POOL_LIMIT_PER_HOST})")
+    return _session
+
+async def stop_http_client():
+    """Close the shared client session and release all pooled connections."""
+    global _session, _connector
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("Stopped HTTP client pool")
+    _session = None
+    _connector = None
+
+async def get_session() -> aiohttp.ClientSession:
+    """Return the shared client session, starting it if necessary."""
+    if _session is None or _session.closed:
+        return await start_http_client()
+    return _session
+
+def pool_stats() -> Dict[str, object]:
+    """
+    Report the current state of the connection pool.
+
+    Returns:
+        Dictionary with configured limits, connection counts per host and request counters
+    """
+    stats = {
+        "running": _session is not None and not _session.closed,
+        "limit": HTTP_POOL_LIMIT,
+        "limit_per_host": HTTP_POOL_LIMIT_PER_HOST,
+        **_stats,
+    }
+
+    if _connector is not None and not _connector.closed:
+        # aiohttp doesn't expose these publicly, so read them defensively
+        acquired = getattr(_connector, "_acquired_per_host", {})
+        idle = getattr(_connector, "_conns", {})
+        stats["in_use"] = sum(len(conns) for conns in acquired.values())
+        stats["idle"] = sum(len(conns) for conns in idle.values())
+        stats["hosts"] = {
+            key.host: {
+                "in_use": len(acquired.get(key, ())),
+                "idle": len(idle.get(key, ())),
+            }
+            for key in set(acquired) | set(idle)
+        }
+
+    return stats
+
+def _trace_config() -> aiohttp.TraceConfig:
+    """Count requests and new connections so pool reuse is visible in pool_stats()."""
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params):
+        _stats["requests"] += 1
+
+    async def on_connection_create_end(session, context, params):
+        _stats["connections_created"] += 1
+
+    async def on_connection_reuseconn(session, context, params):
+        _stats["connections_reused"] += 1
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    return trace_config
@@ -0,0 +1,516 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Collection, Deque, Dict, Optional, TypeVar
+from config import (JOB_BACKEND, JOB_DB_PATH, JOB_VISIBILITY_TIMEOUT, JOB_MAX_ATTEMPTS,
+                    JOB_POLL_INTERVAL, JOB_RETENTION)
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Job states: waiting to be claimed, leased to a worker, finished, or out of attempts
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+# Priority classes; lower values are claimed first
+INTERACTIVE, BATCH = 0, 1
+
+T = TypeVar("T")
+
+@dataclass(slots=True)
+class Job:
+    """A unit of work; for prompts the job id is the session id."""
+    job_id: str
+    payload: Dict
+    status: str = QUEUED
+    attempts: int = 0
+    owner: Optional[str] = None
+    lease_until: float = 0.0
+    error: Optional[str] = None
+    priority: int = INTERACTIVE
+    # Who submitted the job; claims are shared fairly between clients
+    client: str = ""
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    def to_dict(self) -> Dict:
+        """Client-facing job state (without the payload)."""
+        return {"job_id": self.job_id, "status": self.status, "attempts": self.attempts, "priority": self.priority,
+                "error": self.error, "created_at": self.created_at, "updated_at": self.updated_at}
+
+class JobQueue:
+    """
+    Interface for job queues with at-least-once delivery.
+
+    claim() leases the next job to a worker for `visibility_timeout` seconds. A worker
+    that is still busy extends its lease with heartbeat(); if it dies instead, the lease
+    runs out and the job is handed to another worker, until it has been tried
+    `max_attempts` times. Handlers must therefore tolerate running more than once.
+
+    Jobs are claimed by priority class first; within a class, the client with the fewest
+    running jobs goes next, so one client's burst can't hold everyone else's jobs back.
+    A worker can also claim from some classes only, so each class gets its own workers.
+    """
+
+    backend = "none"
+    # Whether calls can wait on a lock held by another process (see offload)
+    blocking = False
+
+    def __init__(self, visibility_timeout: float = JOB_VISIBILITY_TIMEOUT,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, poll_interval: float = JOB_POLL_INTERVAL,
+                 retention: float = JOB_RETENTION):
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.enqueued = 0
+        self.claimed = 0
+        self.completed = 0
+        self.failed = 0
+        self.redelivered = 0
+        # Wakes local workers as soon as a job is enqueued in this process
+        self._available: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def enqueue(self, job_id: str, payload: Dict, priority: int = INTERACTIVE, client: str = "") -> Job:
+        raise NotImplementedError
+
+    def claim(self, owner: str, priorities: Optional[Collection[int]] = None) -> Optional[Job]:
+        """Lease the next job (of one of `priorities`, if given) to `owner`, or return None if there is none."""
+        raise NotImplementedError
+
+    def heartbeat(self, job_id: str, owner: str) -> bool:
+        """Extend `owner`'s lease; False if the job was lost to another worker."""
+        raise NotImplementedError
+
+    def complete(self, job_id: str, owner: str):
+        raise NotImplementedError
+
+    def fail(self, job_id: str, owner: str, error: str):
+        """Release a job after an error; it is retried unless it is out of attempts."""
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[Job]:
+        raise NotImplementedError
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs in each state."""
+        raise NotImplementedError
+
+    def position(self, job_id: str) -> Optional[int]:
+        """
+        Estimated place of a queued job in line (1 = claimed next), or None if it isn't queued.
+
+        Counts the jobs that fair sharing puts ahead of it in its own priority class (each
+        class has its own workers). A job's turn is its client's running jobs plus its place
+        among that client's queued jobs; lower turns go first, then older jobs.
+        """
+        raise NotImplementedError
+
+    def load(self, client: str) -> int:
+        """Jobs of a client that are queued or running."""
+        raise NotImplementedError
+
+    def throughput(self, window: float = 60) -> float:
+        """Jobs finished per second over the last `window` seconds."""
+        raise NotImplementedError
+
+    async def offload(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Call `fn` (a queue method, or code that uses the queue) from async code without
+        stalling the event loop: in a thread for blocking backends, whose calls can wait for
+        another process's write lock, and inline otherwise (the memory queue isn't thread-safe).
+        """
+        if self.blocking:
+            return await asyncio.to_thread(fn, *args, **kwargs)
+        return fn(*args, **kwargs)
+
+    async def wait(self):
+        """Wait until a job may be available: a local enqueue, or the next poll."""
+        if self._available is None:
+            self._available = asyncio.Event()
+            self._loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(self._available.wait(), timeout=self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._available.clear()
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "backend": self.backend,
+            **self.counts(),
+            "enqueued": self.enqueued,
+            "claimed": self.claimed,
+            "completed": self.completed,
+            "failed": self.failed,
+            "redelivered": self.redelivered,
+            "visibility_timeout": self.visibility_timeout,
+            "max_attempts": self.max_attempts,
+        }
+
+    def _notify(self):
+        # Enqueues may run in a thread (see offload)
+        if self._available is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._available.set)
+
+class MemoryJobQueue(JobQueue):
+    """In-process queue; jobs don't survive a restart and can't be shared between processes."""
+
+    backend = "memory"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._jobs: Dict[str, Job] = {}
+        # Ids of queued jobs per priority class and client
+        self._queued: Dict[int, Dict[str, Deque[str]]] = {}
+        # Leased jobs, their number per client, and finished jobs by finish time
+        self._running: Dict[str, Job] = {}
+        self._running_by_client: Dict[str, int] = {}
+        self._finished: "OrderedDict[str, None]" = OrderedDict()
+        self._finish_times: Deque[float] = deque(maxlen=10000)
+        # Jobs in each state, kept up to date so counts() (read on every admission) is cheap
+        self._counts: Dict[str, int] = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+
+    def enqueue(self, job_id: str, payload: Dict, priority: int = INTERACTIVE, client: str = "") -> Job:
+        previous = self._jobs.get(job_id)
+        if previous is not None:
+            self._release(previous)
+            self._finished.pop(job_id, None)
+            self._counts[previous.status] -= 1
+        job = self._jobs[job_id] = Job(job_id=job_id, payload=payload, priority=priority, client=client)
+        self._counts[QUEUED] += 1
+        self._push(job)
+        self.enqueued += 1
+        self._notify()
+        return job
+
+    def claim(self, owner: str, priorities: Optional[Collection[int]] = None) -> Optional[Job]:
+        now = time.time()
+        self._purge(now)
+        job = None
+        for running in list(self._running.values()):
+            if running.lease_until >= now or (priorities is not None and running.priority not in priorities):
+                continue
+            self.redelivered += 1
+            logger.warning(f"Lease on job {running.job_id} held by {running.owner} expired, redelivering")
+            if running.attempts >= self.max_attempts:
+                self._finish(running, FAILED, "Ran out of attempts (worker lost)")
+                continue
+            job = running
+            break
+        if job is None:
+            job = self._next_queued(priorities)
+        if job is None:
+            return None
+
+        if job.job_id not in self._running:
+            self._running[job.job_id] = job
+            self._running_by_client[job.client] = self._running_by_client.get(job.client, 0) + 1
+        self._set_status(job, RUNNING)
+        job.owner = owner
+        job.attempts += 1
+        job.lease_until = now + self.visibility_timeout
+        job.updated_at = now
+        self.claimed += 1
+        return job
+
+    def heartbeat(self, job_id: str, owner: str) -> bool:
+        job = self._running.get(job_id)
+        if job is None or job.owner != owner:
+            return False
+        job.lease_until = time.time() + self.visibility_timeout
+        return True
+
+    def complete(self, job_id: str, owner: str):
+        job = self._running.get(job_id)
+        if job is not None and job.owner == owner:
+            self._finish(job, DONE)
+            self.completed += 1
+
+    def fail(self, job_id: str, owner: str, error: str):
+        job = self._running.get(job_id)
+        if job is None or job.owner != owner:
+            return
+        if job.attempts >= self.max_attempts:
+            self._finish(job, FAILED, error)
+            return
+        self._release(job)
+        self._set_status(job, QUEUED)
+        job.owner, job.error, job.updated_at = None, error, time.time()
+        self._push(job)
+        self._notify()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self._counts)
+
+    def position(self, job_id: str) -> Optional[int]:
+        job = self._jobs.get(job_id)
+        if job is None or job.status != QUEUED:
+            return None
+        clients = self._queued.get(job.priority, {})
+        own = clients.get(job.client, ())
+        place = next((index + 1 for index, queued_id in enumerate(own) if queued_id == job_id), len(own))
+        turn = self._running_by_client.get(job.client, 0) + place
+        others = 0
+        for client, ids in clients.items():
+            if client == job.client:
+                continue
+            running = self._running_by_client.get(client, 0)
+            others += min(len(ids), max(turn - running - 1, 0))
+            other = self._jobs.get(ids[turn - running - 1]) if running < turn <= running + len(ids) else None
+            if other is not None and other.created_at < job.created_at:
+                others += 1
+        return others + place
+
+    def load(self, client: str) -> int:
+        queued = sum(len(clients.get(client, ())) for clients in self._queued.values())
+        return queued + self._running_by_client.get(client, 0)
+
+    def throughput(self, window: float = 60) -> float:
+        cutoff = time.time() - window
+        return sum(1 for finished in self._finish_times if finished >= cutoff) / window
+
+    def _push(self, job: Job):
+        self._queued.setdefault(job.priority, {}).setdefault(job.client, deque()).append(job.job_id)
+
+    def _next_queued(self, priorities: Optional[Collection[int]]) -> Optional[Job]:
+        for priority in sorted(self._queued):
+            if priorities is not None and priority not in priorities:
+                continue
+            clients = self._queued[priority]
+            while clients:
+                # Fewest running jobs first; among equals, the client with the oldest job
+                client = min(clients, key=lambda name: (self._running_by_client.get(name, 0), self._age(clients[name])))
+                ids = clients[client]
+                job = self._jobs.get(ids.popleft())
+                if not ids:
+                    del clients[client]
+                # Ids left behind by a re-enqueued job are skipped
+                if job is not None and job.status == QUEUED and job.priority == priority and job.client == client:
+                    return job
+            del self._queued[priority]
+        return None
+
+    def _age(self, ids: Deque[str]) -> float:
+        job = self._jobs.get(ids[0])
+        return job.created_at if job is not None else 0
+
+    def _set_status(self, job: Job, status: str):
+        self._counts[job.status] -= 1
+        self._counts[status] += 1
+        job.status = status
+
+    def _release(self, job: Job):
+        """Stop counting a job as running."""
+        if self._running.pop(job.job_id, None) is None:
+            return
+        remaining = self._running_by_client.get(job.client, 1) - 1
+        if remaining > 0:
+            self._running_by_client[job.client] = remaining
+        else:
+            self._running_by_client.pop(job.client, None)
+
+    def _finish(self, job: Job, status: str, error: Optional[str] = None):
+        self._release(job)
+        self._set_status(job, status)
+        job.owner, job.error, job.updated_at = None, error, time.time()
+        if status == FAILED:
+            self.failed += 1
+        self._finish_times.append(job.updated_at)
+        # Finished jobs are kept for status reads until they age out
+        self._finished[job.job_id] = None
+
+    def _purge(self, now: float):
+        cutoff = now - self.retention
+        while self._finished:
+            job_id = next(iter(self._finished))
+            if self._jobs[job_id].updated_at >= cutoff:
+                break
+            del self._finished[job_id]
+            self._counts[self._jobs.pop(job_id).status] -= 1
+
+class SQLiteJobQueue(JobQueue):
+    """
+    Durable queue in a SQLite file: jobs survive restarts, and any process on the host
+    that opens the same file can enqueue or work on them.
+    """
+
+    backend = "sqlite"
+    blocking = True
+
+    def __init__(self, path: str = JOB_DB_PATH, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, payload TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL, "
+            "owner TEXT, lease_until REAL NOT NULL, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+            "priority INTEGER NOT NULL DEFAULT 0, client TEXT NOT NULL DEFAULT '')"
+        )
+        # Files created before jobs had a priority and client get the columns added
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "priority" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+        if "client" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN client TEXT NOT NULL DEFAULT ''")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_priority ON jobs (status, priority, client, created_at)")
+
+    def enqueue(self, job_id: str, payload: Dict, priority: int = INTERACTIVE, client: str = "") -> Job:
+        job = Job(job_id=job_id, payload=payload, priority=priority, client=client)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, payload, status, attempts, owner, lease_until, error, "
+                "created_at, updated_at, priority, client) VALUES (?, ?, ?, 0, NULL, 0, NULL, ?, ?, ?, ?)",
+                (job_id, json.dumps(payload), QUEUED, job.created_at, job.updated_at, priority, client)
+            )
+        self.enqueued += 1
+        self._notify()
+        return job
+
+    def claim(self, owner: str, priorities: Optional[Collection[int]] = None) -> Optional[Job]:
+        now = time.time()
+        # Class numbers are ints, so they can go into the query as they are
+        only = f"AND priority IN ({', '.join(str(int(priority)) for priority in priorities)}) " if priorities is not None else ""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                                   (DONE, FAILED, now - self.retention))
+                # Expired leases that are out of attempts are given up on rather than redelivered
+                expired = self._conn.execute(
+                    "UPDATE jobs SET status = ?, owner = NULL, error = ?, updated_at = ? "
+                    "WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                    (FAILED, "Ran out of attempts (worker lost)", now, RUNNING, now, self.max_attempts)
+                ).rowcount
+                # Expired leases first, then by priority class, client with the fewest running jobs, age
+                row = self._conn.execute(
+                    "WITH busy AS (SELECT client, COUNT(*) AS running FROM jobs WHERE status = ? GROUP BY client) "
+                    "SELECT job_id, status FROM jobs LEFT JOIN busy USING (client) "
+                    f"WHERE (status = ? OR (status = ? AND lease_until < ?)) {only}"
+                    "ORDER BY status = ?, priority, COALESCE(running, 0), created_at LIMIT 1",
+                    (RUNNING, QUEUED, RUNNING, now, QUEUED)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = ?, owner = ?, attempts = attempts + 1, lease_until = ?, updated_at = ? "
+                        "WHERE job_id = ?",
+                        (RUNNING, owner, now + self.visibility_timeout, now, row[0])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        self.failed += expired
+        if row is None:
+            return None
+        if row[1] == RUNNING:
+            self.redelivered += 1
+            logger.warning(f"Lease on job {row[0]} expired, redelivering")
+        self.claimed += 1
+        return self.get(row[0])
+
+    def heartbeat(self, job_id: str, owner: str) -> bool:
+        with self._lock:
+            updated = self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND status = ? AND owner = ?",
+                (time.time() + self.visibility_timeout, job_id, RUNNING, owner)
+            ).rowcount
+        return updated > 0
+
+    def complete(self, job_id: str, owner: str):
+        with self._lock:
+            updated = self._conn.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, updated_at = ? WHERE job_id = ? AND owner = ?",
+                (DONE, time.time(), job_id, owner)
+            ).rowcount
+        self.completed += updated
+
+    def fail(self, job_id: str, owner: str, error: str):
+        with self._lock:
+            updated = self._conn.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, owner = NULL, error = ?, updated_at = ? "
+                "WHERE job_id = ? AND owner = ?",
+                (self.max_attempts, FAILED, QUEUED, error, time.time(), job_id, owner)
+            ).rowcount
+        if updated:
+            self._notify()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job_id, payload, status, attempts, owner, lease_until, error, priority, client, "
+                "created_at, updated_at FROM jobs WHERE job_id = ?",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return Job(job_id=row[0], payload=json.loads(row[1]), status=row[2], attempts=row[3], owner=row[4],
+                   lease_until=row[5], error=row[6], priority=row[7], client=row[8], created_at=row[9],
+                   updated_at=row[10])
+
+    def counts(self) -> Dict[str, int]:
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        with self._lock:
+            for status, count in self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+                counts[status] = count
+        return counts
+
+    def position(self, job_id: str) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute("SELECT status, priority, client, created_at FROM jobs WHERE job_id = ?",
+                                     (job_id,)).fetchone()
+            if row is None or row[0] != QUEUED:
+                return None
+            _, priority, client, created_at = row
+            place = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND priority = ? AND client = ? AND created_at <= ?",
+                (QUEUED, priority, client, created_at)
+            ).fetchone()[0]
+            running = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ? AND client = ?",
+                                         (RUNNING, client)).fetchone()[0]
+            turn = running + place
+            others = self._conn.execute(
+                "WITH busy AS (SELECT client, COUNT(*) AS running FROM jobs WHERE status = ? GROUP BY client) "
+                "SELECT COUNT(*) FROM (SELECT created_at, COALESCE(running, 0) + ROW_NUMBER() "
+                "OVER (PARTITION BY client ORDER BY created_at) AS turn FROM jobs LEFT JOIN busy USING (client) "
+                "WHERE status = ? AND priority = ? AND client != ?) "
+                "WHERE turn < ? OR (turn = ? AND created_at < ?)",
+                (RUNNING, QUEUED, priority, client, turn, turn, created_at)
+            ).fetchone()[0]
+        return others + place
+
+    def load(self, client: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE client = ? AND status IN (?, ?)",
+                                      (client, QUEUED, RUNNING)).fetchone()[0]
+
+    def throughput(self, window: float = 60) -> float:
+        with self._lock:
+            finished = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?) AND updated_at >= ?",
+                                          (DONE, FAILED, time.time() - window)).fetchone()[0]
+        return finished / window
+
+def make_job_queue(backend: str = JOB_BACKEND) -> JobQueue:
+    """Create the job queue configured by JOB_BACKEND ("memory" or "sqlite")."""
+    if backend == "sqlite":
+        logger.info(f"Using SQLite job queue at {JOB_DB_PATH}")
+        return SQLiteJobQueue()
+    if backend != "memory":
+        logger.warning(f"Unknown JOB_BACKEND {backend!r}, using memory")
+    return MemoryJobQueue()
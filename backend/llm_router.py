@@ -1,204 +1,218 @@
-import aiohttp
+import asyncio
 import json
 import logging
-from typing import Dict, List, Optional
-from config import API_KEYS
+from typing import AsyncIterator, Callable, Dict, List, Optional
+from config import ROUTE_CATEGORY_TIMEOUT, GENERATE_TIMEOUT, ROUTING_MAX_FALLBACKS
+from prompt_parser import extract_json_object
+from providers import (ProviderError, anthropic_message, stream_anthropic_message,
+                       gemini_generate, stream_gemini_generate)
+from routing_table import routing_table, ModelSpec, CategoryRoute
+from hedging import hedger
+from message_batches import deferring, deferred_timeout
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-async def route_to_llms(generated_prompts: Dict[str, str]) -> Dict[str, str]:
+# Model used for prompt generation and combining
+CLAUDE_37_MODEL = "claude-3-7-sonnet-20250219"
+
+def is_error_response(response: str) -> bool:
+    """Check whether a routed response is one of the error strings the router returns."""
+    return response.startswith("Error") or response.startswith("Cannot process")
+
+async def route_prompt(category: str, prompt: str, timeout: Optional[float] = None,
+                       on_delta: Optional[Callable[[str], None]] = None) -> str:
     """
-    Route each prompt to the appropriate LLM based on the category.
+    Send a single category's prompt to the best model the routing table offers for it.
+    
+    If that model fails, the next candidate is tried while time remains (up to
+    ROUTING_MAX_FALLBACKS times), unless part of a streamed reply was already delivered.
+    With HEDGE_ENABLED, an attempt that runs past the model's usual latency is raced
+    against a duplicate call (see hedging.py).
     
     Arguments:
-        generated_prompts: Dictionary with categories as keys and generated prompts as values
+        category: The category of the prompt
+        prompt: The generated prompt for that category
+        timeout: Seconds allowed for the call, fallbacks included (defaults to ROUTE_CATEGORY_TIMEOUT)
+        on_delta: If given, the reply is streamed and each text delta is passed to it as it arrives
         
     Returns:
-        Dictionary with categories as keys and LLM responses as values
+        The LLM response, or an error string (see is_error_response)
     """
-    responses = {}
-    tasks = []
-    
-    # Check if keys exist
-    if not API_KEYS.get("gemini"):
-        logger.error("Gemini API key is missing")
-    if not API_KEYS.get("claude"):
-        logger.error("Claude API key is missing")
-    
-    # Process each category in parallel
-    for category, prompt in generated_prompts.items():
-        if prompt != "Not Applicable":
-            if category == "mathematics" and API_KEYS.get("gemini"):
-                task = process_math_with_gemini(prompt)
-                tasks.append((category, task))
-            elif category == "coding" and API_KEYS.get("claude"):
-                task = process_coding_with_claude_37(prompt)
-                tasks.append((category, task))
-            elif category == "literature" and API_KEYS.get("claude"):
-                task = process_literature_with_claude_35(prompt)
-                tasks.append((category, task))
-            elif category == "general_knowledge" and API_KEYS.get("claude"):
-                task = process_general_with_claude_37(prompt)
-                tasks.append((category, task))
-            else:
-                logger.warning(f"Skipping category {category} due to missing API key or unsupported category")
-                responses[category] = f"Cannot process {category} - missing API key or unsupported category"
+    if timeout is None:
+        timeout = deferred_timeout(ROUTE_CATEGORY_TIMEOUT)
+    
+    route = routing_table.route(category)
+    ranked = routing_table.candidates(category)
+    candidates = ranked[:1 + ROUTING_MAX_FALLBACKS]
+    if route is None or not candidates:
+        logger.warning(f"Skipping category {category} due to missing API key or unsupported category")
+        return f"Cannot process {category} - missing API key or unsupported category"
     
-    # Await all tasks
-    for category, task in tasks:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    for index, spec in enumerate(candidates):
+        logger.info(f"Routing {category} to {spec.name}")
+        streamed = []
+        started = loop.time()
+        # Deferred calls wait on a batch anyway; racing them would only double the cost
+        delay = None if deferring() else hedger.delay(spec.name)
+        hedge_spec = _hedge_target(spec, ranked)
+        hedge_won = False
         try:
-            responses[category] = await task
-            logger.info(f"Successfully processed {category}")
+            if delay is None:
+                response = await asyncio.wait_for(call_model(spec, route, prompt, on_delta, streamed),
+                                                  timeout=deadline - started)
+            else:
+                # Only the winning attempt's deltas reach on_delta, so `streamed` still
+                # records exactly what the client has seen
+                response, hedge_won = await asyncio.wait_for(
+                    hedger.race(lambda forward: call_model(spec, route, prompt, forward),
+                                lambda forward: call_model(hedge_spec, route, prompt, forward, coalesce=False),
+                                delay, _recording(on_delta, streamed)),
+                    timeout=deadline - started
+                )
+        except asyncio.TimeoutError:
+            routing_table.record(spec.name, loop.time() - started, ok=False)
+            logger.error(f"Timed out processing {category} after {timeout}s")
+            return f"Error processing {category}: timed out after {timeout} seconds"
         except Exception as e:
-            logger.error(f"Error processing {category}: {str(e)}")
-            responses[category] = f"Error processing {category}: {str(e)}"
-    
-    return responses
-
-async def process_general_with_claude_37(prompt: str) -> str:
-    """Process general knowledge queries with Claude 3.7 Sonnet."""
-    logger.info("Processing general knowledge with Claude 3.7")
-    return await call_claude_37(
-        "You are a helpful assistant addressing general knowledge questions.",
-        prompt
-    )
-
-async def process_math_with_gemini(prompt: str) -> str:
-    """Process math queries with Gemini 2.0 Flash."""
-    logger.info("Processing mathematics with Gemini 2.0 Flash")
-    api_key = API_KEYS["gemini"]
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://generativelanguage.googleapis.com/v1/models/gemini-2.0-flash:generateContent",
-                params={"key": api_key},
-                json={
-                    "contents": [
-                        {
-                            "role": "user",
-                            "parts": [{"text": prompt}]
-                        }
-                    ],
-                    "generationConfig": {
-                        "temperature": 0.2,
-                        "maxOutputTokens": 2048
-                    }
-                },
-                timeout=aiohttp.ClientTimeout(total=30)
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    logger.error(f"Gemini API Error (Status {response.status}): {error_text}")
-                    return f"Error from Gemini API (Status {response.status}): {error_text}"
-                    
-                result = await response.json()
+            routing_table.record(spec.name, loop.time() - started, ok=False)
+            logger.error(f"Error processing {category} with {spec.name}: {str(e)}")
+            error = str(e) if isinstance(e, ProviderError) else f"Error processing {category}: {str(e)}"
+            if streamed or index + 1 >= len(candidates) or loop.time() >= deadline:
+                return error
+            logger.warning(f"Falling back to {candidates[index + 1].name} for {category}")
+            routing_table.fallbacks += 1
+            continue
         
-        # Extract the response from Gemini API response
-        try:
-            return result["candidates"][0]["content"]["parts"][0]["text"]
-        except (KeyError, IndexError) as e:
-            logger.error(f"Error extracting Gemini response: {e}")
-            logger.error(f"Gemini result: {json.dumps(result)}")
-            return f"Error processing mathematics with Gemini: {str(e)}"
-    except Exception as e:
-        logger.error(f"Exception calling Gemini API: {str(e)}")
-        return f"Error calling Gemini API: {str(e)}"
+        elapsed = loop.time() - started
+        if deferring():
+            # Batch turnaround says nothing about a model's interactive latency
+            logger.info(f"Successfully processed {category} (deferred)")
+            return response
+        # Primary's latency is at least `elapsed` either way, which keeps the hedge delay honest
+        hedger.observe(spec.name, elapsed)
+        if hedge_won:
+            routing_table.record(hedge_spec.name, elapsed - delay, ok=True)
+            logger.info(f"Successfully processed {category} (hedge to {hedge_spec.name} won)")
+        else:
+            routing_table.record(spec.name, elapsed, ok=True)
+            logger.info(f"Successfully processed {category}")
+        return response
+
+def _hedge_target(spec: ModelSpec, ranked: List[ModelSpec]) -> ModelSpec:
+    """The model a hedge of `spec` goes to: the next ranked model, or `spec` itself."""
+    if hedger.target == "alternate":
+        names = [candidate.name for candidate in ranked]
+        position = names.index(spec.name) if spec.name in names else -1
+        if position + 1 < len(ranked):
+            return ranked[position + 1]
+    return spec
 
-async def process_coding_with_claude_37(prompt: str) -> str:
-    """Process coding queries with Claude 3.7 Sonnet."""
-    logger.info("Processing coding with Claude 3.7")
-    return await call_claude_37(
-        "You are a helpful programming assistant that explains code clearly and provides well-structured, efficient solutions.",
-        prompt
-    )
+def _recording(on_delta: Optional[Callable[[str], None]],
+               streamed: List[str]) -> Optional[Callable[[str], None]]:
+    if on_delta is None:
+        return None
+    def deliver(text: str):
+        streamed.append(text)
+        on_delta(text)
+    return deliver
 
-async def process_literature_with_claude_35(prompt: str) -> str:
-    """Process literature/reading comprehension with Claude 3.5 Haiku."""
-    logger.info("Processing literature with Claude 3.5 Haiku")
-    api_key = API_KEYS["claude"]
+async def call_model(spec: ModelSpec, route: CategoryRoute, prompt: str,
+                     on_delta: Optional[Callable[[str], None]] = None,
+                     streamed: Optional[List[str]] = None, coalesce: bool = True) -> str:
+    """
+    Call one model from the routing table with a category's settings.
     
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://api.anthropic.com/v1/messages",
-                headers={
-                    "x-api-key": api_key,
-                    "anthropic-version": "2023-06-01",
-                    "content-type": "application/json"
-                },
-                json={
-                    "model": "claude-3-5-haiku-20241022",
-                    "max_tokens": 4096,
-                    "system": "You are a literary analysis and reading comprehension expert who provides insightful, nuanced interpretations.",
-                    "messages": [
-                        {"role": "user", "content": prompt}
-                    ]
-                },
-                timeout=aiohttp.ClientTimeout(total=30)
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    logger.error(f"Claude API Error (Status {response.status}): {error_text}")
-                    return f"Error from Claude API (Status {response.status}): {error_text}"
-                    
-                result = await response.json()
+    Arguments:
+        spec: The model to call
+        route: The category's route (system prompt, max tokens, temperature)
+        prompt: The user prompt
+        on_delta: If given, the reply is streamed and each text delta is passed to it
+        streamed: If given, deltas are also appended here so callers can tell whether
+            any text was delivered before a failure
+        coalesce: Share an identical call already in flight; hedges turn this off, since
+            joining the call they duplicate would defeat them
         
-        # Extract the response from Claude API response
-        try:
-            return result["content"][0]["text"]
-        except (KeyError, IndexError) as e:
-            logger.error(f"Error extracting Claude 3.5 response: {e}")
-            logger.error(f"Claude result: {json.dumps(result)}")
-            return f"Error processing literature with Claude 3.5 Haiku: {str(e)}"
-    except Exception as e:
-        logger.error(f"Exception calling Claude 3.5 API: {str(e)}")
-        return f"Error calling Claude 3.5 API: {str(e)}"
+    Returns:
+        The full reply text; raises ProviderError on API errors
+    """
+    if spec.provider == "gemini":
+        if on_delta is None:
+            return await gemini_generate(spec.model, prompt, max_output_tokens=route.max_tokens,
+                                         temperature=route.temperature, coalesce=coalesce)
+        stream = stream_gemini_generate(spec.model, prompt, max_output_tokens=route.max_tokens,
+                                        temperature=route.temperature, coalesce=coalesce)
+    elif spec.provider == "claude":
+        if on_delta is None:
+            return await anthropic_message(spec.model, route.system_prompt, prompt, max_tokens=route.max_tokens,
+                                           temperature=route.temperature, coalesce=coalesce)
+        stream = stream_anthropic_message(spec.model, route.system_prompt, prompt, max_tokens=route.max_tokens,
+                                          temperature=route.temperature, coalesce=coalesce)
+    else:
+        raise ValueError(f"Unknown provider {spec.provider} for model {spec.name}")
+    
+    chunks = streamed if streamed is not None else []
+    async for delta in stream:
+        chunks.append(delta)
+        on_delta(delta)
+    return "".join(chunks)
 
 async def call_claude_37(system_prompt: str, prompt: str) -> str:
     """Call Claude 3.7 Sonnet API with the given system prompt and user prompt."""
-    api_key = API_KEYS["claude"]
-    
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://api.anthropic.com/v1/messages",
-                headers={
-                    "x-api-key": api_key,
-                    "anthropic-version": "2023-06-01",
-                    "content-type": "application/json"
-                },
-                json={
-                    "model": "claude-3-7-sonnet-20250219",
-                    "max_tokens": 4096,
-                    "system": system_prompt,
-                    "messages": [
-                        {"role": "user", "content": prompt}
-                    ]
-                },
-                timeout=aiohttp.ClientTimeout(total=30)
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    logger.error(f"Claude API Error (Status {response.status}): {error_text}")
-                    return f"Error from Claude API (Status {response.status}): {error_text}"
-                    
-                result = await response.json()
-        
-        # Extract the response
-        try:
-            return result["content"][0]["text"]
-        except (KeyError, IndexError) as e:
-            logger.error(f"Error extracting Claude 3.7 response: {e}")
-            logger.error(f"Claude result: {json.dumps(result)}")
-            return f"Error processing with Claude 3.7: {str(e)}"
+        return await anthropic_message(CLAUDE_37_MODEL, system_prompt, prompt, max_tokens=4096)
+    except ProviderError as e:
+        return str(e)
     except Exception as e:
         logger.error(f"Exception calling Claude 3.7 API: {str(e)}")
         return f"Error calling Claude 3.7 API: {str(e)}"
 
+def stream_claude_37(system_prompt: str, prompt: str) -> AsyncIterator[str]:
+    """Stream a Claude 3.7 Sonnet reply as text deltas. Raises ProviderError on API errors."""
+    return stream_anthropic_message(CLAUDE_37_MODEL, system_prompt, prompt, max_tokens=4096)
+
+# Descriptions used when asking Claude to rewrite a category's content
+CATEGORY_DESCRIPTIONS = {
+    "general_knowledge": "general knowledge questions",
+    "mathematics": "mathematical problems or equations",
+    "coding": "programming tasks or code explanations",
+    "literature": "literary analysis or reading comprehension"
+}
+
+# The generation system prompts are the same for every request so the provider can cache
+# them; the category they are about is named in the user message instead
+GENERATE_SYSTEM_PROMPT = """You are an expert at creating structured prompts for AI language models.
+    Take the provided content, related to the topic named before it, and create a clear,
+    well-structured prompt that will help another AI model provide the best possible response.
+    
+    Focus on:
+    1. Clarifying any ambiguities in the original content
+    2. Organizing the information logically
+    3. Highlighting key questions or requirements
+    4. Providing necessary context
+    
+    Your output should be just the reformulated prompt with no additional explanations or meta-commentary."""
+
+GENERATE_BATCH_SYSTEM_PROMPT = """You are an expert at creating structured prompts for AI language models.
+    You will receive a list of categories, each with the topic it covers, followed by a JSON
+    object mapping those categories to content.
+    
+    For each category, rewrite its content into a clear, well-structured prompt that will help
+    another AI model specialized in that category provide the best possible response.
+    
+    Focus on:
+    1. Clarifying any ambiguities in the original content
+    2. Organizing the information logically
+    3. Highlighting key questions or requirements
+    4. Providing necessary context
+    
+    Respond with only a JSON object that has the same keys, where each value is the reformulated
+    prompt for that category. Do not add any other text."""
+
 async def generate_structured_prompt(category: str, content: str) -> str:
     """
     Generate an optimized prompt for a specific category using Claude 3.7 Sonnet.
@@ -211,23 +225,73 @@ async def generate_structured_prompt(category: str, content: str) -> str:
         A structured prompt optimized for the target LLM
     """
     logger.info(f"Generating structured prompt for {category}")
-    category_descriptions = {
-        "general_knowledge": "general knowledge questions",
-        "mathematics": "mathematical problems or equations",
-        "coding": "programming tasks or code explanations",
-        "literature": "literary analysis or reading comprehension"
-    }
     
-    system_prompt = f"""You are an expert at creating structured prompts for AI language models.
-    Take the provided content related to {category_descriptions.get(category, "a specific topic")} and create
-    a clear, well-structured prompt that will help another AI model provide the best possible response.
+    topic = CATEGORY_DESCRIPTIONS.get(category, "a specific topic")
+    return await call_claude_37(GENERATE_SYSTEM_PROMPT, f"Topic: {topic}\n\n<content>\n{content}\n</content>")
+
+async def generate_prompt_with_fallback(category: str, content: str, timeout: Optional[float] = None) -> str:
+    """
+    Generate a structured prompt for one category, falling back to the original content
+    if generation fails or takes longer than `timeout` seconds (defaults to GENERATE_TIMEOUT).
+    """
+    if timeout is None:
+        timeout = deferred_timeout(GENERATE_TIMEOUT)
     
-    Focus on:
-    1. Clarifying any ambiguities in the original content
-    2. Organizing the information logically
-    3. Highlighting key questions or requirements
-    4. Providing necessary context
+    try:
+        generated = await asyncio.wait_for(generate_structured_prompt(category, content), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"Timed out generating prompt for {category} after {timeout}s, using original content")
+        return content
+    except Exception as e:
+        logger.error(f"Error generating prompt for {category}: {str(e)}")
+        return content
     
-    Your output should be just the reformulated prompt with no additional explanations or meta-commentary."""
+    if generated.startswith("Error"):
+        logger.error(f"Error generating prompt for {category}: {generated}")
+        return content
+    logger.info(f"Generated prompt for {category}")
+    return generated
+
+async def generate_structured_prompts_batch(categories: Dict[str, str],
+                                            timeout: Optional[float] = None) -> Dict[str, str]:
+    """
+    Generate structured prompts for several categories in a single Claude 3.7 Sonnet call.
+    
+    Arguments:
+        categories: Dictionary with categories as keys and extracted content as values
+        timeout: Seconds allowed for the whole call (defaults to GENERATE_TIMEOUT)
+        
+    Returns:
+        Dictionary with categories as keys and generated prompts as values; categories
+        missing from the reply fall back to their original content
+    """
+    if timeout is None:
+        timeout = deferred_timeout(GENERATE_TIMEOUT)
+    
+    logger.info(f"Generating structured prompts for {', '.join(categories)} in one call")
+    
+    category_list = "\n".join(f"- {category}: {CATEGORY_DESCRIPTIONS.get(category, 'a specific topic')}"
+                              for category in categories)
+    prompt = f"The categories are:\n{category_list}\n\n{json.dumps(categories, indent=2)}"
+    
+    try:
+        reply = await asyncio.wait_for(call_claude_37(GENERATE_BATCH_SYSTEM_PROMPT, prompt), timeout=timeout)
+        if reply.startswith("Error"):
+            raise ValueError(reply)
+        generated = extract_json_object(reply)
+    except asyncio.TimeoutError:
+        logger.error(f"Timed out generating batched prompts after {timeout}s, using original content")
+        return dict(categories)
+    except Exception as e:
+        logger.error(f"Error generating batched prompts: {str(e)}")
+        return dict(categories)
     
-    return await call_claude_37(system_prompt, content)
\ No newline at end of file
+    results = {}
+    for category, content in categories.items():
+        value = generated.get(category)
+        if isinstance(value, str) and value.strip():
+            results[category] = value
+        else:
+            logger.warning(f"Batched reply had no prompt for {category}, using original content")
+            results[category] = content
+    return results
@@ -0,0 +1,290 @@
+import asyncio
+import glob
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Deque, Dict, List, Optional
+from config import (PROMPT_LOG_DIR, PROMPT_LOG_SEGMENT_BYTES, PROMPT_LOG_SEGMENT_SECONDS,
+                    PROMPT_LOG_MAX_SEGMENTS, PROMPT_LOG_BATCH_SIZE, PROMPT_LOG_FLUSH_INTERVAL,
+                    PROMPT_LOG_QUEUE_SIZE, PARSED_PROMPTS_DIR, GENERATED_PROMPTS_DIR)
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Per-session JSON files written before the log sink existed, by record kind
+LEGACY_DIRS = {
+    "parsed": PARSED_PROMPTS_DIR,
+    "generated": GENERATED_PROMPTS_DIR,
+}
+
+class LogSink:
+    """
+    Background writer for prompt logs.
+
+    Records are queued without touching the disk and a single writer task appends them in
+    batches to gzip-compressed JSONL segments (one gzip member per batch), rotating to a
+    new segment by size or age and deleting the oldest past `max_segments`. A SQLite index
+    maps each session id to the segment and member offset holding its records, so lookup()
+    only decompresses the batches it needs.
+
+    Several processes can share the directory: each writes segments of its own, and only
+    deletes another process's segment once that can no longer be written to.
+    """
+
+    def __init__(self, directory: str = PROMPT_LOG_DIR,
+                 segment_bytes: int = PROMPT_LOG_SEGMENT_BYTES,
+                 segment_seconds: float = PROMPT_LOG_SEGMENT_SECONDS,
+                 max_segments: int = PROMPT_LOG_MAX_SEGMENTS,
+                 batch_size: int = PROMPT_LOG_BATCH_SIZE,
+                 flush_interval: float = PROMPT_LOG_FLUSH_INTERVAL,
+                 queue_size: int = PROMPT_LOG_QUEUE_SIZE):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.max_segments = max_segments
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        # Records waiting for the writer, which is woken when one is added or on stop()
+        self._queue: Deque[Dict] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        self._index: Optional[sqlite3.Connection] = None
+        self._segment: Optional[str] = None
+        self._segment_opened = 0.0
+        # Records taken off the queue but not yet written
+        self._pending: List[Dict] = []
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.errors = 0
+
+    def start(self):
+        """Start the writer task on the running event loop."""
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run(), name="prompt-log-writer")
+
+    async def stop(self):
+        """Flush everything queued and stop the writer task."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        with self._lock:
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+
+    def write(self, kind: str, session_id: str, data) -> bool:
+        """
+        Queue a record for writing; never blocks.
+
+        Arguments:
+            kind: Record type, e.g. "parsed" or "generated"
+            session_id: Session the record belongs to
+            data: JSON-serializable payload
+
+        Returns:
+            False if the queue was full and the record was dropped
+        """
+        if self._task is None or self._task.done():
+            self.start()
+        if len(self._queue) >= self.queue_size:
+            self.dropped += 1
+            logger.warning(f"Prompt log queue full, dropped {kind} record for {session_id}")
+            return False
+        self._queue.append({"ts": time.time(), "kind": kind, "session_id": session_id, "data": data})
+        self._wakeup.set()
+        return True
+
+    async def lookup(self, session_id: str) -> Dict[str, object]:
+        """
+        Find the logged records for a session.
+
+        Returns:
+            Dictionary mapping record kind to its payload (the latest one if logged twice)
+        """
+        records = await asyncio.to_thread(self._read_session, session_id)
+        # Records still queued or being written haven't reached the index yet
+        for record in self._pending + list(self._queue):
+            if record["session_id"] == session_id:
+                records[record["kind"]] = record["data"]
+        return records
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "directory": self.directory,
+            "segment": os.path.basename(self._segment) if self._segment else None,
+            "queued": len(self._queue),
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "errors": self.errors,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                # Everything queued before stop() is written first
+                if self._stopping:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # Give a partial batch up to flush_interval to fill
+            deadline = loop.time() + self.flush_interval
+            while len(self._queue) < self.batch_size and not self._stopping:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            batch = self._pending = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Dict]):
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error writing {len(batch)} prompt log records: {str(e)}")
+        finally:
+            self._pending = []
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._index is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._index = sqlite3.connect(os.path.join(self.directory, "index.sqlite3"),
+                                          check_same_thread=False, isolation_level=None, timeout=30)
+            self._index.execute("PRAGMA journal_mode=WAL")
+            self._index.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "session_id TEXT NOT NULL, kind TEXT NOT NULL, segment TEXT NOT NULL, offset INTEGER NOT NULL)"
+            )
+            self._index.execute("CREATE INDEX IF NOT EXISTS entries_session_id ON entries (session_id)")
+        return self._index
+
+    def _segments(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.directory, "prompts-*.jsonl.gz")))
+
+    def _current_segment(self) -> str:
+        now = time.time()
+        if (self._segment is None
+                or now - self._segment_opened >= self.segment_seconds
+                or (os.path.exists(self._segment) and os.path.getsize(self._segment) >= self.segment_bytes)):
+            # The process id keeps each process appending to a segment of its own, so the
+            # offsets taken with tell() stay right when several processes log
+            self._segment = os.path.join(
+                self.directory,
+                f"prompts-{time.strftime('%Y%m%d-%H%M%S', time.gmtime(now))}-{int(now * 1000) % 1000:03d}"
+                f"-{os.getpid()}.jsonl.gz"
+            )
+            self._segment_opened = now
+            self._enforce_retention()
+        return self._segment
+
+    def _enforce_retention(self):
+        if self.max_segments <= 0:
+            return
+        segments = self._segments()
+        now = time.time()
+        # Leave room for the segment about to be created
+        for path in segments[:max(0, len(segments) - self.max_segments + 1)]:
+            if not self._finished(path, now):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process deleted it first
+                pass
+            self._index.execute("DELETE FROM entries WHERE segment = ?", (os.path.basename(path),))
+            logger.info(f"Deleted old prompt log segment {os.path.basename(path)}")
+
+    def _finished(self, path: str, now: float) -> bool:
+        """Whether no process writes to a segment any more."""
+        if path == self._segment:
+            return False
+        if path.endswith(f"-{os.getpid()}.jsonl.gz"):
+            return True
+        # A writer rotates away from a segment `segment_seconds` after opening it, and the
+        # segment was opened before its last write
+        try:
+            return os.path.getmtime(path) < now - self.segment_seconds
+        except FileNotFoundError:
+            return True
+
+    def _write_batch(self, batch: List[Dict]):
+        lines = "".join(json.dumps(record) + "\n" for record in batch).encode("utf-8")
+        with self._lock:
+            index = self._connect()
+            segment = self._current_segment()
+            with open(segment, "ab") as f:
+                offset = f.tell()
+                f.write(gzip.compress(lines))
+            name = os.path.basename(segment)
+            index.execute("BEGIN")
+            index.executemany(
+                "INSERT INTO entries (session_id, kind, segment, offset) VALUES (?, ?, ?, ?)",
+                [(record["session_id"], record["kind"], name, offset) for record in batch]
+            )
+            index.execute("COMMIT")
+
+    def _read_session(self, session_id: str) -> Dict[str, object]:
+        records = {}
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT DISTINCT segment, offset FROM entries WHERE session_id = ? ORDER BY segment, offset",
+                (session_id,)
+            ).fetchall()
+        for segment, offset in rows:
+            try:
+                for record in _read_member(os.path.join(self.directory, segment), offset):
+                    if record["session_id"] == session_id:
+                        records[record["kind"]] = record["data"]
+            except (OSError, zlib.error, json.JSONDecodeError) as e:
+                logger.error(f"Error reading prompt log segment {segment}: {str(e)}")
+
+        # Sessions logged before the sink was introduced have one file per kind
+        for kind, directory in LEGACY_DIRS.items():
+            path = os.path.join(directory, f"{session_id}.json")
+            if kind not in records and os.path.exists(path):
+                with open(path) as f:
+                    records[kind] = json.load(f)
+        return records
+
+def _read_member(path: str, offset: int) -> List[Dict]:
+    """Decompress the single gzip member starting at `offset` and parse its JSONL records."""
+    decompressor = zlib.decompressobj(wbits=31)
+    chunks = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while not decompressor.eof:
+            data = f.read(64 * 1024)
+            if not data:
+                break
+            chunks.append(decompressor.decompress(data))
+    return [json.loads(line) for line in b"".join(chunks).decode("utf-8").splitlines() if line]
+
+# Shared sink used for prompt logging
+log_sink = LogSink()
@@ -1,23 +1,66 @@
-from fastapi import FastAPI, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import os
-import uuid
+from contextlib import asynccontextmanager
+import asyncio
 import json
+import time
+import uuid
 import logging
-from typing import Dict, List, Optional
+from typing import Dict, List, Literal, Optional, Tuple
 
 from prompt_parser import parse_prompt
-from llm_router import route_to_llms, generate_structured_prompt
-from api_integration import combine_responses
-from config import PARSED_PROMPTS_DIR, GENERATED_PROMPTS_DIR
+from pipeline import run_category_pipelines, is_error_response
+from planner import plan_session
+from api_integration import combine_responses, stream_combined_response
+from http_client import start_http_client, stop_http_client, pool_stats
+from events import event_bus, format_sse, RESYNC
+from cache import response_cache
+from session_store import make_session_store, current_session_id
+from rate_limiter import rate_limiter
+from resilience import resilience_stats
+from classifier import prompt_classifier
+from log_sink import log_sink
+from routing_table import routing_table
+from hedging import hedger
+from singleflight import singleflight
+from job_queue import make_job_queue, Job, QUEUED, RUNNING, FAILED, INTERACTIVE, BATCH
+from admission import AdmissionController, PRIORITIES, client_key
+from worker import WorkerPool
+from prompt_batches import PromptBatchStore, parse_upload, run_prompt_batch
+from message_batches import message_batcher
+from metrics import start_session, session_metrics, finish_session, track_stage, render_metrics
+from config import EVENT_KEEPALIVE_INTERVAL, STREAM_RESPONSES, JOB_WORKERS, JOB_BATCH_WORKERS, JOB_POLL_INTERVAL
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the shared connection pool once and reuse it for every LLM call
+    await start_http_client()
+    log_sink.start()
+    # Pick up bulk uploads that were interrupted by a restart
+    for batch_id in batch_store().unfinished():
+        enqueue_prompt_batch(batch_id)
+    # Run queued prompts in this process too, unless that is left to worker.py
+    worker_pool.start()
+    batch_worker_pool.start()
+    yield
+    await worker_pool.stop()
+    await batch_worker_pool.stop()
+    await message_batcher.stop()
+    await log_sink.stop()
+    await stop_http_client()
+    global prompt_batches
+    if prompt_batches is not None:
+        prompt_batches.close()
+        prompt_batches = None
+
+app = FastAPI(lifespan=lifespan)
 
 # Enable CORS
 app.add_middleware(
@@ -30,6 +73,8 @@ app.add_middleware(
 
 class PromptRequest(BaseModel):
     prompt: str
+    # "batch" prompts wait until no interactive prompts are queued
+    priority: Literal["interactive", "batch"] = "interactive"
 
 class PromptResponse(BaseModel):
     session_id: str
@@ -37,100 +82,375 @@ class PromptResponse(BaseModel):
     parsed_categories: Optional[Dict[str, str]] = None
     generated_prompts: Optional[Dict[str, str]] = None
     responses: Optional[Dict[str, str]] = None
+    category_progress: Optional[Dict[str, str]] = None
+    plan: Optional[Dict] = None
+    metrics: Optional[Dict] = None
     combined_response: Optional[str] = None
     error: Optional[str] = None
+    job: Optional[Dict] = None
+    queue_position: Optional[int] = None
+
+# Session data, bounded and expiring (see session_store.py)
+sessions = make_session_store()
+
+# Prompts waiting for or being processed by a worker (see job_queue.py and worker.py)
+job_queue = make_job_queue()
+
+# Turns prompts away when the queue is too deep (see admission.py)
+admission = AdmissionController(job_queue)
+
+# Bulk uploads and their results (see prompt_batches.py); opened at startup, not on import
+prompt_batches: Optional[PromptBatchStore] = None
+
+def batch_store() -> PromptBatchStore:
+    """The bulk upload store, opened by the lifespan hook or by a worker process's first batch job."""
+    global prompt_batches
+    if prompt_batches is None:
+        prompt_batches = PromptBatchStore()
+    return prompt_batches
+
+# Prefix of the job ids of bulk uploads; other jobs are keyed by session id
+BATCH_JOB_PREFIX = "batch:"
+
+# Statuses after which a session no longer changes
+FINAL_STATUSES = ("completed", "error")
+
+def update_session(session_id: str, **fields):
+    """Update a session and push the changed fields to anyone listening on /api/events."""
+    if fields.get("status") in FINAL_STATUSES:
+        # Attach the finished session's latency and token breakdown
+        fields["metrics"] = finish_session(session_id)
+    if sessions.update(session_id, **fields) is None:
+        logger.warning(f"Session {session_id} expired or was evicted before it finished")
+    event_bus.publish(session_id, "update", fields)
+
+def job_state(job_id: str) -> Tuple[Optional[Job], Optional[int]]:
+    """A job and its place in line (None unless it is queued)."""
+    job = job_queue.get(job_id)
+    return job, job_queue.position(job_id) if job is not None and job.status == QUEUED else None
 
-# Create directories if they don't exist
-os.makedirs(PARSED_PROMPTS_DIR, exist_ok=True)
-os.makedirs(GENERATED_PROMPTS_DIR, exist_ok=True)
+async def session_snapshot(session_id: str) -> dict:
+    """The full client-facing state of a session, as returned by /api/status."""
+    record = sessions.get(session_id)
+    job, position = await job_queue.offload(job_state, session_id)
+    if record is None:
+        if job is None:
+            return {"session_id": session_id, "status": "not_found"}
+        # The session expired but the job outlives it; report what the queue knows
+        data = {"status": "error" if job.status == FAILED else job.status, "error": job.error,
+                "queue_position": position}
+        return PromptResponse(session_id=session_id, job=job.to_dict(), **data).model_dump(exclude_none=True)
+    data = record.to_dict()
+    if data["metrics"] is None:
+        data["metrics"] = session_metrics(session_id)
+    if job is not None:
+        data["job"] = job.to_dict()
+        data["queue_position"] = position
+    return PromptResponse(session_id=session_id, **data).model_dump(exclude_none=True)
 
-# In-memory storage for session data
-sessions = {}
+def admit(request: Request, priority: int) -> str:
+    """
+    Check a new job against admission control; returns the client it counts against.
+    Reads the job queue, so async callers go through job_queue.offload.
+    """
+    client = client_key(request)
+    rejection = admission.check(client, priority)
+    if rejection is not None:
+        logger.warning(f"Rejected a prompt from {client}: {rejection.reason}")
+        raise HTTPException(status_code=rejection.status, detail=rejection.reason, headers=rejection.headers)
+    return client
 
 @app.post("/api/prompt", response_model=PromptResponse)
-async def process_prompt(prompt_request: PromptRequest, background_tasks: BackgroundTasks):
+async def process_prompt(prompt_request: PromptRequest, request: Request):
+    # Turn the prompt away now rather than after a long wait in line
+    priority = PRIORITIES[prompt_request.priority]
+    client = await job_queue.offload(admit, request, priority)
+    
     # Create a new session
     session_id = str(uuid.uuid4())
-    sessions[session_id] = {
-        "status": "parsing",
-        "prompt": prompt_request.prompt
-    }
+    sessions.create(session_id, prompt_request.prompt)
+    sessions.update(session_id, status="queued")
+    
+    # Queue it for a worker, in this process or in worker.py
+    await job_queue.offload(job_queue.enqueue, session_id, {"prompt": prompt_request.prompt},
+                            priority=priority, client=client)
+    
+    return {"session_id": session_id, "status": "queued",
+            "queue_position": await job_queue.offload(job_queue.position, session_id)}
+
+def enqueue_prompt_batch(batch_id: str, client: str = ""):
+    """Queue a bulk upload for a worker, unless one already has it."""
+    job = job_queue.get(BATCH_JOB_PREFIX + batch_id)
+    if job is None or job.status not in (QUEUED, RUNNING):
+        job_queue.enqueue(BATCH_JOB_PREFIX + batch_id, {"batch_id": batch_id}, priority=BATCH,
+                          client=client or (job.client if job is not None else ""))
+
+@app.post("/api/prompts/batch")
+async def submit_prompt_batch(request: Request, retry_errors: bool = False):
+    """
+    Submit many prompts at once as a JSONL body (one {"prompt": ..., "custom_id": ...} per line).
+    
+    Duplicate prompts are processed once, and the stages run in bulk, deferring Claude calls
+    to the Message Batches API. Uploading the same file again returns the same batch and
+    resumes it rather than starting over; with `retry_errors` its failed prompts are retried.
+    Results are downloaded from /api/prompts/batch/{batch_id}/results.
+    
+    Uploads run at batch priority, behind interactive prompts.
+    """
+    try:
+        upload = parse_upload((await request.body()).decode("utf-8"))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not upload.prompts:
+        raise HTTPException(status_code=400, detail="The upload has no prompts")
+    
+    batch_id = upload.batch_id
+    client = await job_queue.offload(admit, request, BATCH)
+    store = batch_store()
+    created = await asyncio.to_thread(store.create, upload)
+    if not created and retry_errors:
+        await asyncio.to_thread(store.retry_errors, batch_id)
+    summary = await asyncio.to_thread(store.summary, batch_id)
+    if summary["status"] != "completed":
+        await job_queue.offload(enqueue_prompt_batch, batch_id, client)
+    return {**summary, "resumed": not created}
+
+@app.get("/api/prompts/batch/{batch_id}")
+async def get_prompt_batch(batch_id: str):
+    summary = await asyncio.to_thread(batch_store().summary, batch_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Unknown batch")
+    job = await job_queue.offload(job_queue.get, BATCH_JOB_PREFIX + batch_id)
+    return {**summary, "job": job.to_dict() if job is not None else None}
+
+@app.get("/api/prompts/batch/{batch_id}/results")
+async def get_prompt_batch_results(batch_id: str, request: Request, after: int = 0, follow: bool = True):
+    """
+    Stream a batch's results as JSONL, one line per uploaded line, in the order they finished.
     
-    # Start background processing
-    background_tasks.add_task(process_prompt_async, session_id, prompt_request.prompt)
+    Each line carries a `seq`; a download that was cut off resumes with `after` set to the
+    last one received. With `follow` the stream stays open until the whole batch is done.
+    """
+    store = batch_store()
+    if await asyncio.to_thread(store.summary, batch_id) is None:
+        raise HTTPException(status_code=404, detail="Unknown batch")
     
-    return {"session_id": session_id, "status": "parsing"}
+    async def result_lines():
+        cursor = after
+        while True:
+            # Checked before reading, so results that finish in between are still sent
+            finished = (await asyncio.to_thread(store.summary, batch_id))["pending"] == 0
+            results = await asyncio.to_thread(store.results, batch_id, cursor)
+            for seq, custom_ids, result in results:
+                for custom_id in custom_ids:
+                    yield json.dumps({"seq": seq, "custom_id": custom_id, **result}) + "\n"
+                cursor = seq
+            if results:
+                continue
+            if finished or not follow or await request.is_disconnected():
+                return
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+    
+    return StreamingResponse(result_lines(), media_type="application/x-ndjson")
 
 @app.get("/api/status/{session_id}", response_model=PromptResponse)
 async def get_status(session_id: str):
-    if session_id not in sessions:
-        return {"session_id": session_id, "status": "not_found"}
+    return await session_snapshot(session_id)
+
+@app.get("/api/events/{session_id}")
+async def stream_events(session_id: str, request: Request):
+    """
+    Push session updates as server-sent events instead of making the client poll /api/status.
+    
+    The stream opens with a "snapshot" event holding the full session state, followed by
+    "update" events (changed session fields), "category" events (per-category progress) and
+    "delta" events (text as it streams from the LLMs, tagged with the category or "combined")
+    until the session completes or fails.
+    
+    Events are only pushed while the session runs in this process; when another process
+    works on it, the stream polls the session store and sends a "snapshot" when it changes.
+    """
+    if sessions.get(session_id) is None:
+        async def not_found():
+            yield format_sse("snapshot", {"session_id": session_id, "status": "not_found"})
+        return StreamingResponse(not_found(), media_type="text/event-stream")
+    
+    # Subscribe before taking the snapshot so no update falls in between
+    queue = event_bus.subscribe(session_id)
+    
+    async def event_stream():
+        try:
+            snapshot = await session_snapshot(session_id)
+            yield format_sse("snapshot", snapshot)
+            if snapshot["status"] in FINAL_STATUSES:
+                return
+            
+            last_sent = time.monotonic()
+            record = sessions.get(session_id)
+            last_seen = record.updated_at if record is not None else None
+            last_position = snapshot.get("queue_position")
+            while not await request.is_disconnected():
+                local = worker_pool.owns(session_id) or batch_worker_pool.owns(session_id)
+                try:
+                    item = await asyncio.wait_for(
+                        queue.get(), timeout=EVENT_KEEPALIVE_INTERVAL if local else JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    record = None if local else sessions.get(session_id)
+                    # Moving up in the queue doesn't touch the session, so it is checked separately
+                    position = None if local else await job_queue.offload(job_queue.position, session_id)
+                    if record is not None and (record.updated_at != last_seen or position != last_position):
+                        last_seen, last_position = record.updated_at, position
+                        item = RESYNC
+                    elif time.monotonic() - last_sent >= EVENT_KEEPALIVE_INTERVAL:
+                        # Comment line keeps proxies from closing an idle stream
+                        last_sent = time.monotonic()
+                        yield ": keep-alive\n\n"
+                        continue
+                    else:
+                        continue
+                last_sent = time.monotonic()
+                
+                if item is RESYNC:
+                    event, data = "snapshot", await session_snapshot(session_id)
+                else:
+                    event, data = item
+                yield format_sse(event, data)
+                
+                if event in ("snapshot", "update") and data.get("status") in FINAL_STATUSES:
+                    break
+        finally:
+            event_bus.unsubscribe(session_id, queue)
     
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/logs/{session_id}")
+async def get_logs(session_id: str):
+    """The parsed categories and generated prompts logged for a session, if any."""
+    return {"session_id": session_id, **(await log_sink.lookup(session_id))}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Stage, provider call, queue and cache metrics in the Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/stats")
+async def get_stats():
     return {
-        "session_id": session_id,
-        **sessions[session_id]
+        "http_pool": pool_stats(),
+        "cache": response_cache.stats(),
+        "sessions": sessions.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "resilience": resilience_stats(),
+        "classifier": prompt_classifier.stats(),
+        "prompt_log": log_sink.stats(),
+        "routing": routing_table.stats(),
+        "hedging": hedger.stats(),
+        "singleflight": singleflight.stats(),
+        "jobs": {**await job_queue.offload(job_queue.stats), "local_workers": worker_pool.stats(),
+                 "local_batch_workers": batch_worker_pool.stats()},
+        "admission": admission.stats(),
+        "message_batches": message_batcher.stats()
     }
 
 async def process_prompt_async(session_id: str, prompt: str):
+    # Lets the shared layers (rate limiter, metrics) attribute provider calls to this session
+    current_session_id.set(session_id)
+    start_session(session_id)
+    
     try:
         logger.info(f"Processing session {session_id}")
+        update_session(session_id, status="parsing")
         
         # Step 1: Parse prompt into categories using Claude 3.7 Sonnet
         logger.info("Step 1: Parsing prompt into categories")
-        parsed_categories = await parse_prompt(prompt)
-        sessions[session_id]["status"] = "generating_prompts"
-        sessions[session_id]["parsed_categories"] = parsed_categories
+        with track_stage("parse"):
+            parsed_categories = await parse_prompt(prompt)
         
-        # Log parsed categories
-        try:
-            with open(os.path.join(PARSED_PROMPTS_DIR, f"{session_id}.json"), "w") as f:
-                json.dump(parsed_categories, f, indent=2)
-                logger.info(f"Saved parsed categories to {session_id}.json")
-        except Exception as e:
-            logger.error(f"Error saving parsed categories: {str(e)}")
+        # Decide which of the remaining stages this prompt actually needs
+        plan = plan_session(parsed_categories)
+        update_session(session_id, status="generating_prompts", parsed_categories=parsed_categories,
+                       plan=plan.to_dict())
         
-        # Step 2: Generate structured prompts for each category
-        logger.info("Step 2: Generating structured prompts")
-        generated_prompts = {}
-        for category, content in parsed_categories.items():
-            if content != "Not Applicable":
-                try:
-                    generated_prompts[category] = await generate_structured_prompt(category, content)
-                    logger.info(f"Generated prompt for {category}")
-                except Exception as e:
-                    logger.error(f"Error generating prompt for {category}: {str(e)}")
-                    generated_prompts[category] = content  # Use original content as fallback
+        # Log parsed categories (written in the background, see log_sink.py)
+        log_sink.write("parsed", session_id, parsed_categories)
+        
+        # Steps 2 and 3: Generate structured prompts and route them to the LLMs.
+        # Each category runs as its own pipeline, so a category is sent to its LLM as soon
+        # as its own prompt is ready and its response shows up in the session as it lands.
+        logger.info("Steps 2-3: Generating structured prompts and routing to LLMs")
+        progress = {category: "pending" for category in plan.categories}
+        partial_prompts = {}
+        partial_responses = {}
+        update_session(session_id, generated_prompts={}, responses={}, category_progress=dict(progress))
         
-        sessions[session_id]["status"] = "routing_to_llms"
-        sessions[session_id]["generated_prompts"] = generated_prompts
+        def on_update(category: str, stage: str, value: Optional[str]):
+            progress[category] = stage
+            changes = {"category_progress": dict(progress)}
+            if stage == "routing":
+                partial_prompts[category] = value
+                changes["generated_prompts"] = dict(partial_prompts)
+            elif stage in ("completed", "error"):
+                partial_responses[category] = value
+                changes["responses"] = dict(partial_responses)
+            
+            # The session moves on once no category is still waiting for its prompt
+            if stage == "routing" and "pending" not in progress.values() and "generating" not in progress.values():
+                changes["status"] = "routing_to_llms"
+                event_bus.publish(session_id, "update", {"status": "routing_to_llms"})
+            
+            sessions.update(session_id, **changes)
+            event_bus.publish(session_id, "category", {"category": category, "stage": stage, "value": value})
+        
+        def on_delta(category: str, text: str):
+            event_bus.publish(session_id, "delta", {"target": category, "text": text})
+        
+        with track_stage("pipeline"):
+            generated_prompts, responses = await run_category_pipelines(
+                parsed_categories,
+                on_update=on_update,
+                on_delta=on_delta if STREAM_RESPONSES else None,
+                rewrite=plan.rewrite
+            )
+        update_session(session_id, generated_prompts=generated_prompts)
         
         # Log generated prompts
-        try:
-            with open(os.path.join(GENERATED_PROMPTS_DIR, f"{session_id}.json"), "w") as f:
-                json.dump(generated_prompts, f, indent=2)
-                logger.info(f"Saved generated prompts to {session_id}.json")
-        except Exception as e:
-            logger.error(f"Error saving generated prompts: {str(e)}")
+        log_sink.write("generated", session_id, generated_prompts)
         
-        # Step 3: Route prompts to appropriate LLMs
-        logger.info("Step 3: Routing prompts to LLMs")
-        responses = await route_to_llms(generated_prompts)
-        sessions[session_id]["status"] = "combining_responses"
-        sessions[session_id]["responses"] = responses
+        # Only proceed if we have at least one valid response
+        has_valid_response = any(isinstance(resp, str) and not is_error_response(resp) for resp in responses.values())
+        
+        if not plan.combine and has_valid_response:
+            # A single specialist answer is already the final answer
+            update_session(session_id, status="completed", responses=responses,
+                           combined_response=next(iter(responses.values())))
+            logger.info(f"Processing completed successfully ({plan.name} plan, combine skipped)")
+            return
+        
+        update_session(session_id, status="combining_responses", responses=responses)
         
         # Step 4: Combine responses using Claude 3.7 Sonnet
         logger.info("Step 4: Combining responses")
         
-        # Only proceed if we have at least one valid response
-        if any(isinstance(resp, str) and not resp.startswith("Error") for resp in responses.values()):
-            combined_response = await combine_responses(responses)
-            sessions[session_id]["status"] = "completed"
-            sessions[session_id]["combined_response"] = combined_response
+        if has_valid_response:
+            with track_stage("combine"):
+                if STREAM_RESPONSES:
+                    # Push the combined answer to the client token by token as Claude writes it
+                    chunks = []
+                    async for delta in stream_combined_response(responses):
+                        chunks.append(delta)
+                        event_bus.publish(session_id, "delta", {"target": "combined", "text": delta})
+                    combined_response = "".join(chunks)
+                else:
+                    combined_response = await combine_responses(responses)
+            update_session(session_id, status="completed", combined_response=combined_response)
             logger.info("Processing completed successfully")
         else:
             error_msg = "Failed to get valid responses from any LLM"
-            sessions[session_id]["status"] = "error"
-            sessions[session_id]["error"] = error_msg
+            update_session(session_id, status="error", error=error_msg)
             logger.error(error_msg)
         
     except Exception as e:
@@ -138,8 +458,19 @@ async def process_prompt_async(session_id: str, prompt: str):
         error_details = traceback.format_exc()
         logger.error(f"Error processing prompt: {str(e)}")
         logger.error(error_details)
-        sessions[session_id]["status"] = "error"
-        sessions[session_id]["error"] = f"{str(e)}\n\nDetails: {error_details}"
+        update_session(session_id, status="error", error=f"{str(e)}\n\nDetails: {error_details}")
+
+async def run_job(job: Job):
+    """Job handler for the worker pool: process the prompt queued for a session, or a bulk upload."""
+    if "batch_id" in job.payload:
+        await run_prompt_batch(batch_store(), job.payload["batch_id"])
+        return
+    await process_prompt_async(job.job_id, job.payload["prompt"])
+
+# Workers for queued prompts in the API process (0 leaves them to worker.py); batch-priority
+# jobs get workers of their own, so bulk uploads can't hold every slot for hours
+worker_pool = WorkerPool(job_queue, run_job, JOB_WORKERS, priorities=(INTERACTIVE,))
+batch_worker_pool = WorkerPool(job_queue, run_job, JOB_BATCH_WORKERS, priorities=(BATCH,))
 
 if __name__ == "__main__":
     import uvicorn
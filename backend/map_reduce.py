@@ -0,0 +1,159 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+from config import (MAP_REDUCE_THRESHOLD_TOKENS, MAP_REDUCE_CHUNK_TOKENS, MAP_REDUCE_OVERLAP_TOKENS,
+                    MAP_REDUCE_CONCURRENCY, MAP_REDUCE_REDUCE_TOKENS, MAP_REDUCE_MAX_CHUNKS)
+from chunking import iter_chunks, make_excerpt, OMITTED_PATTERN
+from llm_router import route_prompt, is_error_response
+from metrics import track_stage
+from tokens import estimate_tokens
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Tokens from each end of a long text that are shown with every chunk as the request
+TASK_CONTEXT_TOKENS = 200
+
+def needs_map_reduce(content: str, threshold: int = MAP_REDUCE_THRESHOLD_TOKENS) -> bool:
+    """Whether a category's content is too long for a single specialist call."""
+    return threshold > 0 and estimate_tokens(content) > threshold
+
+def _task_context(content: str) -> str:
+    """The start and end of the content, where a request about pasted text usually is."""
+    excerpt, _ = make_excerpt(content, 2 * TASK_CONTEXT_TOKENS)
+    return OMITTED_PATTERN.sub("[... long text ...]", excerpt)
+
+def _map_prompt(task: str, index: int, chunk: str) -> str:
+    return f"""The request below is about a text too long to read at once, so it is being read in parts.
+
+Request (start and end of the original message):
+{task}
+
+Write concise notes on everything in this part that is relevant to the request: key facts,
+events, names, arguments and short quotes. Do not answer the request yet, and say so
+briefly if nothing in this part is relevant.
+
+Part {index + 1}:
+{chunk}"""
+
+def _reduce_prompt(task: str, notes: List[str], final: bool) -> str:
+    joined = "\n\n".join(f"Notes {index + 1}:\n{text}" for index, text in enumerate(notes))
+    if final:
+        instruction = ("These notes were taken from consecutive parts of the text and together cover all of it. "
+                       "Using them, respond to the request in full.")
+    else:
+        instruction = ("These notes were taken from consecutive parts of the text. Merge them into one set of "
+                       "concise notes in the same order, keeping every detail relevant to the request. "
+                       "Do not answer the request yet.")
+    return f"""Request (start and end of the original message):
+{task}
+
+{instruction}
+
+{joined}"""
+
+async def map_reduce(category: str, content: str, on_delta: Optional[Callable[[str], None]] = None,
+                     chunk_tokens: int = MAP_REDUCE_CHUNK_TOKENS, overlap_tokens: int = MAP_REDUCE_OVERLAP_TOKENS,
+                     concurrency: int = MAP_REDUCE_CONCURRENCY, reduce_tokens: int = MAP_REDUCE_REDUCE_TOKENS,
+                     max_chunks: int = MAP_REDUCE_MAX_CHUNKS) -> str:
+    """
+    Answer a category whose content is too long for one call.
+
+    The content is split into chunks that are sent to the category's specialist model
+    concurrently (map), each returning notes. Notes are merged in groups that fit one call
+    until they fit a single final call (reduce), which answers the original request.
+
+    Arguments:
+        category: The category of the content
+        content: The category's (long) content
+        on_delta: If given, the final answer is streamed and each text delta is passed to it
+        chunk_tokens: Target chunk size
+        overlap_tokens: Tokens repeated between neighbouring chunks
+        concurrency: Maximum calls in flight
+        reduce_tokens: Maximum notes merged by one call
+        max_chunks: Chunks processed at most; the rest of the text is left out
+
+    Returns:
+        The answer, or an error string in the same format route_prompt uses
+    """
+    task = _task_context(content)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def call(prompt: str) -> str:
+        async with semaphore:
+            return await route_prompt(category, prompt)
+
+    # Map: chunks are pulled from the generator only as slots free up
+    notes: Dict[int, str] = {}
+    failures = 0
+    with track_stage("map", category):
+        pending = set()
+
+        async def map_chunk(index: int, chunk: str) -> Tuple[int, str]:
+            return index, await call(_map_prompt(task, index, chunk))
+
+        def collect(done):
+            nonlocal failures
+            for task_done in done:
+                index, result = task_done.result()
+                if is_error_response(result):
+                    failures += 1
+                    logger.error(f"Chunk {index + 1} of {category} failed: {result}")
+                else:
+                    notes[index] = result
+
+        try:
+            for index, chunk in enumerate(iter_chunks(content, chunk_tokens, overlap_tokens)):
+                if index >= max_chunks:
+                    logger.warning(f"{category} content is longer than {max_chunks} chunks, leaving out the rest")
+                    break
+                if len(pending) >= max(1, concurrency):
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    collect(done)
+                pending.add(asyncio.create_task(map_chunk(index, chunk), name=f"map-{category}-{index}"))
+            if pending:
+                done, pending = await asyncio.wait(pending)
+                collect(done)
+        finally:
+            for pending_task in pending:
+                pending_task.cancel()
+
+    if not notes:
+        return f"Error processing {category}: every part of the long input failed"
+    logger.info(f"Mapped {len(notes) + failures} chunks of {category} ({failures} failed)")
+    level = [notes[index] for index in sorted(notes)]
+
+    # Reduce: merge neighbouring notes until they fit in the final call
+    with track_stage("reduce", category):
+        while len(level) > 1 and sum(estimate_tokens(text) for text in level) > reduce_tokens:
+            groups = _group_notes(level, reduce_tokens)
+            logger.info(f"Reducing {len(level)} notes of {category} into {len(groups)}")
+            merged = await asyncio.gather(*(call(_reduce_prompt(task, group, final=False)) for group in groups))
+            # A failed merge keeps its inputs for the next level rather than losing them
+            level = [text for group, result in zip(groups, merged)
+                     for text in (group if is_error_response(result) else [result])]
+            if all(is_error_response(result) for result in merged):
+                return f"Error processing {category}: could not merge the notes on the long input"
+
+        return await route_prompt(category, _reduce_prompt(task, level, final=True), on_delta=on_delta)
+
+def _group_notes(notes: List[str], reduce_tokens: int) -> List[List[str]]:
+    """Pack neighbouring notes into groups of at most `reduce_tokens`, at least two per group."""
+    groups: List[List[str]] = []
+    current: List[str] = []
+    size = 0
+    for text in notes:
+        tokens = estimate_tokens(text)
+        if len(current) >= 2 and size + tokens > reduce_tokens:
+            groups.append(current)
+            current, size = [], 0
+        current.append(text)
+        size += tokens
+    if current:
+        if len(current) == 1 and groups:
+            groups[-1].append(current[0])
+        else:
+            groups.append(current)
+    return groups
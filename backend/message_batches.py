@@ -0,0 +1,220 @@
+import asyncio
+import itertools
+import json
+import logging
+import time
+import aiohttp
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+from config import (MESSAGE_BATCHES_ENABLED, ANTHROPIC_BATCHES_URL, MESSAGE_BATCH_WINDOW,
+                    MESSAGE_BATCH_MAX_REQUESTS, MESSAGE_BATCH_POLL_INTERVAL, MESSAGE_BATCH_TIMEOUT,
+                    HTTP_REQUEST_TIMEOUT)
+from http_client import get_session
+from resilience import ProviderError, parse_retry_after
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Set for work nobody is waiting on interactively (bulk uploads); Claude calls made in
+# this context are sent through the Message Batches API, which is cheaper but slow
+deferred: ContextVar[bool] = ContextVar("deferred", default=False)
+
+# Error types in batch results that are worth submitting again
+RETRYABLE_ERRORS = ("overloaded_error", "api_error", "rate_limit_error")
+
+def deferring() -> bool:
+    """Whether Claude calls made in the current context go through the Message Batches API."""
+    return deferred.get() and message_batcher.enabled
+
+def deferred_timeout(timeout: float) -> float:
+    """The deadline for a stage: `timeout`, stretched to MESSAGE_BATCH_TIMEOUT when calls are deferred."""
+    return max(timeout, message_batcher.timeout) if deferring() else timeout
+
+class MessageBatcher:
+    """
+    Collects Anthropic Messages calls into Message Batches.
+
+    Calls submitted within `window` seconds of each other (up to `max_requests`) are sent
+    as one batch; the batch is polled until it has ended and each caller gets its own
+    message, or a ProviderError for a request that errored, expired or was canceled.
+    Batches are billed at a discount but can take minutes to hours to finish.
+    """
+
+    def __init__(self, url: str = ANTHROPIC_BATCHES_URL, enabled: bool = MESSAGE_BATCHES_ENABLED,
+                 window: float = MESSAGE_BATCH_WINDOW, max_requests: int = MESSAGE_BATCH_MAX_REQUESTS,
+                 poll_interval: float = MESSAGE_BATCH_POLL_INTERVAL, timeout: float = MESSAGE_BATCH_TIMEOUT):
+        self.url = url
+        self.enabled = enabled
+        self.window = window
+        self.max_requests = max(1, max_requests)
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+        self._pending: List[Tuple[str, Dict, asyncio.Future]] = []
+        self._headers: Dict[str, str] = {}
+        self._timer: Optional[asyncio.Task] = None
+        self._batches: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.requests = 0
+        self.succeeded = 0
+        self.errored = 0
+
+    async def submit(self, params: Dict, headers: Dict[str, str]) -> Dict:
+        """
+        Send one Messages request as part of the next batch and wait for its result.
+
+        Arguments:
+            params: The request body, as for the Messages API
+            headers: Request headers (API key and version) for the batch calls
+
+        Returns:
+            The message object, as the Messages API would return it
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((f"req-{next(self._ids)}", params, future))
+        self._headers = headers
+        self.requests += 1
+        if len(self._pending) >= self.max_requests:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later(), name="message-batch-window")
+        # A cancelled caller only stops waiting; its request stays in the batch
+        return await future
+
+    async def stop(self):
+        """Stop waiting on batches in progress; their callers get a ProviderError."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        requests, self._pending = self._pending, []
+        _fail(requests, ProviderError("claude", "Message batch abandoned at shutdown", retryable=True))
+        for batch in list(self._batches):
+            batch.cancel()
+        await asyncio.gather(*self._batches, return_exceptions=True)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": self.enabled,
+            "collecting": len(self._pending),
+            "batches_in_progress": len(self._batches),
+            "batches": self.batches,
+            "requests": self.requests,
+            "succeeded": self.succeeded,
+            "errored": self.errored,
+        }
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        requests, self._pending = self._pending, []
+        if not requests:
+            return
+        task = asyncio.create_task(self._run_batch(requests, self._headers), name="message-batch")
+        self._batches.add(task)
+        task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(self, requests: List[Tuple[str, Dict, asyncio.Future]], headers: Dict[str, str]):
+        try:
+            batch = await self._create(requests, headers)
+            self.batches += 1
+            logger.info(f"Sent message batch {batch['id']} with {len(requests)} requests")
+            deadline = time.monotonic() + self.timeout
+            while batch.get("processing_status") != "ended":
+                if time.monotonic() > deadline:
+                    raise ProviderError("claude", f"Message batch {batch['id']} did not end within {self.timeout}s",
+                                        retryable=False)
+                await asyncio.sleep(self.poll_interval)
+                try:
+                    batch = await self._get_json(f"{self.url}/{batch['id']}", headers)
+                except (ProviderError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # The batch runs on regardless; check again at the next interval
+                    logger.warning(f"Error polling message batch {batch['id']}: {str(e)}")
+
+            futures = {custom_id: future for custom_id, _, future in requests}
+            async for line in self._results(batch, headers):
+                self._resolve(futures.pop(line.get("custom_id"), None), line.get("result") or {})
+            _fail([(custom_id, None, future) for custom_id, future in futures.items()],
+                  ProviderError("claude", f"Message batch {batch['id']} has no result for the request", retryable=True))
+            logger.info(f"Message batch {batch['id']} ended")
+        except asyncio.CancelledError:
+            _fail(requests, ProviderError("claude", "Message batch abandoned", retryable=True))
+            raise
+        except Exception as e:
+            logger.error(f"Message batch failed: {str(e)}")
+            error = e if isinstance(e, ProviderError) else ProviderError("claude", f"Message batch failed: {str(e)}",
+                                                                          retryable=True)
+            _fail(requests, error)
+
+    async def _create(self, requests: List[Tuple[str, Dict, asyncio.Future]], headers: Dict[str, str]) -> Dict:
+        session = await get_session()
+        body = {"requests": [{"custom_id": custom_id, "params": params} for custom_id, params, _ in requests]}
+        async with session.post(self.url, headers=headers, json=body) as response:
+            await _raise_for_status(response)
+            return await response.json()
+
+    async def _get_json(self, url: str, headers: Dict[str, str]) -> Dict:
+        session = await get_session()
+        async with session.get(url, headers=headers) as response:
+            await _raise_for_status(response)
+            return await response.json()
+
+    async def _results(self, batch: Dict, headers: Dict[str, str]) -> AsyncIterator[Dict]:
+        """Yield the lines of a batch's JSONL results file without holding all of it in memory."""
+        session = await get_session()
+        url = batch.get("results_url") or f"{self.url}/{batch['id']}/results"
+        # The file can take longer than one API call to download, but shouldn't stall
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=HTTP_REQUEST_TIMEOUT)
+        async with session.get(url, headers=headers, timeout=timeout) as response:
+            await _raise_for_status(response)
+            buffer = b""
+            async for chunk in response.content.iter_any():
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+            if buffer.strip():
+                yield json.loads(buffer)
+
+    def _resolve(self, future: Optional[asyncio.Future], result: Dict):
+        if result.get("type") == "succeeded":
+            self.succeeded += 1
+            if future is not None and not future.done():
+                future.set_result(result.get("message") or {})
+            return
+        self.errored += 1
+        if result.get("type") == "errored":
+            error = (result.get("error") or {}).get("error") or result.get("error") or {}
+            exception = ProviderError("claude", f"Error from Claude API (message batch): {error.get('message', error)}",
+                                      retryable=error.get("type") in RETRYABLE_ERRORS)
+        else:
+            # "canceled" or "expired": the request never ran
+            exception = ProviderError("claude", f"Message batch request {result.get('type', 'lost')}", retryable=True)
+        if future is not None and not future.done():
+            future.set_exception(exception)
+
+def _fail(requests: List[Tuple[str, Optional[Dict], asyncio.Future]], error: Exception):
+    for _, _, future in requests:
+        if not future.done():
+            future.set_exception(error)
+
+async def _raise_for_status(response):
+    if response.status != 200:
+        error_text = await response.text()
+        raise ProviderError(
+            "claude",
+            f"Error from Claude Message Batches API (Status {response.status}): {error_text}",
+            status=response.status,
+            retry_after=parse_retry_after(response.headers.get("retry-after"))
+        )
+
+# Shared batcher for deferred Claude calls
+message_batcher = MessageBatcher()
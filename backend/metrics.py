@@ -0,0 +1,257 @@
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+from session_store import current_session_id
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+def _label_key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Counter:
+    """Monotonic counter with labels, rendered in the Prometheus text format."""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value:g}")
+        return lines
+
+class Histogram:
+    """Cumulative-bucket histogram with labels, rendered in the Prometheus text format."""
+
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [counts per bucket (+Inf last), sum]
+        self._series: Dict[LabelKey, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', f'{bound:g}'))} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total:g}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+STAGE_SECONDS = Histogram("llm_router_stage_seconds", "Time spent in each pipeline stage")
+CALL_SECONDS = Histogram("llm_router_provider_call_seconds", "Total latency of provider calls")
+CALL_TTFB_SECONDS = Histogram("llm_router_provider_ttfb_seconds", "Time to first byte (or first streamed token) of provider calls")
+CALL_INPUT_TOKENS = Histogram("llm_router_provider_input_tokens", "Input tokens per provider call, from the API usage fields", TOKEN_BUCKETS)
+CALL_OUTPUT_TOKENS = Histogram("llm_router_provider_output_tokens", "Output tokens per provider call, from the API usage fields", TOKEN_BUCKETS)
+CALLS = Counter("llm_router_provider_calls_total", "Provider call attempts by outcome")
+RETRIES = Counter("llm_router_provider_retries_total", "Provider calls retried after a transient failure")
+QUEUE_WAIT_SECONDS = Histogram("llm_router_queue_wait_seconds", "Time spent waiting for rate limit or concurrency slots")
+CACHE_LOOKUPS = Counter("llm_router_cache_lookups_total", "Response cache lookups by result")
+COALESCED = Counter("llm_router_coalesced_calls_total", "Provider calls that joined an identical call already in flight")
+HEDGES = Counter("llm_router_hedges_total", "Hedged specialist calls by outcome (won, lost, denied by budget)")
+PROMPT_CACHE_TOKENS = Counter("llm_router_prompt_cache_tokens_total", "Input tokens read from or written to the provider's prompt cache")
+ADMISSIONS = Counter("llm_router_admissions_total", "Submitted jobs by admission decision (admitted, queue_full, client_limit)")
+
+REGISTRY = [STAGE_SECONDS, CALL_SECONDS, CALL_TTFB_SECONDS, CALL_INPUT_TOKENS, CALL_OUTPUT_TOKENS,
+            CALLS, RETRIES, QUEUE_WAIT_SECONDS, CACHE_LOOKUPS, COALESCED, HEDGES, PROMPT_CACHE_TOKENS,
+            ADMISSIONS]
+
+class SessionMetrics:
+    """Per-session totals of the same measurements, returned with the session."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages: Dict[str, float] = {}
+        self.calls: Dict[str, Dict[str, float]] = {}
+        self.retries = 0
+        self.queue_wait = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.coalesced = 0
+
+    def add_call(self, provider: str, model: str, latency: float, ttfb: Optional[float],
+                 input_tokens: int, output_tokens: int, outcome: str,
+                 cache_read_tokens: int = 0, cache_write_tokens: int = 0):
+        call = self.calls.setdefault(f"{provider}:{model}", {
+            "calls": 0, "errors": 0, "latency": 0.0, "max_ttfb": 0.0, "input_tokens": 0, "output_tokens": 0,
+            "cache_read_tokens": 0, "cache_write_tokens": 0,
+        })
+        call["calls"] += 1
+        call["errors"] += outcome != "ok"
+        call["latency"] = round(call["latency"] + latency, 3)
+        if ttfb is not None:
+            call["max_ttfb"] = round(max(call["max_ttfb"], ttfb), 3)
+        call["input_tokens"] += input_tokens
+        call["output_tokens"] += output_tokens
+        call["cache_read_tokens"] += cache_read_tokens
+        call["cache_write_tokens"] += cache_write_tokens
+
+    def to_dict(self) -> Dict:
+        return {
+            "elapsed": round(time.monotonic() - self.started, 3),
+            "stages": {stage: round(seconds, 3) for stage, seconds in self.stages.items()},
+            "calls": self.calls,
+            "input_tokens": sum(call["input_tokens"] for call in self.calls.values()),
+            "output_tokens": sum(call["output_tokens"] for call in self.calls.values()),
+            "cache_read_tokens": sum(call["cache_read_tokens"] for call in self.calls.values()),
+            "cache_write_tokens": sum(call["cache_write_tokens"] for call in self.calls.values()),
+            "retries": self.retries,
+            "queue_wait": round(self.queue_wait, 3),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "coalesced": self.coalesced,
+        }
+
+# Live metrics for sessions still being processed, keyed by session id
+_sessions: Dict[str, SessionMetrics] = {}
+
+def _current() -> Optional[SessionMetrics]:
+    session_id = current_session_id.get()
+    if session_id is None:
+        return None
+    # Only sessions between start_session() and finish_session() are tracked
+    return _sessions.get(session_id)
+
+def observe_stage(stage: str, seconds: float, category: Optional[str] = None):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    session = _current()
+    if session is not None:
+        # Per-category stages run concurrently, so the session keeps them apart
+        name = f"{stage}:{category}" if category else stage
+        session.stages[name] = session.stages.get(name, 0.0) + seconds
+
+@contextmanager
+def track_stage(stage: str, category: Optional[str] = None) -> Iterator[None]:
+    """Time the enclosed block as one pipeline stage of the current session."""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.monotonic() - started, category)
+
+def observe_call(provider: str, model: str, latency: float, ttfb: Optional[float] = None,
+                 input_tokens: int = 0, output_tokens: int = 0, outcome: str = "ok",
+                 cache_read_tokens: int = 0, cache_write_tokens: int = 0):
+    """
+    Record one provider call attempt.
+
+    Arguments:
+        provider: Provider name
+        model: Model name
+        latency: Seconds from sending the request to reading the whole reply
+        ttfb: Seconds until the response headers (or the first streamed token) arrived
+        input_tokens: Input tokens reported by the API (for Anthropic, excluding prompt cache reads and writes)
+        output_tokens: Output tokens reported by the API
+        outcome: "ok", or a short error label such as the HTTP status
+        cache_read_tokens: Input tokens served from the provider's prompt cache
+        cache_write_tokens: Input tokens written to the provider's prompt cache
+    """
+    CALLS.inc(provider=provider, model=model, outcome=outcome)
+    CALL_SECONDS.observe(latency, provider=provider, model=model)
+    if ttfb is not None:
+        CALL_TTFB_SECONDS.observe(ttfb, provider=provider, model=model)
+    if input_tokens or output_tokens:
+        CALL_INPUT_TOKENS.observe(input_tokens, provider=provider, model=model)
+        CALL_OUTPUT_TOKENS.observe(output_tokens, provider=provider, model=model)
+    if cache_read_tokens:
+        PROMPT_CACHE_TOKENS.inc(cache_read_tokens, provider=provider, model=model, kind="read")
+    if cache_write_tokens:
+        PROMPT_CACHE_TOKENS.inc(cache_write_tokens, provider=provider, model=model, kind="write")
+    session = _current()
+    if session is not None:
+        session.add_call(provider, model, latency, ttfb, input_tokens, output_tokens, outcome,
+                         cache_read_tokens, cache_write_tokens)
+
+def count_retry(provider: str):
+    RETRIES.inc(provider=provider)
+    session = _current()
+    if session is not None:
+        session.retries += 1
+
+def observe_queue_wait(queue: str, seconds: float):
+    QUEUE_WAIT_SECONDS.observe(seconds, queue=queue)
+    session = _current()
+    if session is not None:
+        session.queue_wait += seconds
+
+def count_cache_lookup(hit: bool):
+    CACHE_LOOKUPS.inc(result="hit" if hit else "miss")
+    session = _current()
+    if session is not None:
+        if hit:
+            session.cache_hits += 1
+        else:
+            session.cache_misses += 1
+
+def count_coalesced(kind: str):
+    COALESCED.inc(kind=kind)
+    session = _current()
+    if session is not None:
+        session.coalesced += 1
+
+def count_hedge(outcome: str):
+    HEDGES.inc(outcome=outcome)
+
+def count_admission(outcome: str, priority: str):
+    ADMISSIONS.inc(outcome=outcome, priority=priority)
+
+def start_session(session_id: str):
+    """Start collecting metrics for a session; its elapsed time counts from here."""
+    _sessions[session_id] = SessionMetrics()
+
+def session_metrics(session_id: str) -> Optional[Dict]:
+    """Metrics collected so far for a session that is still being processed."""
+    session = _sessions.get(session_id)
+    return session.to_dict() if session is not None else None
+
+def finish_session(session_id: str) -> Optional[Dict]:
+    """Stop tracking a session and return its final metrics."""
+    session = _sessions.pop(session_id, None)
+    if session is None:
+        return None
+    result = session.to_dict()
+    STAGE_SECONDS.observe(result["elapsed"], stage="total")
+    return result
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
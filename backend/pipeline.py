@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Collection, Dict, Optional, Tuple
+from config import GENERATE_CONCURRENCY, GENERATE_TIMEOUT, GENERATE_BATCHED, ROUTE_TOTAL_TIMEOUT, MAP_REDUCE_TIMEOUT
+from llm_router import (generate_prompt_with_fallback, generate_structured_prompts_batch, route_prompt,
+                        is_error_response)
+from map_reduce import needs_map_reduce, map_reduce
+from message_batches import deferred_timeout
+from metrics import track_stage, observe_queue_wait
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Called as on_update(category, stage, value) whenever a category moves to a new stage.
+# Stages: "generating", "routing" (value is the generated prompt), "completed" or "error"
+# (value is the LLM response).
+UpdateCallback = Callable[[str, str, Optional[str]], None]
+
+# Called as on_delta(category, text) for each chunk of a specialist reply while it streams
+DeltaCallback = Callable[[str, str], None]
+
+async def run_category_pipelines(parsed_categories: Dict[str, str],
+                                 on_update: Optional[UpdateCallback] = None,
+                                 on_delta: Optional[DeltaCallback] = None,
+                                 concurrency: Optional[int] = None,
+                                 total_timeout: Optional[float] = None,
+                                 batched: Optional[bool] = None,
+                                 rewrite: Optional[Collection[str]] = None) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Run generate -> route for every applicable category as its own pipeline.
+
+    Each category moves on to its specialist LLM as soon as its own structured prompt is
+    ready instead of waiting for every other category, so a session costs roughly one
+    critical path rather than the slowest stage times the number of categories. Progress
+    and results are reported through `on_update` as they happen. Categories whose content
+    is too long for one call skip generation and are answered by map_reduce() instead.
+
+    Arguments:
+        parsed_categories: Dictionary with categories as keys and extracted content as values
+        on_update: Optional callback receiving (category, stage, value) on every transition
+        on_delta: Optional callback receiving (category, text); when given, specialist replies are streamed
+        concurrency: Maximum number of generation calls in flight (defaults to GENERATE_CONCURRENCY)
+        total_timeout: Seconds allowed for all pipelines (defaults to GENERATE_TIMEOUT + ROUTE_TOTAL_TIMEOUT,
+            or MAP_REDUCE_TIMEOUT if that is longer and a category needs map-reduce)
+        batched: Generate every category's prompt in one call first (defaults to GENERATE_BATCHED)
+        rewrite: Categories to generate structured prompts for; the others are routed with their
+            parsed content as-is (defaults to every category)
+
+    Returns:
+        Tuple of (generated prompts, responses), both keyed by category
+    """
+    if concurrency is None:
+        concurrency = GENERATE_CONCURRENCY
+    if batched is None:
+        batched = GENERATE_BATCHED
+
+    applicable = {category: content for category, content in parsed_categories.items()
+                  if content != "Not Applicable"}
+    long_inputs = {category for category, content in applicable.items() if needs_map_reduce(content)}
+    if total_timeout is None:
+        total_timeout = GENERATE_TIMEOUT + ROUTE_TOTAL_TIMEOUT
+        if long_inputs:
+            total_timeout = max(total_timeout, MAP_REDUCE_TIMEOUT)
+        total_timeout = deferred_timeout(total_timeout)
+    if rewrite is None:
+        rewrite = applicable.keys()
+    # Categories that skip generation start out with their parsed content as the prompt
+    prompts = {category: None if category in rewrite else content for category, content in applicable.items()}
+    generated_prompts = {}
+    responses = {}
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    def report(category: str, stage: str, value: Optional[str] = None):
+        if on_update is not None:
+            try:
+                on_update(category, stage, value)
+            except Exception as e:
+                logger.error(f"Error reporting progress for {category}: {str(e)}")
+
+    async def run(category: str, content: str, prompt: Optional[str] = None):
+        if category in long_inputs:
+            await run_long(category, content)
+            return
+        if prompt is None and category in batched_prompts:
+            # Shielded: every category waits on the one call, so one giving up mustn't cancel it for the rest
+            prompt = (await asyncio.shield(batch))[category]
+        if prompt is None:
+            report(category, "generating")
+            queued = time.monotonic()
+            async with semaphore:
+                observe_queue_wait("generate", time.monotonic() - queued)
+                with track_stage("generate", category):
+                    prompt = await generate_prompt_with_fallback(category, content)
+
+        generated_prompts[category] = prompt
+        report(category, "routing", prompt)
+
+        with track_stage("route", category):
+            if on_delta is not None:
+                response = await route_prompt(category, prompt, on_delta=lambda text: on_delta(category, text))
+            else:
+                response = await route_prompt(category, prompt)
+        responses[category] = response
+        report(category, "error" if is_error_response(response) else "completed", response)
+
+    async def run_long(category: str, content: str):
+        # The content itself is the prompt; it is too long to be worth rewriting first
+        generated_prompts[category] = content
+        report(category, "routing", content)
+
+        with track_stage("route", category):
+            response = await map_reduce(category, content,
+                                        on_delta=(lambda text: on_delta(category, text)) if on_delta is not None else None)
+        responses[category] = response
+        report(category, "error" if is_error_response(response) else "completed", response)
+
+    if not applicable:
+        return generated_prompts, responses
+
+    to_generate = {category: content for category, content in applicable.items()
+                   if prompts[category] is None and category not in long_inputs}
+    batched_prompts = to_generate if batched and len(to_generate) > 1 else {}
+
+    async def generate_batch() -> Dict[str, str]:
+        with track_stage("generate", "batch"):
+            return await generate_structured_prompts_batch(batched_prompts)
+
+    # The batched call runs under the same deadline as the pipelines, and the categories
+    # that don't need it start routing meanwhile
+    batch = None
+    if batched_prompts:
+        for category in batched_prompts:
+            report(category, "generating")
+        batch = asyncio.create_task(generate_batch(), name="pipeline-generate-batch")
+    tasks = [asyncio.create_task(run(category, content, prompts[category]), name=f"pipeline-{category}")
+             for category, content in applicable.items()]
+    started = tasks + ([batch] if batch is not None else [])
+
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=total_timeout)
+    finally:
+        for task in started:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*started, return_exceptions=True)
+
+    for category, task in zip(applicable, tasks):
+        if task in done and task.exception() is not None:
+            logger.error(f"Error processing {category}: {str(task.exception())}")
+            generated_prompts.setdefault(category, applicable[category])
+            responses[category] = f"Error processing {category}: {str(task.exception())}"
+            report(category, "error", responses[category])
+
+    for category, content in applicable.items():
+        if category not in responses:
+            logger.error(f"Pipeline for {category} did not finish within {total_timeout}s")
+            generated_prompts.setdefault(category, content)
+            responses[category] = f"Error processing {category}: timed out after {total_timeout} seconds"
+            report(category, "error", responses[category])
+
+    return generated_prompts, responses
@@ -0,0 +1,59 @@
+import logging
+from dataclasses import dataclass, asdict
+from typing import Dict, List
+from config import PLANNER_FAST_PATH, PLANNER_REWRITE_MIN_TOKENS
+from tokens import estimate_tokens
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+@dataclass(slots=True)
+class Plan:
+    """Which pipeline stages a session runs after parsing."""
+    name: str
+    categories: List[str]
+    rewrite: List[str]
+    combine: bool
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+def plan_session(parsed_categories: Dict[str, str],
+                 fast_path: bool = PLANNER_FAST_PATH,
+                 rewrite_min_tokens: int = PLANNER_REWRITE_MIN_TOKENS) -> Plan:
+    """
+    Decide which stages are worth running for a parsed prompt.
+
+    Categories whose content is shorter than `rewrite_min_tokens` are sent to their
+    specialist as-is instead of through structured prompt generation, and a single
+    category's answer is returned directly rather than "combined" with nothing.
+
+    Arguments:
+        parsed_categories: Dictionary with categories as keys and extracted content as values
+        fast_path: Allow skipping stages at all; when False every session runs the full pipeline
+        rewrite_min_tokens: Estimated tokens below which a category's prompt isn't rewritten
+
+    Returns:
+        The plan, with the applicable categories and the ones to rewrite
+    """
+    categories = [category for category, content in parsed_categories.items()
+                  if content != "Not Applicable"]
+
+    if not fast_path:
+        return Plan("full", categories, list(categories), combine=bool(categories))
+
+    rewrite = [category for category in categories
+               if estimate_tokens(parsed_categories[category]) >= rewrite_min_tokens]
+
+    if not categories:
+        plan = Plan("empty", categories, rewrite, combine=False)
+    elif len(categories) == 1:
+        plan = Plan("single" if rewrite else "direct", categories, rewrite, combine=False)
+    else:
+        plan = Plan("full" if len(rewrite) == len(categories) else "partial_rewrite",
+                    categories, rewrite, combine=True)
+
+    logger.info(f"Plan {plan.name}: categories={plan.categories} rewrite={plan.rewrite} combine={plan.combine}")
+    return plan
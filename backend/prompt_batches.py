@@ -0,0 +1,244 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from config import PROMPT_BATCH_DB_PATH, PROMPT_BATCH_CONCURRENCY
+from cache import normalize_prompt
+from prompt_parser import parse_prompt
+from planner import plan_session
+from pipeline import run_category_pipelines, is_error_response
+from api_integration import combine_responses
+from message_batches import deferred
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Item states; finished items keep their result for download
+PENDING, COMPLETED, ERROR = "pending", "completed", "error"
+
+@dataclass(slots=True)
+class BatchUpload:
+    """A parsed JSONL upload: unique prompts, each with the ids of the lines that asked it."""
+    prompts: List[str] = field(default_factory=list)
+    custom_ids: List[List[str]] = field(default_factory=list)
+    lines: int = 0
+
+    @property
+    def batch_id(self) -> str:
+        """Derived from the content, so uploading the same file again resumes the same batch."""
+        digest = hashlib.sha256()
+        for prompt, ids in zip(self.prompts, self.custom_ids):
+            digest.update(json.dumps([prompt, ids]).encode("utf-8"))
+        return f"pb_{digest.hexdigest()[:24]}"
+
+def parse_upload(body: str) -> BatchUpload:
+    """
+    Read a JSONL upload of prompts and merge duplicates.
+
+    Each line is an object with a "prompt" (or a "title" and "body", as in a request
+    backlog) and optionally an id in "custom_id", "id" or "request_id". Identical prompts (up to
+    line endings and outer whitespace) are processed once and their result is returned for
+    every line; any other difference, such as indentation, keeps them apart.
+
+    Raises:
+        ValueError: if a line is not a JSON object with a prompt, or an id is repeated
+    """
+    upload = BatchUpload()
+    index_by_key: Dict[str, int] = {}
+    seen_ids = set()
+    for number, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {number} is not valid JSON: {str(e)}")
+        if not isinstance(record, dict):
+            raise ValueError(f"Line {number} is not a JSON object")
+        prompt = record.get("prompt")
+        if prompt is None and record.get("body"):
+            prompt = "\n\n".join(str(part) for part in (record.get("title"), record["body"]) if part)
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise ValueError(f"Line {number} has no prompt")
+        custom_id = str(record.get("custom_id") or record.get("id") or record.get("request_id") or f"line-{number}")
+        if custom_id in seen_ids:
+            raise ValueError(f"Line {number} repeats the id {custom_id!r}")
+        seen_ids.add(custom_id)
+
+        upload.lines += 1
+        key = normalize_prompt(prompt)
+        if key in index_by_key:
+            upload.custom_ids[index_by_key[key]].append(custom_id)
+        else:
+            index_by_key[key] = len(upload.prompts)
+            upload.prompts.append(prompt)
+            upload.custom_ids.append([custom_id])
+    return upload
+
+class PromptBatchStore:
+    """
+    Uploaded batches and their results in SQLite, so an interrupted batch resumes where it
+    stopped and finished results can be downloaded (again) at any time.
+    """
+
+    def __init__(self, path: str = PROMPT_BATCH_DB_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            "batch_id TEXT PRIMARY KEY, lines INTEGER NOT NULL, created_at REAL NOT NULL, finished_at REAL)"
+        )
+        # `seq` numbers results in the order they finished, for resumable downloads
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS batch_items ("
+            "batch_id TEXT NOT NULL, item_index INTEGER NOT NULL, prompt TEXT NOT NULL, custom_ids TEXT NOT NULL, "
+            "status TEXT NOT NULL, result TEXT, seq INTEGER, PRIMARY KEY (batch_id, item_index))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS batch_items_seq ON batch_items (batch_id, seq)")
+
+    def create(self, upload: BatchUpload) -> bool:
+        """Store a new batch; False if a batch with the same content already exists."""
+        batch_id = upload.batch_id
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._conn.execute("SELECT 1 FROM batches WHERE batch_id = ?", (batch_id,)).fetchone():
+                    self._conn.execute("COMMIT")
+                    return False
+                self._conn.execute("INSERT INTO batches (batch_id, lines, created_at) VALUES (?, ?, ?)",
+                                   (batch_id, upload.lines, time.time()))
+                self._conn.executemany(
+                    "INSERT INTO batch_items (batch_id, item_index, prompt, custom_ids, status) VALUES (?, ?, ?, ?, ?)",
+                    ((batch_id, index, prompt, json.dumps(ids), PENDING)
+                     for index, (prompt, ids) in enumerate(zip(upload.prompts, upload.custom_ids)))
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return True
+
+    def retry_errors(self, batch_id: str) -> int:
+        """Put a batch's failed items back to pending; returns how many there were."""
+        with self._lock:
+            retried = self._conn.execute(
+                "UPDATE batch_items SET status = ?, result = NULL, seq = NULL WHERE batch_id = ? AND status = ?",
+                (PENDING, batch_id, ERROR)
+            ).rowcount
+            if retried:
+                self._conn.execute("UPDATE batches SET finished_at = NULL WHERE batch_id = ?", (batch_id,))
+        return retried
+
+    def summary(self, batch_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT lines, created_at, finished_at FROM batches WHERE batch_id = ?",
+                                     (batch_id,)).fetchone()
+            if row is None:
+                return None
+            counts = dict(self._conn.execute(
+                "SELECT status, COUNT(*) FROM batch_items WHERE batch_id = ? GROUP BY status", (batch_id,)
+            ).fetchall())
+        unique = sum(counts.values())
+        return {
+            "batch_id": batch_id,
+            "status": "completed" if row[2] is not None else "running",
+            "lines": row[0],
+            "unique_prompts": unique,
+            "duplicates": row[0] - unique,
+            "pending": counts.get(PENDING, 0),
+            "completed": counts.get(COMPLETED, 0),
+            "errors": counts.get(ERROR, 0),
+            "created_at": row[1],
+            "finished_at": row[2],
+        }
+
+    def pending_items(self, batch_id: str) -> List[Tuple[int, str]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT item_index, prompt FROM batch_items WHERE batch_id = ? AND status = ? ORDER BY item_index",
+                (batch_id, PENDING)
+            ).fetchall()
+
+    def finish_item(self, batch_id: str, index: int, result: Dict):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE batch_items SET status = ?, result = ?, "
+                "seq = (SELECT COALESCE(MAX(seq), 0) + 1 FROM batch_items WHERE batch_id = ?) "
+                "WHERE batch_id = ? AND item_index = ?",
+                (result["status"], json.dumps(result), batch_id, batch_id, index)
+            )
+
+    def finish(self, batch_id: str):
+        with self._lock:
+            self._conn.execute("UPDATE batches SET finished_at = ? WHERE batch_id = ?", (time.time(), batch_id))
+
+    def results(self, batch_id: str, after: int = 0, limit: int = 500) -> List[Tuple[int, List[str], Dict]]:
+        """Finished items after result number `after`, as (seq, custom ids, result)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, custom_ids, result FROM batch_items WHERE batch_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (batch_id, after, limit)
+            ).fetchall()
+        return [(seq, json.loads(custom_ids), json.loads(result)) for seq, custom_ids, result in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def unfinished(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT batch_id FROM batches WHERE finished_at IS NULL")]
+
+async def run_prompt_batch(store: PromptBatchStore, batch_id: str, concurrency: int = PROMPT_BATCH_CONCURRENCY):
+    """
+    Process a batch's pending prompts, `concurrency` at a time.
+
+    Claude calls are deferred to the Message Batches API (when enabled), so every prompt
+    that reaches the same stage within a batching window shares one batch. Each result is
+    stored as soon as its prompt finishes; running this again only processes what is left.
+    Store calls run in threads: a write can wait on another process's lock.
+    """
+    token = deferred.set(True)
+    try:
+        pending = await asyncio.to_thread(store.pending_items, batch_id)
+        logger.info(f"Processing {len(pending)} pending prompts of batch {batch_id}")
+        items = iter(pending)
+
+        async def work():
+            for index, prompt in items:
+                result = await process_batch_prompt(prompt)
+                await asyncio.to_thread(store.finish_item, batch_id, index, result)
+
+        await asyncio.gather(*(work() for _ in range(max(1, min(concurrency, len(pending))))))
+        await asyncio.to_thread(store.finish, batch_id)
+    finally:
+        deferred.reset(token)
+    logger.info(f"Finished batch {batch_id}")
+
+async def process_batch_prompt(prompt: str) -> Dict:
+    """Run one prompt through the pipeline without a session or streaming; returns its result line."""
+    try:
+        parsed_categories = await parse_prompt(prompt)
+        plan = plan_session(parsed_categories)
+        _, responses = await run_category_pipelines(parsed_categories, rewrite=plan.rewrite)
+        if not any(isinstance(resp, str) and not is_error_response(resp) for resp in responses.values()):
+            return {"status": ERROR, "error": "Failed to get valid responses from any LLM", "responses": responses}
+        if plan.combine:
+            response = await combine_responses(responses)
+        else:
+            response = next(iter(responses.values()))
+        return {"status": COMPLETED, "response": response, "plan": plan.name, "categories": plan.categories}
+    except Exception as e:
+        logger.error(f"Error processing batch prompt: {str(e)}")
+        return {"status": ERROR, "error": str(e)}
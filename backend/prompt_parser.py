@@ -1,7 +1,11 @@
-import aiohttp
 import json
 from typing import Dict
-from config import API_KEYS
+from config import API_KEYS, RETRY_MAX_ATTEMPTS, MAP_REDUCE_THRESHOLD_TOKENS, PARSE_EXCERPT_TOKENS
+from providers import anthropic_message
+from resilience import backoff_delay
+from classifier import prompt_classifier
+from tokens import estimate_tokens
+from chunking import make_excerpt, restore_excerpt
 import asyncio
 import traceback
 import os
@@ -12,6 +16,17 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+def extract_json_object(response_text: str) -> Dict[str, str]:
+    """Extract a JSON object from a model reply, even if it's wrapped in ```json ``` or other formatting."""
+    if "```json" in response_text:
+        json_text = response_text.split("```json")[1].split("```")[0].strip()
+    elif "```" in response_text:
+        json_text = response_text.split("```")[1].split("```")[0].strip()
+    else:
+        json_text = response_text.strip()
+    
+    return json.loads(json_text)
+
 async def parse_prompt(prompt: str) -> Dict[str, str]:
     """
     Parse the user prompt into different categories using Claude 3.7 Sonnet.
@@ -39,94 +54,75 @@ async def parse_prompt(prompt: str) -> Dict[str, str]:
     
     Provide only the JSON object in your response with no additional text."""
     
-    # Number of retry attempts
-    max_retries = 3
-    retry_delay = 2  # seconds
+    # Transient API failures are retried inside anthropic_message; this loop only
+    # re-asks when the model's reply isn't valid JSON
+    max_retries = RETRY_MAX_ATTEMPTS
+    fallback = {
+        "general_knowledge": prompt,
+        "mathematics": "Not Applicable",
+        "coding": "Not Applicable",
+        "literature": "Not Applicable"
+    }
+    
+    # Obviously single-category prompts (a code snippet, a bare sum) don't need the LLM
+    classification = prompt_classifier.classify(prompt)
+    logger.info(f"Local classifier: {classification.category} (confidence {classification.confidence})")
+    if prompt_classifier.should_bypass(classification):
+        return classification.as_categories(prompt)
     
     # Check if API key exists
     if not API_KEYS.get("claude"):
         logger.error("Claude API key is missing")
-        return {
-            "general_knowledge": prompt,
-            "mathematics": "Not Applicable",
-            "coding": "Not Applicable",
-            "literature": "Not Applicable"
-        }
+        return fallback
+    
+    # A long prompt is parsed from its start and end only; copying all of it into the reply
+    # would blow the token limit. The middle goes back into whichever category held it.
+    excerpt, omitted = prompt, (len(prompt), len(prompt))
+    if estimate_tokens(prompt) > MAP_REDUCE_THRESHOLD_TOKENS:
+        excerpt, omitted = make_excerpt(prompt, PARSE_EXCERPT_TOKENS)
+        logger.info(f"Parsing an excerpt of a {estimate_tokens(prompt)}-token prompt")
+    
+    # The reply restates the prompt split up, so it's never much longer than the prompt
+    max_tokens = min(1024, 2 * estimate_tokens(excerpt) + 128)
     
     for attempt in range(max_retries):
         try:
             logger.info(f"Parsing prompt attempt {attempt+1}/{max_retries}")
-            # Call Claude 3.7 Sonnet API
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    "https://api.anthropic.com/v1/messages",
-                    headers={
-                        "x-api-key": API_KEYS["claude"],
-                        "anthropic-version": "2023-06-01",
-                        "content-type": "application/json"
-                    },
-                    json={
-                        "model": "claude-3-7-sonnet-20250219",
-                        "max_tokens": 1024,
-                        "system": system_prompt,
-                        "messages": [
-                            {"role": "user", "content": prompt}
-                        ],
-                        "temperature": 0.2
-                    },
-                    timeout=aiohttp.ClientTimeout(total=30)  # 30 second timeout
-                ) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"API Error (Status {response.status}): {error_text}")
-                        raise ValueError(f"API returned status code {response.status}: {error_text}")
-                    
-                    result = await response.json()
-                    logger.info("Successfully received response from Claude API")
-            
-            # Extract and parse the JSON response
-            try:
-                response_text = result["content"][0]["text"]
-                logger.info(f"Raw response: {response_text[:100]}...")
-                
-                # Extract JSON object if it's wrapped in ```json ``` or other formatting
-                if "```json" in response_text:
-                    json_text = response_text.split("```json")[1].split("```")[0].strip()
-                elif "```" in response_text:
-                    json_text = response_text.split("```")[1].split("```")[0].strip()
-                else:
-                    json_text = response_text.strip()
-                
-                categories = json.loads(json_text)
-                
-                # Ensure all expected categories are present
-                for category in ["general_knowledge", "mathematics", "coding", "literature"]:
-                    if category not in categories:
-                        categories[category] = "Not Applicable"
-                
-                return categories
-                
-            except (KeyError, IndexError, json.JSONDecodeError) as e:
-                logger.error(f"Error parsing response: {e}")
-                logger.error(f"Response content: {result}")
-                if attempt < max_retries - 1:
-                    logger.info(f"Retrying in {retry_delay} seconds...")
-                    await asyncio.sleep(retry_delay)
-                else:
-                    raise e
-                
+            # Call Claude 3.7 Sonnet API; bypass the cache after a bad reply so we don't get it back
+            response_text = await anthropic_message(
+                "claude-3-7-sonnet-20250219",
+                system_prompt,
+                excerpt,
+                max_tokens=max_tokens,
+                temperature=0.2,
+                refresh=attempt > 0
+            )
+            logger.info("Successfully received response from Claude API")
         except Exception as e:
-            logger.error(f"API connection error (attempt {attempt+1}/{max_retries}): {str(e)}")
+            logger.error(f"Failed to get a response from Claude API: {str(e)}")
             traceback.print_exc()
+            return fallback
+        
+        # Extract and parse the JSON response
+        try:
+            logger.info(f"Raw response: {response_text[:100]}...")
+            
+            categories = extract_json_object(response_text)
             
+            # Ensure all expected categories are present
+            for category in ["general_knowledge", "mathematics", "coding", "literature"]:
+                if category not in categories:
+                    categories[category] = "Not Applicable"
+            
+            return restore_excerpt(categories, prompt, omitted)
+            
+        except (KeyError, IndexError, json.JSONDecodeError) as e:
+            logger.error(f"Error parsing response: {e}")
+            logger.error(f"Response content: {response_text}")
             if attempt < max_retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
+                retry_delay = backoff_delay(attempt + 1)
+                logger.info(f"Retrying in {retry_delay:.1f} seconds...")
                 await asyncio.sleep(retry_delay)
-            else:
-                logger.error(f"Failed to connect to Claude API after {max_retries} attempts")
-                return {
-                    "general_knowledge": prompt,
-                    "mathematics": "Not Applicable",
-                    "coding": "Not Applicable",
-                    "literature": "Not Applicable"
-                }
\ No newline at end of file
+    
+    logger.error(f"Could not parse Claude's reply after {max_retries} attempts")
+    return fallback
@@ -0,0 +1,460 @@
+import hashlib
+import json
+import logging
+import time
+from typing import AsyncIterator, Dict, Optional
+from config import API_KEYS, ANTHROPIC_API_URL, GEMINI_API_URL, RETRY_BUDGET, PROMPT_CACHING_ENABLED
+from http_client import get_session
+from cache import make_cache_key, response_cache
+from rate_limiter import rate_limiter
+from resilience import ProviderError, call_with_retries, stream_with_retries, parse_retry_after
+from tokens import estimate_tokens
+from metrics import observe_call
+from singleflight import singleflight
+from message_batches import message_batcher, deferring, deferred_timeout
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+ANTHROPIC_VERSION = "2023-06-01"
+
+# Display names used in error messages
+PROVIDER_NAMES = {
+    "claude": "Claude",
+    "gemini": "Gemini",
+}
+
+def _anthropic_headers() -> Dict[str, str]:
+    return {
+        "x-api-key": API_KEYS["claude"],
+        "anthropic-version": ANTHROPIC_VERSION,
+        "content-type": "application/json"
+    }
+
+def _anthropic_payload(model: str, system_prompt: str, prompt: str, max_tokens: int,
+                       temperature: Optional[float], stream: bool = False) -> Dict:
+    payload = {
+        "model": model,
+        "max_tokens": max_tokens,
+        "system": _anthropic_system(system_prompt),
+        "messages": [
+            {"role": "user", "content": prompt}
+        ]
+    }
+    if temperature is not None:
+        payload["temperature"] = temperature
+    if stream:
+        payload["stream"] = True
+    return payload
+
+def _anthropic_system(system_prompt: str):
+    """
+    The system prompt, marked for prompt caching when enabled.
+
+    System prompts carry only static instructions (anything request-specific goes in the
+    user message), so every request with the same one shares the cached prefix.
+    """
+    if not PROMPT_CACHING_ENABLED or not system_prompt:
+        return system_prompt
+    return [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+
+def _flight_key(provider: str, model: str, payload: Dict, stream: bool = False) -> str:
+    """
+    Singleflight key: a hash of the exact request sent. Unlike the cache key nothing is
+    normalized, so callers only ever share the reply to the request they would have sent.
+    """
+    body = json.dumps({"provider": provider, "model": model, "stream": stream, "payload": payload}, sort_keys=True)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+def _gemini_payload(prompt: str, max_output_tokens: int, temperature: Optional[float]) -> Dict:
+    generation_config = {"maxOutputTokens": max_output_tokens}
+    if temperature is not None:
+        generation_config["temperature"] = temperature
+    return {
+        "contents": [
+            {
+                "role": "user",
+                "parts": [{"text": prompt}]
+            }
+        ],
+        "generationConfig": generation_config
+    }
+
+async def _raise_for_status(provider: str, response):
+    if response.status != 200:
+        error_text = await response.text()
+        logger.error(f"{PROVIDER_NAMES[provider]} API Error (Status {response.status}): {error_text}")
+        raise ProviderError(
+            provider,
+            f"Error from {PROVIDER_NAMES[provider]} API (Status {response.status}): {error_text}",
+            status=response.status,
+            retry_after=parse_retry_after(response.headers.get("retry-after"))
+        )
+
+def _anthropic_tokens(usage: Optional[Dict], default: int) -> int:
+    """Total input + output tokens from an Anthropic `usage` object (cache writes count as input)."""
+    if not usage:
+        return default
+    return (usage.get("input_tokens", 0) + usage.get("cache_creation_input_tokens", 0)
+            + usage.get("output_tokens", 0)) or default
+
+def _observe_anthropic(model: str, started: float, ttfb: Optional[float], usage: Dict, outcome: str):
+    observe_call("claude", model, time.monotonic() - started, ttfb,
+                 usage.get("input_tokens", 0), usage.get("output_tokens", 0), outcome,
+                 usage.get("cache_read_input_tokens") or 0, usage.get("cache_creation_input_tokens") or 0)
+
+def _gemini_tokens(usage: Optional[Dict], default: int) -> int:
+    """Total tokens from a Gemini `usageMetadata` object."""
+    if not usage:
+        return default
+    return usage.get("totalTokenCount") or default
+
+async def _sse_events(response) -> AsyncIterator[Dict]:
+    """Yield the JSON payload of each `data:` line in a server-sent event stream."""
+    async for raw_line in response.content:
+        line = raw_line.decode("utf-8").strip()
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if not data or data == "[DONE]":
+            continue
+        yield json.loads(data)
+
+async def _anthropic_request(model: str, system_prompt: str, prompt: str,
+                             max_tokens: int, temperature: Optional[float]) -> str:
+    """One rate-limited attempt at a non-streaming Anthropic call."""
+    input_estimate = estimate_tokens(system_prompt) + estimate_tokens(prompt)
+    reservation = await rate_limiter.acquire("claude", model, input_estimate + max_tokens)
+    usage = {}
+    started = time.monotonic()
+    ttfb = None
+    outcome = "error"
+    try:
+        session = await get_session()
+        async with session.post(
+            ANTHROPIC_API_URL,
+            headers=_anthropic_headers(),
+            json=_anthropic_payload(model, system_prompt, prompt, max_tokens, temperature)
+        ) as response:
+            ttfb = time.monotonic() - started
+            outcome = str(response.status)
+            await _raise_for_status("claude", response)
+            result = await response.json()
+        usage = result.get("usage") or {}
+        outcome = "ok"
+    finally:
+        reservation.settle(_anthropic_tokens(usage, input_estimate))
+        _observe_anthropic(model, started, ttfb, usage, outcome)
+
+    return _anthropic_text(result)
+
+async def _anthropic_batch_request(model: str, system_prompt: str, prompt: str,
+                                   max_tokens: int, temperature: Optional[float]) -> str:
+    """One attempt at an Anthropic call through the Message Batches API (see message_batches.py)."""
+    usage = {}
+    started = time.monotonic()
+    outcome = "error"
+    try:
+        # Batches have their own quota, so the interactive rate limits don't apply
+        result = await message_batcher.submit(
+            _anthropic_payload(model, system_prompt, prompt, max_tokens, temperature),
+            _anthropic_headers()
+        )
+        usage = result.get("usage") or {}
+        outcome = "ok"
+    finally:
+        _observe_anthropic(model, started, None, usage, outcome)
+
+    return _anthropic_text(result)
+
+def _anthropic_text(result: Dict) -> str:
+    try:
+        return result["content"][0]["text"]
+    except (KeyError, IndexError) as e:
+        logger.error(f"Claude result: {json.dumps(result)}")
+        raise ProviderError("claude", f"Error extracting Claude response: {str(e)}")
+
+async def _anthropic_stream(model: str, system_prompt: str, prompt: str,
+                            max_tokens: int, temperature: Optional[float]) -> AsyncIterator[str]:
+    """One rate-limited attempt at a streaming Anthropic call."""
+    input_estimate = estimate_tokens(system_prompt) + estimate_tokens(prompt)
+    reservation = await rate_limiter.acquire("claude", model, input_estimate + max_tokens)
+    usage = {}
+    started = time.monotonic()
+    ttfb = None
+    outcome = "error"
+    try:
+        session = await get_session()
+        async with session.post(
+            ANTHROPIC_API_URL,
+            headers=_anthropic_headers(),
+            json=_anthropic_payload(model, system_prompt, prompt, max_tokens, temperature, stream=True)
+        ) as response:
+            outcome = str(response.status)
+            await _raise_for_status("claude", response)
+
+            async for event in _sse_events(response):
+                event_type = event.get("type")
+                if event_type == "content_block_delta":
+                    delta = event.get("delta", {})
+                    if delta.get("type") == "text_delta" and delta.get("text"):
+                        if ttfb is None:
+                            ttfb = time.monotonic() - started
+                        yield delta["text"]
+                elif event_type == "message_start":
+                    usage.update(event.get("message", {}).get("usage", {}))
+                elif event_type == "message_delta":
+                    usage.update(event.get("usage", {}))
+                elif event_type == "error":
+                    error = event.get("error", {})
+                    outcome = error.get("type", "error")
+                    # Overload is reported mid-stream as an error event rather than a status
+                    raise ProviderError(
+                        "claude",
+                        f"Error from Claude API stream: {error.get('message', error)}",
+                        retryable=error.get("type") in ("overloaded_error", "api_error", "rate_limit_error")
+                    )
+                elif event_type == "message_stop":
+                    outcome = "ok"
+                    return
+    finally:
+        reservation.settle(_anthropic_tokens(usage, input_estimate))
+        _observe_anthropic(model, started, ttfb, usage, outcome)
+
+    raise ProviderError("claude", "Error from Claude API stream: connection closed before message_stop",
+                        retryable=True)
+
+async def _gemini_request(model: str, prompt: str, max_output_tokens: int,
+                          temperature: Optional[float]) -> str:
+    """One rate-limited attempt at a non-streaming Gemini call."""
+    input_estimate = estimate_tokens(prompt)
+    reservation = await rate_limiter.acquire("gemini", model, input_estimate + max_output_tokens)
+    usage = {}
+    started = time.monotonic()
+    ttfb = None
+    outcome = "error"
+    try:
+        session = await get_session()
+        async with session.post(
+            f"{GEMINI_API_URL}/models/{model}:generateContent",
+            params={"key": API_KEYS["gemini"]},
+            json=_gemini_payload(prompt, max_output_tokens, temperature)
+        ) as response:
+            ttfb = time.monotonic() - started
+            outcome = str(response.status)
+            await _raise_for_status("gemini", response)
+            result = await response.json()
+        usage = result.get("usageMetadata") or {}
+        outcome = "ok"
+    finally:
+        reservation.settle(_gemini_tokens(usage, input_estimate))
+        observe_call("gemini", model, time.monotonic() - started, ttfb,
+                     usage.get("promptTokenCount", 0), usage.get("candidatesTokenCount", 0), outcome)
+
+    try:
+        return result["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError) as e:
+        logger.error(f"Gemini result: {json.dumps(result)}")
+        raise ProviderError("gemini", f"Error extracting Gemini response: {str(e)}")
+
+async def _gemini_stream(model: str, prompt: str, max_output_tokens: int,
+                         temperature: Optional[float]) -> AsyncIterator[str]:
+    """One rate-limited attempt at a streaming Gemini call."""
+    input_estimate = estimate_tokens(prompt)
+    reservation = await rate_limiter.acquire("gemini", model, input_estimate + max_output_tokens)
+    usage = {}
+    completed = False
+    started = time.monotonic()
+    ttfb = None
+    outcome = "error"
+    try:
+        session = await get_session()
+        async with session.post(
+            f"{GEMINI_API_URL}/models/{model}:streamGenerateContent",
+            params={"key": API_KEYS["gemini"], "alt": "sse"},
+            json=_gemini_payload(prompt, max_output_tokens, temperature)
+        ) as response:
+            outcome = str(response.status)
+            await _raise_for_status("gemini", response)
+
+            async for event in _sse_events(response):
+                # Each chunk carries the running usage totals
+                usage = event.get("usageMetadata") or usage
+                for candidate in event.get("candidates", []):
+                    for part in candidate.get("content", {}).get("parts", []):
+                        if part.get("text"):
+                            if ttfb is None:
+                                ttfb = time.monotonic() - started
+                            yield part["text"]
+                    if candidate.get("finishReason"):
+                        completed = True
+                        outcome = "ok"
+    finally:
+        reservation.settle(_gemini_tokens(usage, input_estimate))
+        observe_call("gemini", model, time.monotonic() - started, ttfb,
+                     usage.get("promptTokenCount", 0), usage.get("candidatesTokenCount", 0), outcome)
+
+    if not completed:
+        raise ProviderError("gemini", "Error from Gemini API stream: connection closed before finishReason",
+                            retryable=True)
+
+async def anthropic_message(model: str, system_prompt: str, prompt: str,
+                            max_tokens: int = 4096, temperature: Optional[float] = None,
+                            refresh: bool = False, coalesce: bool = True) -> str:
+    """
+    Send a single-turn request to the Anthropic Messages API.
+
+    Cached replies are returned as-is; otherwise the call is rate limited and
+    transient failures are retried with backoff. Identical calls already in flight
+    share one request (see singleflight.py). Deferred calls (bulk uploads) are sent
+    through the Message Batches API instead (see message_batches.py).
+
+    Arguments:
+        model: Anthropic model name
+        system_prompt: System prompt for the request
+        prompt: User message
+        max_tokens: Maximum tokens to generate
+        temperature: Sampling temperature, or None for the API default
+        refresh: Skip the cache lookup and don't join a call in flight; the new reply still
+            replaces the cached one
+        coalesce: Join an identical call in flight (False for deliberate duplicates such as hedges)
+
+    Returns:
+        The text of the reply
+
+    Raises:
+        ProviderError: if the API returns an error status or an unexpected body
+    """
+    cache_key = make_cache_key("claude", model, system_prompt, prompt, max_tokens=max_tokens, temperature=temperature)
+    if not refresh:
+        cached = await response_cache.lookup(cache_key)
+        if cached is not None:
+            return cached
+
+    attempt = _anthropic_batch_request if deferring() else _anthropic_request
+
+    async def fetch() -> str:
+        text = await call_with_retries(
+            "claude",
+            lambda: attempt(model, system_prompt, prompt, max_tokens, temperature),
+            budget=deferred_timeout(RETRY_BUDGET)
+        )
+        await response_cache.store(cache_key, text)
+        return text
+
+    if refresh or not coalesce:
+        return await fetch()
+    flight_key = _flight_key("claude", model, _anthropic_payload(model, system_prompt, prompt, max_tokens, temperature))
+    # A deferred flight can take hours, so interactive callers must never join one; deferred
+    # callers joining an interactive flight only get their reply sooner
+    return await singleflight.do(f"deferred:{flight_key}" if deferring() else flight_key, fetch)
+
+async def stream_anthropic_message(model: str, system_prompt: str, prompt: str,
+                                   max_tokens: int = 4096, temperature: Optional[float] = None,
+                                   coalesce: bool = True) -> AsyncIterator[str]:
+    """
+    Stream a single-turn request to the Anthropic Messages API (`stream: true`).
+
+    Takes the same arguments as anthropic_message and yields text deltas as they arrive.
+
+    Raises:
+        ProviderError: if the API returns an error status or an error event mid-stream
+    """
+    cache_key = make_cache_key("claude", model, system_prompt, prompt, max_tokens=max_tokens, temperature=temperature)
+    cached = await response_cache.lookup(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    async def fetch() -> AsyncIterator[str]:
+        chunks = []
+        async for chunk in stream_with_retries(
+            "claude",
+            lambda: _anthropic_stream(model, system_prompt, prompt, max_tokens, temperature)
+        ):
+            chunks.append(chunk)
+            yield chunk
+
+        # Incomplete streams raise above, so only complete replies are cached
+        await response_cache.store(cache_key, "".join(chunks))
+
+    flight_key = _flight_key("claude", model,
+                             _anthropic_payload(model, system_prompt, prompt, max_tokens, temperature, stream=True),
+                             stream=True)
+    async for chunk in singleflight.stream(flight_key, fetch) if coalesce else fetch():
+        yield chunk
+
+async def gemini_generate(model: str, prompt: str, max_output_tokens: int = 2048,
+                          temperature: Optional[float] = None, coalesce: bool = True) -> str:
+    """
+    Send a single-turn request to the Gemini generateContent API.
+
+    Cached replies are returned as-is; otherwise the call is rate limited and
+    transient failures are retried with backoff. Identical calls already in flight
+    share one request (see singleflight.py).
+
+    Arguments:
+        model: Gemini model name
+        prompt: User message
+        max_output_tokens: Maximum tokens to generate
+        temperature: Sampling temperature, or None for the API default
+        coalesce: Join an identical call in flight (False for deliberate duplicates such as hedges)
+
+    Returns:
+        The text of the reply
+
+    Raises:
+        ProviderError: if the API returns an error status or an unexpected body
+    """
+    cache_key = make_cache_key("gemini", model, "", prompt, max_tokens=max_output_tokens, temperature=temperature)
+    cached = await response_cache.lookup(cache_key)
+    if cached is not None:
+        return cached
+
+    async def fetch() -> str:
+        text = await call_with_retries(
+            "gemini",
+            lambda: _gemini_request(model, prompt, max_output_tokens, temperature)
+        )
+        await response_cache.store(cache_key, text)
+        return text
+
+    if not coalesce:
+        return await fetch()
+    return await singleflight.do(
+        _flight_key("gemini", model, _gemini_payload(prompt, max_output_tokens, temperature)), fetch)
+
+async def stream_gemini_generate(model: str, prompt: str, max_output_tokens: int = 2048,
+                                 temperature: Optional[float] = None, coalesce: bool = True) -> AsyncIterator[str]:
+    """
+    Stream a single-turn request to the Gemini streamGenerateContent API.
+
+    Takes the same arguments as gemini_generate and yields text deltas as they arrive.
+
+    Raises:
+        ProviderError: if the API returns an error status
+    """
+    cache_key = make_cache_key("gemini", model, "", prompt, max_tokens=max_output_tokens, temperature=temperature)
+    cached = await response_cache.lookup(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    async def fetch() -> AsyncIterator[str]:
+        chunks = []
+        async for chunk in stream_with_retries(
+            "gemini",
+            lambda: _gemini_stream(model, prompt, max_output_tokens, temperature)
+        ):
+            chunks.append(chunk)
+            yield chunk
+
+        # Incomplete streams raise above, so only complete replies are cached
+        await response_cache.store(cache_key, "".join(chunks))
+
+    flight_key = _flight_key("gemini", model, _gemini_payload(prompt, max_output_tokens, temperature),
+                             stream=True)
+    async for chunk in singleflight.stream(flight_key, fetch) if coalesce else fetch():
+        yield chunk
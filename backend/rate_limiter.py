@@ -0,0 +1,236 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+from config import RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW, RATE_LIMIT_TOKENS, RATE_LIMITS
+from session_store import current_session_id
+from metrics import observe_queue_wait
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """
+    Async token bucket limiting both requests and LLM tokens (input + output) per window.
+
+    Callers that can't be served immediately wait in per-session queues which are served
+    round-robin, so one session with many calls can't starve the others. Token budgets are
+    reserved up front from an estimate and corrected with settle() once real usage is known.
+    """
+
+    def __init__(self, name: str, max_requests: int, window: float, max_tokens: int = 0):
+        self.name = name
+        self.max_requests = max_requests
+        self.max_tokens = max_tokens
+        self.window = window
+        self._requests = float(max_requests)
+        self._tokens = float(max_tokens)
+        self._updated = time.monotonic()
+        # Waiting (future, tokens) pairs per session, in round-robin order
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.granted = 0
+        self.delayed = 0
+        self.total_wait = 0.0
+
+    async def acquire(self, tokens: int = 0, key: str = "") -> int:
+        """
+        Wait until one request and `tokens` tokens are available, then take them.
+
+        Arguments:
+            tokens: Estimated tokens the call will use (clamped to the bucket size)
+            key: Fairness key, normally the session id
+
+        Returns:
+            The number of tokens reserved, to pass to settle()
+        """
+        tokens = min(tokens, self.max_tokens) if self.max_tokens else 0
+
+        if not self._queues and self._available(tokens):
+            self._take(tokens)
+            observe_queue_wait(f"rate_limit:{self.name}", 0.0)
+            return tokens
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append((future, tokens))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch(), name=f"rate-limit-{self.name}")
+
+        started = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as we were cancelled; give the capacity back
+                self._requests = min(self.max_requests, self._requests + 1)
+                self.settle(tokens, 0)
+            raise
+
+        waited = time.monotonic() - started
+        self.delayed += 1
+        self.total_wait += waited
+        observe_queue_wait(f"rate_limit:{self.name}", waited)
+        return tokens
+
+    def settle(self, reserved: int, actual: int):
+        """Replace a token reservation with the tokens the call really used."""
+        if not self.max_tokens:
+            return
+        # Going negative is allowed: the overrun is paid back before the next grant
+        self._tokens = min(self.max_tokens, self._tokens + reserved - actual)
+
+    def stats(self) -> Dict[str, object]:
+        self._refill()
+        return {
+            "max_requests": self.max_requests,
+            "max_tokens": self.max_tokens,
+            "window": self.window,
+            "available_requests": round(self._requests, 2),
+            "available_tokens": round(self._tokens, 2) if self.max_tokens else None,
+            "queued": sum(len(queue) for queue in self._queues.values()),
+            "granted": self.granted,
+            "delayed": self.delayed,
+            "avg_wait": self.total_wait / self.delayed if self.delayed else 0.0,
+        }
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.max_requests, self._requests + elapsed * self.max_requests / self.window)
+        if self.max_tokens:
+            self._tokens = min(self.max_tokens, self._tokens + elapsed * self.max_tokens / self.window)
+
+    def _available(self, tokens: int) -> bool:
+        self._refill()
+        return self._requests >= 1 and (not self.max_tokens or self._tokens >= tokens)
+
+    def _take(self, tokens: int):
+        self._requests -= 1
+        if self.max_tokens:
+            self._tokens -= tokens
+        self.granted += 1
+
+    def _wait_time(self, tokens: int) -> float:
+        request_wait = max(0.0, 1 - self._requests) * self.window / self.max_requests
+        token_wait = 0.0
+        if self.max_tokens:
+            token_wait = max(0.0, tokens - self._tokens) * self.window / self.max_tokens
+        return max(request_wait, token_wait, 0.01)
+
+    async def _dispatch(self):
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+
+            # Drop callers that gave up while waiting
+            while queue and queue[0][0].done():
+                queue.popleft()
+            if not queue:
+                del self._queues[key]
+                continue
+
+            future, tokens = queue[0]
+            if not self._available(tokens):
+                await asyncio.sleep(self._wait_time(tokens))
+                continue
+
+            queue.popleft()
+            self._take(tokens)
+            future.set_result(None)
+
+            # Round robin: this session goes to the back of the line
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+
+class Reservation:
+    """Capacity taken from one or more buckets for a single provider call."""
+
+    def __init__(self, buckets: List[TokenBucket], reserved: List[int]):
+        self.buckets = buckets
+        self.reserved = reserved
+        self._settled = False
+
+    def settle(self, actual_tokens: int):
+        """Report the tokens the call actually used (input + output)."""
+        if self._settled:
+            return
+        self._settled = True
+        for bucket, reserved in zip(self.buckets, self.reserved):
+            bucket.settle(reserved, actual_tokens)
+
+class RateLimiter:
+    """
+    Buckets per provider, plus optional buckets per provider:model from RATE_LIMITS.
+
+    The provider-wide bucket uses RATE_LIMIT_REQUESTS/RATE_LIMIT_WINDOW/RATE_LIMIT_TOKENS
+    unless RATE_LIMITS overrides it, e.g.
+    {"claude": {"requests": 50, "tokens": 40000}, "claude:claude-3-5-haiku-20241022": {"requests": 20}}
+    """
+
+    def __init__(self, limits: Optional[Dict[str, Dict]] = None):
+        self.limits = limits or {}
+        self._buckets: Dict[str, Optional[TokenBucket]] = {}
+
+    async def acquire(self, provider: str, model: str, tokens: int = 0) -> Reservation:
+        """Wait for capacity for one call to `model` on `provider` using about `tokens` tokens."""
+        key = current_session_id.get() or ""
+        buckets = [bucket for bucket in (self._bucket(provider), self._bucket(f"{provider}:{model}"))
+                   if bucket is not None]
+
+        reserved = []
+        try:
+            for bucket in buckets:
+                reserved.append(await bucket.acquire(tokens, key))
+        except asyncio.CancelledError:
+            Reservation(buckets[:len(reserved)], reserved).settle(0)
+            raise
+
+        return Reservation(buckets, reserved)
+
+    def stats(self) -> Dict[str, Dict]:
+        return {name: bucket.stats() for name, bucket in self._buckets.items() if bucket is not None}
+
+    def _bucket(self, name: str) -> Optional[TokenBucket]:
+        if name in self._buckets:
+            return self._buckets[name]
+
+        settings = self.limits.get(name)
+        if settings is None and ":" in name:
+            # Model-level buckets only exist when configured
+            return None
+        settings = settings or {}
+
+        max_requests = int(settings.get("requests", RATE_LIMIT_REQUESTS))
+        if max_requests <= 0:
+            # A request limit of 0 turns limiting off for this bucket
+            self._buckets[name] = None
+            return None
+
+        bucket = TokenBucket(
+            name,
+            max_requests=max_requests,
+            window=float(settings.get("window", RATE_LIMIT_WINDOW)),
+            max_tokens=int(settings.get("tokens", RATE_LIMIT_TOKENS))
+        )
+        self._buckets[name] = bucket
+        logger.info(f"Rate limiting {name} to {bucket.max_requests} requests"
+                    f"{f' and {bucket.max_tokens} tokens' if bucket.max_tokens else ''} per {bucket.window}s")
+        return bucket
+
+def _load_limits() -> Dict[str, Dict]:
+    if not RATE_LIMITS:
+        return {}
+    try:
+        return json.loads(RATE_LIMITS)
+    except json.JSONDecodeError as e:
+        logger.error(f"Ignoring invalid RATE_LIMITS: {str(e)}")
+        return {}
+
+# Shared limiter used by the provider calls
+rate_limiter = RateLimiter(_load_limits())
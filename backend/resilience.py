@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, TypeVar
+import aiohttp
+from config import (RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_BUDGET,
+                    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+from metrics import count_retry
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Statuses worth retrying: timeouts, conflicts, rate limits, overload and server errors
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+class ProviderError(Exception):
+    """Raised when a provider returns an error status or a response we can't read."""
+
+    def __init__(self, provider: str, message: str, status: Optional[int] = None,
+                 retry_after: Optional[float] = None, retryable: Optional[bool] = None):
+        super().__init__(message)
+        self.provider = provider
+        self.status = status
+        self.retry_after = retry_after
+        self.retryable = retryable if retryable is not None else status in RETRYABLE_STATUSES
+
+class CircuitOpenError(ProviderError):
+    """Raised instead of calling a provider whose circuit breaker is open."""
+
+    def __init__(self, provider: str, retry_in: float):
+        super().__init__(
+            provider,
+            f"Error calling {provider} API: circuit open after repeated failures, retrying in {retry_in:.0f}s",
+            retryable=False
+        )
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header (seconds or an HTTP date) into seconds from now."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether a failed provider call is worth another attempt."""
+    if isinstance(error, ProviderError):
+        return error.retryable
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError))
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY) -> float:
+    """Exponential backoff with full jitter for the given retry number (1 for the first retry)."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+class CircuitBreaker:
+    """
+    Stops calling a provider after `failure_threshold` consecutive retryable failures.
+
+    Once open, calls fail fast for `reset_timeout` seconds; then one trial call is let
+    through (half-open) and its result decides whether the circuit closes or reopens.
+    """
+
+    def __init__(self, provider: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._trial_in_flight = False
+
+    def before_call(self):
+        """Raise CircuitOpenError if the provider shouldn't be called right now."""
+        if self.state == "closed":
+            return
+        if self.state == "open":
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0:
+                raise CircuitOpenError(self.provider, retry_in)
+            self.state = "half_open"
+            self._trial_in_flight = False
+        if self._trial_in_flight:
+            raise CircuitOpenError(self.provider, self.reset_timeout)
+        self._trial_in_flight = True
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info(f"Circuit for {self.provider} closed")
+        self.state = "closed"
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.error(f"Circuit for {self.provider} opened after {self.failures} failures")
+                self.times_opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def record_abort(self):
+        """The call was cancelled; free the half-open trial slot without judging the provider."""
+        self._trial_in_flight = False
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+        }
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_retries: Dict[str, int] = {}
+
+def circuit_breaker(provider: str) -> CircuitBreaker:
+    if provider not in _breakers:
+        _breakers[provider] = CircuitBreaker(provider)
+    return _breakers[provider]
+
+def _next_delay(provider: str, error: BaseException, attempt: int, deadline: float) -> Optional[float]:
+    """Seconds to wait before retrying, or None if we should give up."""
+    if not is_retryable(error) or attempt >= RETRY_MAX_ATTEMPTS:
+        return None
+    retry_after = getattr(error, "retry_after", None)
+    delay = retry_after if retry_after is not None else backoff_delay(attempt)
+    if time.monotonic() + delay >= deadline:
+        return None
+    _retries[provider] = _retries.get(provider, 0) + 1
+    count_retry(provider)
+    logger.warning(f"{provider} call failed ({str(error)[:200]}), retry {attempt}/{RETRY_MAX_ATTEMPTS - 1} in {delay:.1f}s")
+    return delay
+
+async def call_with_retries(provider: str, call: Callable[[], Awaitable[T]],
+                            budget: float = RETRY_BUDGET) -> T:
+    """
+    Run a provider call with retries, backoff and the provider's circuit breaker.
+
+    Arguments:
+        provider: Provider name, used to pick the circuit breaker
+        call: Function that makes one attempt
+        budget: Seconds after which no new attempt is started
+
+    Returns:
+        Whatever the successful attempt returned
+    """
+    breaker = circuit_breaker(provider)
+    deadline = time.monotonic() + budget
+    attempt = 0
+
+    while True:
+        attempt += 1
+        breaker.before_call()
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            breaker.record_abort()
+            raise
+        except Exception as e:
+            if is_retryable(e):
+                breaker.record_failure()
+            else:
+                breaker.record_abort()
+            delay = _next_delay(provider, e, attempt, deadline)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+
+        breaker.record_success()
+        return result
+
+async def stream_with_retries(provider: str, open_stream: Callable[[], AsyncIterator[str]],
+                              budget: float = RETRY_BUDGET) -> AsyncIterator[str]:
+    """
+    Streaming counterpart of call_with_retries.
+
+    A stream is only retried if it fails before producing any text; once text has reached
+    the caller a failure is raised as-is, since replaying it would duplicate output.
+    """
+    breaker = circuit_breaker(provider)
+    deadline = time.monotonic() + budget
+    attempt = 0
+
+    while True:
+        attempt += 1
+        breaker.before_call()
+        started = False
+        try:
+            async for chunk in open_stream():
+                started = True
+                yield chunk
+        except (asyncio.CancelledError, GeneratorExit):
+            breaker.record_abort()
+            raise
+        except Exception as e:
+            if is_retryable(e):
+                breaker.record_failure()
+            else:
+                breaker.record_abort()
+            delay = None if started else _next_delay(provider, e, attempt, deadline)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+
+        breaker.record_success()
+        return
+
+def resilience_stats() -> Dict[str, Dict]:
+    """Retry counts and circuit breaker state per provider."""
+    providers = set(_breakers) | set(_retries)
+    return {
+        provider: {
+            "retries": _retries.get(provider, 0),
+            **(circuit_breaker(provider).stats()),
+        }
+        for provider in providers
+    }
@@ -0,0 +1,255 @@
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from config import (API_KEYS, ROUTING_TABLE_PATH, ROUTING_RELOAD_INTERVAL, ROUTING_EWMA_ALPHA,
+                    ROUTING_PRICE_WEIGHT, ROUTING_MAX_ERROR_RATE, ROUTING_RECOVERY_TIME)
+from resilience import circuit_breaker
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# System prompts for the specialist calls
+GENERAL_SYSTEM_PROMPT = "You are a helpful assistant addressing general knowledge questions."
+MATH_SYSTEM_PROMPT = "You are a mathematics expert who solves problems step by step and states the final answer clearly."
+CODING_SYSTEM_PROMPT = "You are a helpful programming assistant that explains code clearly and provides well-structured, efficient solutions."
+LITERATURE_SYSTEM_PROMPT = "You are a literary analysis and reading comprehension expert who provides insightful, nuanced interpretations."
+
+# Built-in routes; ROUTING_TABLE_PATH can point at a JSON file of the same shape that
+# overrides or adds models and categories. Prices are USD per million tokens, latency is
+# the prior (seconds) used until a model has live measurements.
+#
+# Each category picks the best-scoring healthy model from `models`, and moves to
+# `fallback` models when those are failing, or slower than `slow_after` seconds.
+DEFAULT_ROUTES = {
+    "models": {
+        "claude-3-7-sonnet": {"provider": "claude", "model": "claude-3-7-sonnet-20250219",
+                              "input_price": 3.0, "output_price": 15.0, "latency": 8.0},
+        "claude-3-5-haiku": {"provider": "claude", "model": "claude-3-5-haiku-20241022",
+                             "input_price": 0.8, "output_price": 4.0, "latency": 4.0},
+        "gemini-2.0-flash": {"provider": "gemini", "model": "gemini-2.0-flash",
+                             "input_price": 0.1, "output_price": 0.4, "latency": 3.0},
+    },
+    "categories": {
+        "general_knowledge": {"models": ["claude-3-7-sonnet"], "fallback": ["claude-3-5-haiku"],
+                              "system_prompt": GENERAL_SYSTEM_PROMPT, "max_tokens": 4096},
+        # Gemini calls take no system prompt; it is only used if math falls back to Claude
+        "mathematics": {"models": ["gemini-2.0-flash"], "fallback": ["claude-3-7-sonnet"],
+                        "system_prompt": MATH_SYSTEM_PROMPT, "max_tokens": 2048, "temperature": 0.2},
+        "coding": {"models": ["claude-3-7-sonnet"], "fallback": ["claude-3-5-haiku"],
+                   "system_prompt": CODING_SYSTEM_PROMPT, "max_tokens": 4096},
+        "literature": {"models": ["claude-3-5-haiku"], "fallback": ["claude-3-7-sonnet"],
+                       "system_prompt": LITERATURE_SYSTEM_PROMPT, "max_tokens": 4096},
+    },
+}
+
+@dataclass(slots=True)
+class ModelSpec:
+    """A model that routes can send prompts to."""
+    name: str
+    provider: str
+    model: str
+    input_price: float = 0.0
+    output_price: float = 0.0
+    latency: float = 5.0
+
+@dataclass(slots=True)
+class CategoryRoute:
+    """How one category is served."""
+    category: str
+    models: List[str]
+    fallback: List[str] = field(default_factory=list)
+    system_prompt: str = ""
+    max_tokens: int = 4096
+    temperature: Optional[float] = None
+    slow_after: float = 20.0
+
+class ModelStats:
+    """Exponentially weighted latency and error rate of one model's routed calls."""
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.last_failure = 0.0
+
+    def record(self, latency: float, ok: bool):
+        self.calls += 1
+        if ok:
+            # Failed calls often return early, so only successes say how fast the model is
+            self.latency = latency if self.latency is None else self.alpha * latency + (1 - self.alpha) * self.latency
+        else:
+            self.failures += 1
+            self.last_failure = time.monotonic()
+        self.error_rate = self.alpha * (0.0 if ok else 1.0) + (1 - self.alpha) * self.error_rate
+
+class RoutingTable:
+    """
+    Category -> model routing driven by DEFAULT_ROUTES plus an optional JSON file, which is
+    re-read whenever it changes on disk.
+    """
+
+    def __init__(self, path: str = ROUTING_TABLE_PATH, reload_interval: float = ROUTING_RELOAD_INTERVAL,
+                 alpha: float = ROUTING_EWMA_ALPHA, price_weight: float = ROUTING_PRICE_WEIGHT,
+                 max_error_rate: float = ROUTING_MAX_ERROR_RATE, recovery_time: float = ROUTING_RECOVERY_TIME):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.alpha = alpha
+        self.price_weight = price_weight
+        self.max_error_rate = max_error_rate
+        self.recovery_time = recovery_time
+        self.models: Dict[str, ModelSpec] = {}
+        self.routes: Dict[str, CategoryRoute] = {}
+        self._stats: Dict[str, ModelStats] = {}
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self.reloads = 0
+        self.fallbacks = 0
+        self._apply(self._read_file())
+
+    def route(self, category: str) -> Optional[CategoryRoute]:
+        self._maybe_reload()
+        return self.routes.get(category)
+
+    def candidates(self, category: str) -> List[ModelSpec]:
+        """
+        Models to try for a category, best first.
+
+        Arguments:
+            category: The prompt category
+
+        Returns:
+            Healthy pool models by score, then healthy fallbacks in order, then the unhealthy
+            ones as a last resort; models without an API key are left out
+        """
+        route = self.route(category)
+        if route is None:
+            return []
+
+        pool = [self.models[name] for name in route.models if self._available(name)]
+        fallback = [self.models[name] for name in route.fallback
+                    if self._available(name) and name not in route.models]
+
+        healthy_pool = sorted((spec for spec in pool if self._healthy(spec)), key=self._score)
+        healthy_fallback = [spec for spec in fallback if self._healthy(spec)]
+        unhealthy = [spec for spec in pool + fallback if not self._healthy(spec)]
+
+        # Move to the fallback while the primary is slow, as long as the fallback isn't
+        if healthy_pool and healthy_fallback and self._slow(healthy_pool[0], route) \
+                and not self._slow(healthy_fallback[0], route):
+            return healthy_fallback[:1] + healthy_pool + healthy_fallback[1:] + unhealthy
+        return healthy_pool + healthy_fallback + unhealthy
+
+    def record(self, name: str, latency: float, ok: bool):
+        """Feed the outcome of a routed call into the model's stats."""
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = ModelStats(self.alpha)
+        stats.record(latency, ok)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "path": self.path or None,
+            "reloads": self.reloads,
+            "fallbacks": self.fallbacks,
+            "models": {
+                name: {
+                    "latency_ewma": round(self._stats[name].latency, 3) if name in self._stats and self._stats[name].latency is not None else None,
+                    "error_rate": round(self._stats[name].error_rate, 3) if name in self._stats else 0.0,
+                    "calls": self._stats[name].calls if name in self._stats else 0,
+                    "healthy": self._healthy(spec),
+                    "score": round(self._score(spec), 3),
+                }
+                for name, spec in self.models.items()
+            },
+            "routes": {category: [spec.name for spec in self.candidates(category)] for category in self.routes},
+        }
+
+    def _available(self, name: str) -> bool:
+        spec = self.models.get(name)
+        return spec is not None and bool(API_KEYS.get(spec.provider))
+
+    def _healthy(self, spec: ModelSpec) -> bool:
+        if circuit_breaker(spec.provider).state == "open":
+            return False
+        stats = self._stats.get(spec.name)
+        if stats is None or stats.error_rate < self.max_error_rate:
+            return True
+        # Let a failing model back in for a probe once it has been quiet for a while
+        return time.monotonic() - stats.last_failure >= self.recovery_time
+
+    def _latency(self, spec: ModelSpec) -> float:
+        stats = self._stats.get(spec.name)
+        return stats.latency if stats is not None and stats.latency is not None else spec.latency
+
+    def _score(self, spec: ModelSpec) -> float:
+        """Expected seconds per call, inflated by errors, plus price converted at price_weight."""
+        stats = self._stats.get(spec.name)
+        error_rate = stats.error_rate if stats is not None else 0.0
+        price = (spec.input_price + spec.output_price) / 2
+        return self._latency(spec) * (1 + error_rate) + self.price_weight * price
+
+    def _slow(self, spec: ModelSpec, route: CategoryRoute) -> bool:
+        return self._latency(spec) > route.slow_after
+
+    def _maybe_reload(self):
+        if not self.path:
+            return
+        now = time.monotonic()
+        if now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            logger.info(f"Routing table {self.path} changed, reloading")
+            self._apply(self._read_file())
+            self.reloads += 1
+
+    def _read_file(self) -> Dict:
+        if not self.path:
+            return {}
+        try:
+            self._mtime = os.path.getmtime(self.path)
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            self._mtime = None
+            logger.warning(f"Routing table {self.path} not found, using built-in routes")
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Ignoring invalid routing table {self.path}: {str(e)}")
+        return {}
+
+    def _apply(self, overrides: Dict):
+        models = {**DEFAULT_ROUTES["models"], **overrides.get("models", {})}
+        categories = dict(DEFAULT_ROUTES["categories"])
+        for category, settings in overrides.get("categories", {}).items():
+            categories[category] = {**categories.get(category, {}), **settings}
+
+        try:
+            new_models = {name: ModelSpec(name=name, **spec) for name, spec in models.items()}
+            new_routes = {category: CategoryRoute(category=category, **settings)
+                          for category, settings in categories.items()}
+        except TypeError as e:
+            logger.error(f"Ignoring invalid routing table {self.path}: {str(e)}")
+            if self.routes:
+                return
+            return self._apply({})
+
+        for route in new_routes.values():
+            for name in route.models + route.fallback:
+                if name not in new_models:
+                    logger.warning(f"Route for {route.category} refers to unknown model {name}")
+        self.models = new_models
+        self.routes = new_routes
+
+# Shared routing table used by the router
+routing_table = RoutingTable()
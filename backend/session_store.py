@@ -0,0 +1,256 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass, field, fields, asdict
+from typing import Dict, Optional
+from config import SESSION_BACKEND, SESSION_TTL, SESSION_MAX_ENTRIES, SESSION_MAX_BYTES, SESSION_DB_PATH
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Session being processed by the current task; set by the pipeline and inherited by the
+# tasks it spawns, so shared layers (rate limiting, metrics) can attribute work to it
+current_session_id: ContextVar[Optional[str]] = ContextVar("current_session_id", default=None)
+
+@dataclass(slots=True)
+class SessionRecord:
+    """Everything we keep about one /api/prompt session."""
+    prompt: str
+    status: str = "parsing"
+    parsed_categories: Optional[Dict[str, str]] = None
+    generated_prompts: Optional[Dict[str, str]] = None
+    responses: Optional[Dict[str, str]] = None
+    category_progress: Optional[Dict[str, str]] = None
+    plan: Optional[Dict] = None
+    metrics: Optional[Dict] = None
+    combined_response: Optional[str] = None
+    error: Optional[str] = None
+    updated_at: float = field(default_factory=time.time)
+
+    def to_dict(self) -> Dict:
+        """The record's fields, in the shape PromptResponse expects."""
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "SessionRecord":
+        known = {f.name for f in fields(cls)}
+        return cls(**{key: value for key, value in data.items() if key in known})
+
+    def size(self) -> int:
+        """Approximate number of bytes of text held by the record."""
+        total = len(self.prompt) + len(self.combined_response or "") + len(self.error or "")
+        for mapping in (self.parsed_categories, self.generated_prompts, self.responses, self.category_progress):
+            if mapping:
+                total += sum(len(key) + len(value or "") for key, value in mapping.items())
+        return total
+
+class SessionStore:
+    """
+    Interface for session storage. Sessions expire `ttl` seconds after their last update,
+    and stores evict the least recently updated sessions to stay within their limits.
+    """
+
+    backend = "none"
+
+    def create(self, session_id: str, prompt: str) -> SessionRecord:
+        raise NotImplementedError
+
+    def get(self, session_id: str) -> Optional[SessionRecord]:
+        raise NotImplementedError
+
+    def update(self, session_id: str, **changes) -> Optional[SessionRecord]:
+        """Apply changes to a session; returns None if it no longer exists."""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, object]:
+        raise NotImplementedError
+
+    def __contains__(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+class MemorySessionStore(SessionStore):
+    """In-process session store bounded by TTL, entry count and approximate bytes."""
+
+    backend = "memory"
+
+    def __init__(self, ttl: float = SESSION_TTL, max_entries: int = SESSION_MAX_ENTRIES,
+                 max_bytes: int = SESSION_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Ordered from least to most recently updated
+        self._records: "OrderedDict[str, SessionRecord]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def create(self, session_id: str, prompt: str) -> SessionRecord:
+        record = SessionRecord(prompt=prompt)
+        self._store(session_id, record)
+        return record
+
+    def get(self, session_id: str) -> Optional[SessionRecord]:
+        self._expire()
+        return self._records.get(session_id)
+
+    def update(self, session_id: str, **changes) -> Optional[SessionRecord]:
+        record = self.get(session_id)
+        if record is None:
+            return None
+        for key, value in changes.items():
+            setattr(record, key, value)
+        record.updated_at = time.time()
+        self._store(session_id, record)
+        return record
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "backend": self.backend,
+            "sessions": len(self._records),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _store(self, session_id: str, record: SessionRecord):
+        size = record.size()
+        self._bytes += size - self._sizes.get(session_id, 0)
+        self._sizes[session_id] = size
+        self._records[session_id] = record
+        self._records.move_to_end(session_id)
+
+        self._expire()
+        # Never evict the session we just wrote
+        while len(self._records) > 1 and (len(self._records) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._records)))
+            self.evictions += 1
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        while self._records:
+            session_id, record = next(iter(self._records.items()))
+            if record.updated_at >= cutoff:
+                break
+            self._remove(session_id)
+            self.expirations += 1
+
+    def _remove(self, session_id: str):
+        del self._records[session_id]
+        self._bytes -= self._sizes.pop(session_id, 0)
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Session store backed by SQLite, so /api/status works across uvicorn workers and
+    survives restarts.
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path: str = SESSION_DB_PATH, ttl: float = SESSION_TTL,
+                 max_entries: int = SESSION_MAX_ENTRIES, max_bytes: int = SESSION_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, data TEXT NOT NULL, size INTEGER NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+
+    def create(self, session_id: str, prompt: str) -> SessionRecord:
+        record = SessionRecord(prompt=prompt)
+        self._write(session_id, record)
+        self._enforce_limits()
+        return record
+
+    def get(self, session_id: str) -> Optional[SessionRecord]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM sessions WHERE session_id = ? AND updated_at >= ?",
+                (session_id, time.time() - self.ttl)
+            ).fetchone()
+        if row is None:
+            return None
+        return SessionRecord.from_dict(json.loads(row[0]))
+
+    def update(self, session_id: str, **changes) -> Optional[SessionRecord]:
+        # Read-modify-write in one transaction so concurrent workers don't lose updates
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT data FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                record = SessionRecord.from_dict(json.loads(row[0]))
+                for key, value in changes.items():
+                    setattr(record, key, value)
+                record.updated_at = time.time()
+                self._execute_write(session_id, record)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return record
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM sessions").fetchone()
+        return {
+            "backend": self.backend,
+            "sessions": count,
+            "bytes": total,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "evictions": self.evictions,
+        }
+
+    def _write(self, session_id: str, record: SessionRecord):
+        with self._lock:
+            self._execute_write(session_id, record)
+
+    def _execute_write(self, session_id: str, record: SessionRecord):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, data, size, updated_at) VALUES (?, ?, ?, ?)",
+            (session_id, json.dumps(record.to_dict()), record.size(), record.updated_at)
+        )
+
+    def _enforce_limits(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl,))
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM sessions").fetchone()
+            while count > 1 and (count > self.max_entries or total > self.max_bytes):
+                session_id, size = self._conn.execute(
+                    "SELECT session_id, size FROM sessions ORDER BY updated_at LIMIT 1"
+                ).fetchone()
+                self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                count -= 1
+                total -= size
+                self.evictions += 1
+
+def make_session_store(backend: str = SESSION_BACKEND) -> SessionStore:
+    """Create the session store configured by SESSION_BACKEND ("memory" or "sqlite")."""
+    if backend == "sqlite":
+        logger.info(f"Using SQLite session store at {SESSION_DB_PATH}")
+        return SQLiteSessionStore()
+    if backend != "memory":
+        logger.warning(f"Unknown SESSION_BACKEND {backend!r}, using memory")
+    return MemorySessionStore()
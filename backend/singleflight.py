@@ -0,0 +1,141 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+from config import SINGLEFLIGHT_ENABLED
+from metrics import count_coalesced
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+class _Flight:
+    """One upstream call and the callers waiting on it."""
+    __slots__ = ("task", "waiters", "chunks", "changed")
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        # Streams only: every chunk so far, so late joiners can catch up
+        self.chunks: List[str] = []
+        self.changed = asyncio.Event()
+
+    def wake(self):
+        # Waiters hold the old event; a fresh one is armed for the next change
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+class SingleFlight:
+    """
+    Coalesces identical calls that are in flight at the same time.
+
+    The first caller for a key starts the upstream call in its own task; callers that
+    arrive with the same key before it finishes wait on that task instead of calling
+    again, and all of them get its result or its exception. Waiters can be cancelled
+    independently: the upstream call is only cancelled once every waiter has gone.
+    """
+
+    def __init__(self, enabled: bool = SINGLEFLIGHT_ENABLED):
+        self.enabled = enabled
+        self._flights: Dict[str, _Flight] = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Return `fn()`, sharing the call with any identical call already in flight.
+
+        Arguments:
+            key: Identifies the call; it must cover everything that determines the result
+            fn: Starts the call
+        """
+        if not self.enabled:
+            return await fn()
+        flight = self._join(key, "call", lambda flight: fn())
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(key, flight)
+
+    async def stream(self, key: str, fn: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        Yield the chunks of `fn()`, sharing the stream with any identical stream in flight.
+
+        A caller that joins late first gets every chunk produced so far, then follows the
+        live stream; an upstream error is raised to every caller after the chunks that
+        preceded it.
+        """
+        if not self.enabled:
+            async for chunk in fn():
+                yield chunk
+            return
+
+        async def pump(flight: _Flight):
+            try:
+                async for chunk in fn():
+                    flight.chunks.append(chunk)
+                    flight.wake()
+            finally:
+                flight.wake()
+
+        flight = self._join(f"stream:{key}", "stream", pump)
+        try:
+            index = 0
+            while True:
+                while index < len(flight.chunks):
+                    yield flight.chunks[index]
+                    index += 1
+                if flight.task.done():
+                    # Surfaces the upstream error, if any
+                    flight.task.result()
+                    return
+                await flight.changed.wait()
+        finally:
+            self._leave(f"stream:{key}", flight)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._flights),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+        }
+
+    def _join(self, key: str, kind: str, start: Callable[[_Flight], Awaitable]) -> _Flight:
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.waiters += 1
+            self.coalesced += 1
+            count_coalesced(kind)
+            return flight
+
+        flight = self._flights[key] = _Flight()
+        flight.waiters = 1
+        self.calls += 1
+        flight.task = asyncio.create_task(start(flight), name=f"singleflight-{kind}")
+
+        def finished(task: asyncio.Task):
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if not task.cancelled():
+                # Marks the exception as retrieved even if every waiter has already left
+                task.exception()
+
+        flight.task.add_done_callback(finished)
+        return flight
+
+    def _leave(self, key: str, flight: _Flight):
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # Nobody wants the result any more; stop paying for it
+            self.cancelled += 1
+            flight.task.cancel()
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+# Shared coalescer used for provider calls
+singleflight = SingleFlight()
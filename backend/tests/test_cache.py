@@ -0,0 +1,18 @@
+from cache import make_cache_key
+
+def test_key_ignores_line_endings_and_outer_whitespace():
+    assert make_cache_key("claude", "model", "system", "line one\nline two", max_tokens=10) == \
+        make_cache_key("claude", "model", " system\n", "\n line one\r\nline two  ", max_tokens=10)
+
+def test_key_keeps_indentation():
+    first = "for item in items:\n    if item:\n        print(item)\n    total += 1"
+    second = "for item in items:\n    if item:\n        print(item)\n        total += 1"
+    assert make_cache_key("claude", "model", "system", first) != make_cache_key("claude", "model", "system", second)
+
+def test_key_keeps_line_breaks():
+    assert make_cache_key("claude", "model", "", "a\nb") != make_cache_key("claude", "model", "", "a b")
+
+def test_key_depends_on_params():
+    assert make_cache_key("claude", "model", "", "hi", temperature=0.0) != \
+        make_cache_key("claude", "model", "", "hi", temperature=1.0)
+    assert make_cache_key("claude", "model", "", "hi", temperature=None) == make_cache_key("claude", "model", "", "hi")
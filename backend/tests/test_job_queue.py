@@ -0,0 +1,185 @@
+import asyncio
+import time
+import pytest
+from job_queue import MemoryJobQueue, SQLiteJobQueue, QUEUED, RUNNING, DONE, FAILED, INTERACTIVE, BATCH
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_queue(request, tmp_path):
+    """Build a queue of each backend with the given settings."""
+    def make(**kwargs):
+        if request.param == "memory":
+            return MemoryJobQueue(**kwargs)
+        return SQLiteJobQueue(path=str(tmp_path / "jobs.sqlite3"), **kwargs)
+    return make
+
+def claim_all(queue, owner="worker", priorities=None):
+    claimed = []
+    while True:
+        job = queue.claim(owner, priorities)
+        if job is None:
+            return claimed
+        claimed.append(job.job_id)
+
+def test_claim_and_complete(make_queue):
+    queue = make_queue()
+    queue.enqueue("a", {"prompt": "hi"})
+    job = queue.claim("worker")
+    assert job.job_id == "a" and job.payload == {"prompt": "hi"}
+    assert job.status == RUNNING and job.attempts == 1
+    assert queue.claim("other") is None
+    queue.complete("a", "worker")
+    assert queue.get("a").status == DONE
+    assert queue.counts()[DONE] == 1
+
+def test_complete_by_another_owner_is_ignored(make_queue):
+    queue = make_queue()
+    queue.enqueue("a", {})
+    queue.claim("worker")
+    queue.complete("a", "other")
+    assert queue.get("a").status == RUNNING
+
+def test_expired_lease_is_redelivered(make_queue):
+    queue = make_queue(visibility_timeout=0.05)
+    queue.enqueue("a", {})
+    assert queue.claim("first").job_id == "a"
+    assert queue.claim("second") is None
+    time.sleep(0.1)
+    job = queue.claim("second")
+    assert job.job_id == "a" and job.owner == "second" and job.attempts == 2
+    assert queue.redelivered == 1
+    # The first worker lost the job
+    assert not queue.heartbeat("a", "first")
+    assert queue.heartbeat("a", "second")
+
+def test_heartbeat_extends_lease(make_queue):
+    queue = make_queue(visibility_timeout=0.1)
+    queue.enqueue("a", {})
+    queue.claim("first")
+    for _ in range(3):
+        time.sleep(0.05)
+        assert queue.heartbeat("a", "first")
+    assert queue.claim("second") is None
+
+def test_sqlite_lease_is_reclaimed_by_another_connection(tmp_path):
+    # Two queues on one file stand in for two worker processes
+    path = str(tmp_path / "jobs.sqlite3")
+    first = SQLiteJobQueue(path=path, visibility_timeout=0.05)
+    second = SQLiteJobQueue(path=path, visibility_timeout=0.05)
+    first.enqueue("a", {"prompt": "hi"})
+    assert first.claim("first").job_id == "a"
+    assert second.claim("second") is None
+    # The first process dies without completing the job
+    time.sleep(0.1)
+    job = second.claim("second")
+    assert job.job_id == "a" and job.payload == {"prompt": "hi"} and job.attempts == 2
+    assert not first.heartbeat("a", "first")
+    first.complete("a", "first")
+    assert second.get("a").status == RUNNING
+    second.complete("a", "second")
+    assert first.get("a").status == DONE
+
+def test_sqlite_calls_run_off_the_event_loop(tmp_path):
+    async def main():
+        queue = SQLiteJobQueue(path=str(tmp_path / "jobs.sqlite3"), poll_interval=5)
+        waiting = asyncio.create_task(queue.wait())
+        await asyncio.sleep(0.01)
+        # The enqueue runs in a thread and still wakes the waiting worker on the loop
+        await queue.offload(queue.enqueue, "a", {})
+        await asyncio.wait_for(waiting, timeout=1)
+        assert (await queue.offload(queue.claim, "worker")).job_id == "a"
+
+    asyncio.run(main())
+
+def test_lost_worker_runs_out_of_attempts(make_queue):
+    queue = make_queue(visibility_timeout=0.02, max_attempts=2)
+    queue.enqueue("a", {})
+    queue.claim("first")
+    time.sleep(0.05)
+    queue.claim("second")
+    time.sleep(0.05)
+    assert queue.claim("third") is None
+    assert queue.get("a").status == FAILED
+
+def test_failed_job_is_retried_until_out_of_attempts(make_queue):
+    queue = make_queue(max_attempts=2)
+    queue.enqueue("a", {})
+    queue.claim("worker")
+    queue.fail("a", "worker", "boom")
+    job = queue.get("a")
+    assert job.status == QUEUED and job.error == "boom"
+    assert queue.claim("worker").attempts == 2
+    queue.fail("a", "worker", "boom again")
+    assert queue.get("a").status == FAILED
+    assert queue.claim("worker") is None
+
+def test_counts_follow_every_transition(make_queue):
+    queue = make_queue(max_attempts=1, retention=0.1)
+    for job_id in ("a", "b", "c"):
+        queue.enqueue(job_id, {})
+        time.sleep(0.001)
+    assert queue.counts() == {QUEUED: 3, RUNNING: 0, DONE: 0, FAILED: 0}
+    queue.claim("worker")
+    queue.complete("a", "worker")
+    queue.claim("worker")
+    queue.fail("b", "worker", "boom")
+    assert queue.counts() == {QUEUED: 1, RUNNING: 0, DONE: 1, FAILED: 1}
+    # Enqueueing a finished job again replaces it
+    queue.enqueue("a", {})
+    assert queue.counts() == {QUEUED: 2, RUNNING: 0, DONE: 0, FAILED: 1}
+    # Finished jobs age out on the next claim
+    time.sleep(0.15)
+    assert queue.claim("worker").job_id == "c"
+    assert queue.counts() == {QUEUED: 1, RUNNING: 1, DONE: 0, FAILED: 0}
+
+def test_interactive_jobs_are_claimed_before_batch_jobs(make_queue):
+    queue = make_queue()
+    queue.enqueue("batch", {}, priority=BATCH)
+    queue.enqueue("interactive", {}, priority=INTERACTIVE)
+    assert claim_all(queue) == ["interactive", "batch"]
+
+def test_claim_only_some_priorities(make_queue):
+    queue = make_queue(visibility_timeout=0.05)
+    queue.enqueue("batch", {}, priority=BATCH)
+    queue.enqueue("interactive", {}, priority=INTERACTIVE)
+    assert claim_all(queue, "batch-worker", (BATCH,)) == ["batch"]
+    assert claim_all(queue, "interactive-worker", (INTERACTIVE,)) == ["interactive"]
+    # Expired leases are only redelivered to workers of the job's class
+    time.sleep(0.1)
+    assert queue.claim("interactive-worker", (INTERACTIVE,)).job_id == "interactive"
+    assert queue.claim("interactive-worker", (INTERACTIVE,)) is None
+    assert queue.claim("batch-worker", (BATCH,)).job_id == "batch"
+
+def test_clients_share_claims_fairly(make_queue):
+    queue = make_queue()
+    for index in range(3):
+        queue.enqueue(f"busy-{index}", {}, client="busy")
+        time.sleep(0.001)
+    queue.enqueue("quiet-0", {}, client="quiet")
+    time.sleep(0.001)
+    queue.enqueue("quiet-1", {}, client="quiet")
+    assert claim_all(queue) == ["busy-0", "quiet-0", "busy-1", "quiet-1", "busy-2"]
+
+def test_position_matches_claim_order(make_queue):
+    queue = make_queue()
+    for index in range(3):
+        queue.enqueue(f"busy-{index}", {}, client="busy")
+        time.sleep(0.001)
+    queue.enqueue("quiet-0", {}, client="quiet")
+    time.sleep(0.001)
+    queue.enqueue("batch", {}, priority=BATCH, client="quiet")
+    assert [queue.position(job_id) for job_id in ("busy-0", "quiet-0", "busy-1", "busy-2")] == [1, 2, 3, 4]
+    # Batch jobs have their own workers, so only batch jobs are ahead of them
+    assert queue.position("batch") == 1
+    queue.claim("worker")
+    assert queue.position("busy-0") is None
+    assert queue.position("quiet-0") == 1
+
+def test_load_counts_queued_and_running_jobs(make_queue):
+    queue = make_queue()
+    queue.enqueue("a", {}, client="client")
+    queue.enqueue("b", {}, client="client")
+    queue.enqueue("c", {}, client="other")
+    queue.claim("worker")
+    assert queue.load("client") == 2
+    queue.complete("a", "worker")
+    assert queue.load("client") == 1
@@ -0,0 +1,36 @@
+import asyncio
+import json
+import prompt_batches
+from prompt_batches import PromptBatchStore, parse_upload, run_prompt_batch
+
+def upload(*records):
+    return "\n".join(json.dumps(record) for record in records)
+
+def test_identical_prompts_are_merged():
+    parsed = parse_upload(upload({"custom_id": "a", "prompt": "Sort a list"},
+                                 {"custom_id": "b", "prompt": " Sort a list\r\n"},
+                                 {"custom_id": "c", "prompt": "Reverse a list"}))
+    assert parsed.lines == 3
+    assert parsed.custom_ids == [["a", "b"], ["c"]]
+
+def test_prompts_differing_in_indentation_are_kept_apart():
+    parsed = parse_upload(upload({"custom_id": "a", "prompt": "if x:\n    a()\n    b()"},
+                                 {"custom_id": "b", "prompt": "if x:\n    a()\nb()"},
+                                 {"custom_id": "c", "prompt": "if x: a() b()"}))
+    assert parsed.custom_ids == [["a"], ["b"], ["c"]]
+
+def test_run_prompt_batch_stores_every_result(tmp_path, monkeypatch):
+    async def fake_process(prompt):
+        await asyncio.sleep(0)
+        return {"status": "completed", "response": prompt.upper()}
+
+    monkeypatch.setattr(prompt_batches, "process_batch_prompt", fake_process)
+    store = PromptBatchStore(str(tmp_path / "batches.sqlite3"))
+    parsed = parse_upload(upload({"custom_id": "a", "prompt": "one"}, {"custom_id": "b", "prompt": "two"},
+                                 {"custom_id": "c", "prompt": "one"}))
+    assert store.create(parsed)
+    asyncio.run(run_prompt_batch(store, parsed.batch_id, concurrency=2))
+    assert store.summary(parsed.batch_id)["pending"] == 0
+    results = {tuple(ids): result["response"] for _, ids, result in store.results(parsed.batch_id)}
+    assert results == {("a", "c"): "ONE", ("b",): "TWO"}
+    store.close()
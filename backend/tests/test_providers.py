@@ -0,0 +1,27 @@
+import asyncio
+import providers
+
+def test_calls_differing_in_whitespace_do_not_share_a_flight(monkeypatch):
+    sent = []
+
+    async def fake_request(model, system_prompt, prompt, max_tokens, temperature):
+        sent.append(prompt)
+        await asyncio.sleep(0.05)
+        return f"reply to {prompt!r}"
+
+    async def no_cache(key):
+        return None
+
+    monkeypatch.setattr(providers, "_anthropic_request", fake_request)
+    monkeypatch.setattr(providers.response_cache, "lookup", no_cache)
+    first = "if x:\n    a()\n    b()"
+    second = "if x:\n    a()\nb()"
+
+    async def main():
+        return await asyncio.gather(providers.anthropic_message("model", "system", first),
+                                    providers.anthropic_message("model", "system", second),
+                                    providers.anthropic_message("model", "system", first))
+
+    replies = asyncio.run(main())
+    assert sorted(sent) == sorted([first, second])
+    assert replies == [f"reply to {first!r}", f"reply to {second!r}", f"reply to {first!r}"]
@@ -0,0 +1,133 @@
+import asyncio
+from job_queue import MemoryJobQueue, DONE, QUEUED, FAILED, INTERACTIVE, BATCH
+from worker import WorkerPool
+
+async def wait_for_status(queue, job_id, status, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while queue.get(job_id).status != status:
+        assert asyncio.get_running_loop().time() < deadline, f"job {job_id} is {queue.get(job_id).status}"
+        await asyncio.sleep(0.01)
+
+def test_runs_jobs_to_completion():
+    async def main():
+        queue = MemoryJobQueue(poll_interval=0.01)
+        handled = []
+
+        async def handler(job):
+            handled.append(job.job_id)
+
+        pool = WorkerPool(queue, handler, concurrency=2)
+        pool.start()
+        for index in range(4):
+            queue.enqueue(f"job-{index}", {})
+        for index in range(4):
+            await wait_for_status(queue, f"job-{index}", DONE)
+        await pool.stop()
+        assert sorted(handled) == [f"job-{index}" for index in range(4)]
+
+    asyncio.run(main())
+
+def test_heartbeat_keeps_long_job_leased():
+    async def main():
+        queue = MemoryJobQueue(visibility_timeout=0.15, poll_interval=0.01)
+        runs = []
+
+        async def handler(job):
+            runs.append(job.job_id)
+            await asyncio.sleep(0.5)
+
+        pool = WorkerPool(queue, handler, concurrency=1)
+        pool.start()
+        queue.enqueue("long", {})
+        await asyncio.sleep(0.05)
+        assert pool.owns("long")
+        # Long past the visibility timeout, the lease is still ours
+        await asyncio.sleep(0.3)
+        assert queue.claim("other") is None
+        await wait_for_status(queue, "long", DONE)
+        await pool.stop()
+        assert runs == ["long"] and queue.get("long").attempts == 1 and pool.lost == 0
+
+    asyncio.run(main())
+
+def test_failing_handler_releases_job_for_retry():
+    async def main():
+        queue = MemoryJobQueue(max_attempts=3, poll_interval=0.01)
+        attempts = []
+
+        async def handler(job):
+            attempts.append(job.attempts)
+            if job.attempts < 2:
+                raise RuntimeError("boom")
+
+        pool = WorkerPool(queue, handler, concurrency=1)
+        pool.start()
+        queue.enqueue("flaky", {})
+        await wait_for_status(queue, "flaky", DONE)
+        await pool.stop()
+        assert attempts == [1, 2]
+
+    asyncio.run(main())
+
+def test_handler_that_always_fails_runs_out_of_attempts():
+    async def main():
+        queue = MemoryJobQueue(max_attempts=2, poll_interval=0.01)
+
+        async def handler(job):
+            raise RuntimeError("boom")
+
+        pool = WorkerPool(queue, handler, concurrency=1)
+        pool.start()
+        queue.enqueue("broken", {})
+        await wait_for_status(queue, "broken", FAILED)
+        await pool.stop()
+        assert queue.get("broken").error == "boom" and queue.get("broken").attempts == 2
+
+    asyncio.run(main())
+
+def test_stop_cancels_running_jobs_for_redelivery():
+    async def main():
+        queue = MemoryJobQueue(visibility_timeout=0.1, poll_interval=0.01)
+        started, cancelled = asyncio.Event(), []
+
+        async def handler(job):
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(job.job_id)
+                raise
+
+        pool = WorkerPool(queue, handler, concurrency=1)
+        pool.start()
+        queue.enqueue("slow", {})
+        await asyncio.wait_for(started.wait(), timeout=1)
+        await pool.stop()
+        assert cancelled == ["slow"]
+        assert not pool.owns("slow") and pool.stats()["workers"] == 0
+        # Neither completed nor failed: the lease runs out and another worker gets the job
+        assert queue.claim("other") is None
+        await asyncio.sleep(0.15)
+        job = queue.claim("other")
+        assert job.job_id == "slow" and job.attempts == 2
+
+    asyncio.run(main())
+
+def test_pools_only_claim_their_priorities():
+    async def main():
+        queue = MemoryJobQueue(poll_interval=0.01)
+        ran = []
+
+        async def handler(job):
+            ran.append(job.job_id)
+
+        pool = WorkerPool(queue, handler, concurrency=1, priorities=(INTERACTIVE,))
+        pool.start()
+        queue.enqueue("batch", {}, priority=BATCH)
+        queue.enqueue("interactive", {}, priority=INTERACTIVE)
+        await wait_for_status(queue, "interactive", DONE)
+        await asyncio.sleep(0.05)
+        await pool.stop()
+        assert ran == ["interactive"] and queue.get("batch").status == QUEUED
+
+    asyncio.run(main())
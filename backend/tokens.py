@@ -0,0 +1,10 @@
+import math
+
+# Rough characters-per-token ratio for English text with Claude and Gemini tokenizers
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate for budgeting; no tokenizer is shipped with the app."""
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
@@ -0,0 +1,167 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import uuid
+from typing import Awaitable, Callable, Collection, Dict, List, Optional, Set
+from job_queue import Job, JobQueue, INTERACTIVE, BATCH
+
+# Set up logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[Job], Awaitable[None]]
+
+class WorkerPool:
+    """
+    Runs jobs from a JobQueue on `concurrency` async workers in this process.
+
+    Each worker claims a job, runs the handler on it and heartbeats the lease meanwhile
+    (every third of the visibility timeout), so only jobs whose process died are handed
+    to another worker. A handler that raises releases the job for a retry.
+
+    With `priorities`, the pool only claims jobs of those priority classes, so a class
+    with long jobs can be given a fixed number of workers instead of taking them all.
+    """
+
+    def __init__(self, queue: JobQueue, handler: JobHandler, concurrency: int,
+                 priorities: Optional[Collection[int]] = None):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.priorities = priorities
+        # Identifies this process's leases in a shared queue
+        self.name = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._workers: List[asyncio.Task] = []
+        self._active: Set[str] = set()
+        self._stopping = False
+        self.lost = 0
+
+    def start(self):
+        """Start the workers on the running event loop."""
+        if self._workers or self.concurrency <= 0:
+            return
+        self._stopping = False
+        self._workers = [asyncio.create_task(self._work(index), name=f"job-worker-{index}")
+                         for index in range(self.concurrency)]
+        logger.info(f"Started {self.concurrency} job workers ({self.name})")
+
+    async def stop(self):
+        """Stop claiming jobs and cancel the ones in progress; their leases run out and they are redelivered."""
+        self._stopping = True
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def run_forever(self):
+        self.start()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    def owns(self, job_id: str) -> bool:
+        """Whether the job is running in this process."""
+        return job_id in self._active
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "name": self.name,
+            "workers": len(self._workers),
+            "active": len(self._active),
+            "lost_leases": self.lost,
+        }
+
+    async def _work(self, index: int):
+        owner = f"{self.name}/{index}"
+        while not self._stopping:
+            try:
+                job = await self.queue.offload(self.queue.claim, owner, self.priorities)
+            except Exception as e:
+                logger.error(f"Error claiming a job: {str(e)}")
+                job = None
+            if job is None:
+                await self.queue.wait()
+                continue
+            await self._run(job, owner)
+
+    async def _run(self, job: Job, owner: str):
+        self._active.add(job.job_id)
+        heartbeat = asyncio.create_task(self._heartbeat(job, owner), name=f"job-heartbeat-{job.job_id}")
+        try:
+            if job.attempts > 1:
+                logger.warning(f"Running job {job.job_id} again (attempt {job.attempts})")
+            # Its own task, so context the handler sets (session id, deferral) ends with the job
+            await asyncio.create_task(self.handler(job), name=f"job-{job.job_id}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Job {job.job_id} failed: {str(e)}")
+            await self.queue.offload(self.queue.fail, job.job_id, owner, str(e))
+        else:
+            await self.queue.offload(self.queue.complete, job.job_id, owner)
+        finally:
+            heartbeat.cancel()
+            self._active.discard(job.job_id)
+
+    async def _heartbeat(self, job: Job, owner: str):
+        while True:
+            await asyncio.sleep(self.queue.visibility_timeout / 3)
+            if not await self.queue.offload(self.queue.heartbeat, job.job_id, owner):
+                # Another worker has the job now; finishing ours too is harmless but wasted
+                self.lost += 1
+                logger.warning(f"Lost the lease on job {job.job_id}")
+                return
+
+def run_worker_process(concurrency: int, batch_concurrency: int):
+    """Entry point of one worker process: the app's shared clients plus a worker pool per priority class."""
+    # Imported here so each spawned process sets up its own clients and loggers
+    from main import job_queue, run_job
+    from http_client import start_http_client, stop_http_client
+    from log_sink import log_sink
+
+    async def main():
+        await start_http_client()
+        log_sink.start()
+        pools = [WorkerPool(job_queue, run_job, concurrency, priorities=(INTERACTIVE,)),
+                 WorkerPool(job_queue, run_job, batch_concurrency, priorities=(BATCH,))]
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, lambda: asyncio.ensure_future(asyncio.gather(*(pool.stop() for pool in pools))))
+        try:
+            await asyncio.gather(*(pool.run_forever() for pool in pools))
+        finally:
+            await log_sink.stop()
+            await stop_http_client()
+
+    asyncio.run(main())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run prompt jobs from the shared job queue (JOB_BACKEND=sqlite)")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes to start")
+    parser.add_argument("--concurrency", type=int, default=16, help="Interactive jobs each process runs at once")
+    parser.add_argument("--batch-concurrency", type=int, default=2, help="Batch-priority jobs each process runs at once")
+    args = parser.parse_args()
+
+    # With either in memory, the workers would never see the API's jobs or the API their results
+    from config import JOB_BACKEND, SESSION_BACKEND
+    if JOB_BACKEND != "sqlite":
+        parser.error("JOB_BACKEND must be sqlite, or these workers only see jobs enqueued in their own process")
+    if SESSION_BACKEND != "sqlite":
+        parser.error("SESSION_BACKEND must be sqlite, or the results of these workers never reach /api/status")
+
+    if args.processes <= 1:
+        run_worker_process(args.concurrency, args.batch_concurrency)
+    else:
+        processes = [multiprocessing.Process(target=run_worker_process, args=(args.concurrency, args.batch_concurrency), name=f"worker-{index}")
+                     for index in range(args.processes)]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
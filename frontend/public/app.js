@@ -11,13 +11,25 @@ document.addEventListener('DOMContentLoaded', () => {
     const codingOutput = document.getElementById('coding-output');
     const literatureOutput = document.getElementById('literature-output');
     const combinedOutput = document.getElementById('combined-output');
+    
+    // Output boxes keyed by the category (or "combined") that streamed text is tagged with
+    const outputsByTarget = {
+        'general_knowledge': generalOutput,
+        'mathematics': mathOutput,
+        'coding': codingOutput,
+        'literature': literatureOutput,
+        'combined': combinedOutput
+    };
 
     
-    // Poll status interval in milliseconds
+    // Poll status interval in milliseconds (only used if server-sent events aren't available)
     const POLL_INTERVAL = 1000;
     
     let currentSessionId = null;
     let pollingInterval = null;
+    let eventSource = null;
+    let sessionState = {};
+    let streamedText = {};
     
     submitButton.addEventListener('click', async () => {
         const prompt = promptInput.value.trim();
@@ -53,14 +65,22 @@ document.addEventListener('DOMContentLoaded', () => {
             });
             
             const data = await response.json();
+            if (!response.ok) {
+                // Turned away by admission control (429/503); the server says when to retry
+                const retryAfter = response.headers.get('Retry-After');
+                throw new Error((data.detail || response.statusText) + (retryAfter ? ` (retry in ${retryAfter}s)` : ''));
+            }
             currentSessionId = data.session_id;
+            sessionState = data;
+            streamedText = {};
             
-            // Start polling for status updates
-            if (pollingInterval) {
-                clearInterval(pollingInterval);
+            // Listen for pushed updates, falling back to polling
+            stopUpdates();
+            if (window.EventSource) {
+                subscribeToEvents();
+            } else {
+                pollingInterval = setInterval(pollStatus, POLL_INTERVAL);
             }
-            
-            pollingInterval = setInterval(pollStatus, POLL_INTERVAL);
         } catch (error) {
             console.error('Error submitting prompt:', error);
             parsingOutput.textContent = 'Error: ' + error.message;
@@ -69,22 +89,85 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
     
+    function subscribeToEvents() {
+        eventSource = new EventSource(`${API_BASE}/api/events/${currentSessionId}`);
+        
+        eventSource.addEventListener('snapshot', (event) => {
+            sessionState = JSON.parse(event.data);
+            handleUpdate(sessionState);
+        });
+        
+        eventSource.addEventListener('update', (event) => {
+            Object.assign(sessionState, JSON.parse(event.data));
+            handleUpdate(sessionState);
+        });
+        
+        eventSource.addEventListener('category', (event) => {
+            const { category, stage, value } = JSON.parse(event.data);
+            sessionState.category_progress = { ...sessionState.category_progress, [category]: stage };
+            if (stage === 'routing') {
+                sessionState.generated_prompts = { ...sessionState.generated_prompts, [category]: value };
+            } else if (stage === 'completed' || stage === 'error') {
+                sessionState.responses = { ...sessionState.responses, [category]: value };
+            }
+            handleUpdate(sessionState);
+        });
+        
+        eventSource.addEventListener('delta', (event) => {
+            const { target, text } = JSON.parse(event.data);
+            streamedText[target] = (streamedText[target] || '') + text;
+            if (outputsByTarget[target]) {
+                outputsByTarget[target].textContent = streamedText[target];
+            }
+        });
+        
+        eventSource.onerror = () => {
+            // The stream closes normally once the session is done; otherwise fall back to polling
+            if (eventSource) {
+                eventSource.close();
+                eventSource = null;
+            }
+            if (currentSessionId && !isFinished(sessionState)) {
+                console.warn('Event stream lost, falling back to polling');
+                pollingInterval = setInterval(pollStatus, POLL_INTERVAL);
+            }
+        };
+    }
+    
+    function isFinished(data) {
+        return data.status === 'completed' || data.status === 'error' || data.status === 'not_found';
+    }
+    
+    function stopUpdates() {
+        if (eventSource) {
+            eventSource.close();
+            eventSource = null;
+        }
+        if (pollingInterval) {
+            clearInterval(pollingInterval);
+            pollingInterval = null;
+        }
+    }
+    
+    function handleUpdate(data) {
+        updateUI(data);
+        
+        // Stop listening when completed or error
+        if (isFinished(data)) {
+            stopUpdates();
+            submitButton.disabled = false;
+            submitButton.textContent = 'Submit Prompt';
+        }
+    }
+    
     async function pollStatus() {
         if (!currentSessionId) return;
         
         try {
             const response = await fetch(`${API_BASE}/api/status/${currentSessionId}`);
-            const data = await response.json();
+            sessionState = await response.json();
             
-            updateUI(data);
-            
-            // Stop polling when completed or error
-            if (data.status === 'completed' || data.status === 'error') {
-                clearInterval(pollingInterval);
-                pollingInterval = null;
-                submitButton.disabled = false;
-                submitButton.textContent = 'Submit Prompt';
-            }
+            handleUpdate(sessionState);
         } catch (error) {
             console.error('Error polling status:', error);
             parsingOutput.textContent = 'Error polling status: ' + error.message;
@@ -95,9 +178,15 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
+    function queuedMessage(data) {
+        return 'Waiting for a free worker...' + (data.queue_position ? ` (position ${data.queue_position} in line)` : '');
+    }
+    
     function updateUI(data) {
         // Update parsing output
-        if (data.status === 'parsing') {
+        if (data.status === 'queued') {
+            parsingOutput.textContent = queuedMessage(data);
+        } else if (data.status === 'parsing') {
             parsingOutput.textContent = 'Analyzing prompt with Claude 3.7 Sonnet...';
         } else if (data.parsed_categories) {
             parsingOutput.innerHTML = '<strong>Parsed Categories:</strong>\n\n';
@@ -106,6 +195,33 @@ document.addEventListener('DOMContentLoaded', () => {
                 const formattedCategory = category.replace('_', ' ').replace(/\b\w/g, c => c.toUpperCase());
                 parsingOutput.innerHTML += `<strong>${formattedCategory}:</strong> ${content === 'Not Applicable' ? 'Not Applicable' : 'Applicable'}\n`;
             }
+
+            // Note which stages the backend decided to skip
+            if (data.plan && data.plan.name !== 'full') {
+                const skipped = [];
+                if (data.plan.rewrite.length < data.plan.categories.length) skipped.push('prompt rewriting');
+                if (!data.plan.combine) skipped.push('combining');
+                if (skipped.length) {
+                    parsingOutput.innerHTML += `\n<strong>Fast path:</strong> skipping ${skipped.join(' and ')}\n`;
+                }
+            }
+        }
+        
+        // Show where each category is while its response is still on the way
+        if (data.category_progress) {
+            const progressMessages = {
+                'pending': 'Waiting...',
+                'generating': 'Generating optimized prompt...',
+                'routing': 'Waiting for model response...'
+            };
+            
+            for (const [category, stage] of Object.entries(data.category_progress)) {
+                const output = outputsByTarget[category];
+                const hasText = (data.responses && data.responses[category]) || streamedText[category];
+                if (output && progressMessages[stage] && !hasText) {
+                    output.textContent = progressMessages[stage];
+                }
+            }
         }
         
         // Update LLM outputs
@@ -134,6 +250,7 @@ document.addEventListener('DOMContentLoaded', () => {
         
         // Update status messages
         const statusMessages = {
+            'queued': queuedMessage(data),
             'parsing': 'Analyzing prompt with Claude 3.7 Sonnet...',
             'generating_prompts': 'Generating optimized prompts for each category...',
             'routing_to_llms': 'Sending prompts to specialized LLMs...',